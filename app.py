@@ -1,19 +1,65 @@
 import os
-import json
+import sqlite3
+import time
+from datetime import datetime
+from typing import Optional
+
 import streamlit as st
 
+import metrics
 from utils import load_env
-from llm_client import LLMClient
+from jobs import EDIT_MODES, get_job_manager
+from library import get_persona_library
+from cache import get_response_cache
+from governor import get_governor
+from local_provider import local_model_stats
+from clients import pool_stats
+from router import all_router_stats
 from persona_schema import PersonaBundle
+from llm_client import LLMClient
+from render import bundle_json, persona_key, render_persona
+from study import MAX_PERSONAS, MIN_PERSONAS, get_study_manager, parquet_available
 from auth import login_required, logout, init_auth_session, show_admin_panel
 
 
 load_env()
+
+
 st.set_page_config(page_title="Generador de Personas con IA", page_icon="🧠", layout="wide")
 
+
+@st.cache_resource(show_spinner=False)
+def _setup_metrics() -> None:
+    # Once per process, not on every rerun
+    metrics.configure()
+    metrics.start_http_server()
+
+
+_setup_metrics()
+
 # Initialize auth session
 init_auth_session()
 
+# Last generated bundles are kept per session so reruns never repeat the LLM call
+MAX_SESSION_BUNDLES = 5
+if "bundles" not in st.session_state:
+    st.session_state.bundles = []
+if "job_history" not in st.session_state:
+    # Job ids are mirrored in the URL, so a browser refresh picks finished results back up
+    st.session_state.job_history = [j for j in st.query_params.get("jobs", "").split(",") if j]
+    st.session_state.jobs = list(st.session_state.job_history)
+    st.session_state.job_errors = []
+if "study_id" not in st.session_state:
+    st.session_state.study_id = st.query_params.get("study", "")
+
+LIBRARY_PAGE_SIZE = 20
+STUDY_PAGE_SIZE = 50
+STUDY_COLUMNS = {
+    "segment": "Segmento", "name": "Nombre", "age_range": "Edad", "gender": "Género",
+    "occupation": "Ocupación", "location": "Ubicación", "income_range": "Ingresos",
+}
+MODE_KEYS = {"Streaming": "stream", "Paralelo (una llamada por persona)": "fanout", "Completo": "full"}
+
 # Main app content
 @login_required
 def main_app():
@@ -26,6 +72,77 @@ def main_app():
         st.write(f"Proveedor: `{provider}`")
         default_num = 4
         num_personas = st.slider("Cantidad de personas", min_value=3, max_value=5, value=default_num)
+        fresh = st.checkbox("Generación fresca (ignorar caché)", value=False)
+        mode = st.radio(
+            "Modo de generación",
+            ["Streaming", "Paralelo (una llamada por persona)", "Completo"],
+            help="Streaming muestra cada persona al terminarla; Paralelo genera todas a la vez y reintenta solo las fallidas.",
+        )
+
+        cache = get_response_cache()
+        if cache is not None:
+            with st.expander("📦 Caché de respuestas"):
+                stats = cache.stats()
+                hits = int(stats["memory_hits"] + stats["disk_hits"])
+                st.markdown(
+                    f"- Aciertos: **{hits}** (memoria {int(stats['memory_hits'])}, disco {int(stats['disk_hits'])})\n"
+                    f"- Fallos: **{int(stats['misses'])}** · Tasa de acierto: **{stats['hit_rate']:.0%}**\n"
+                    f"- Tiempo ahorrado: **{stats['saved_seconds']:.1f} s** · Tokens ahorrados: **{int(stats['saved_tokens'])}**"
+                )
+        routes = all_router_stats()
+        if routes:
+            with st.expander("🛰️ Proveedores"):
+                for route in routes:
+                    p95 = f"{route['p95']:.1f} s" if route["p95"] is not None else "—"
+                    st.markdown(
+                        f"**{route['provider']}** (`{route['model']}`) · p95: {p95} · "
+                        f"errores: {route['error_rate']:.0%} · circuito: {route['circuit']}"
+                    )
+        index = _similarity_index()
+        if index is not None:
+            similar = index.stats()
+            if similar["lookups"]:
+                with st.expander("🔁 Solicitudes similares"):
+                    st.markdown(
+                        f"- Indexadas: **{int(similar['indexed'])}** · Consultas: **{int(similar['lookups'])}**\n"
+                        f"- Coincidencias: **{int(similar['hits'])}** ({similar['hit_rate']:.0%}) · "
+                        f"Reutilizadas: **{int(similar['accepted'])}** ({similar['accept_rate']:.0%})"
+                    )
+        job_stats = get_job_manager().stats()
+        if job_stats["submitted"]:
+            with st.expander("⏳ Cola de generación"):
+                st.markdown(
+                    f"- En curso: **{job_stats['running']}** / {job_stats['max_workers']} · En cola: **{job_stats['queued']}**\n"
+                    f"- Completadas: **{job_stats['completed']}** · Fallidas: **{job_stats['failed']}** · "
+                    f"Compartidas entre sesiones: **{job_stats['coalesced']}**"
+                )
+        governor = get_governor()
+        if governor is not None:
+            limits = governor.stats()
+            if limits["queued"] or limits["waiting"]:
+                with st.expander("🚦 Límites de uso"):
+                    st.markdown(
+                        f"- Esperando turno ahora: **{int(limits['waiting'])}**\n"
+                        f"- Llamadas en cola (este proceso): **{int(limits['queued'])}** de {int(limits['granted'])} · "
+                        f"espera media: **{limits['avg_wait']:.1f} s**"
+                    )
+        for local in local_model_stats():
+            if local["requests"]:
+                with st.expander("🖥️ Modelo local"):
+                    st.markdown(
+                        f"- **{local['model']}**{' (esquema compacto)' if local['compact'] else ''} · solicitudes: **{int(local['requests'])}** · en cola: {int(local['queued'])}\n"
+                        f"- {local['tokens_per_sec']:.1f} tokens/s · prefijo reutilizado: **{local['reuse_rate']:.0%}** "
+                        f"del prompt"
+                    )
+        pools = pool_stats()
+        if pools:
+            with st.expander("🔌 Conexiones HTTP"):
+                for pool in pools:
+                    st.markdown(
+                        f"**{pool['pool']}** · peticiones: {pool['requests']} · "
+                        f"abiertas: {pool.get('connections', '?')} (inactivas: {pool.get('idle', '?')}) · "
+                        f"HTTP/2: {'sí' if pool['http2'] else 'no'}"
+                    )
         
         # Show user info and logout
         if st.session_state.user_info:
@@ -38,173 +155,489 @@ def main_app():
         # Show admin panel
         show_admin_panel()
 
-    product = st.text_area("Describe tu producto", height=120, placeholder="Ej.: App móvil de hábitos para profesionales ocupados...")
-    target = st.text_area("Describe tu mercado objetivo", height=100, placeholder="Ej.: Hombres y mujeres 25-40 en ciudades grandes que...")
+    tab_generate, tab_library, tab_study = st.tabs(["🧠 Generar", "📚 Biblioteca", "📊 Estudio"])
+    # Runs first so personas picked from the library show up in the results below on the same rerun
+    with tab_library:
+        _show_library()
+    with tab_study:
+        _show_study_tab()
+
+    with tab_generate:
+        product = st.text_area("Describe tu producto", height=120, placeholder="Ej.: App móvil de hábitos para profesionales ocupados...")
+        target = st.text_area("Describe tu mercado objetivo", height=100, placeholder="Ej.: Hombres y mujeres 25-40 en ciudades grandes que...")
+
+        col1, col2 = st.columns([1, 2])
+        with col1:
+            generate = st.button("Generar personas")
+        with col2:
+            wait = _expected_wait(product, target, num_personas)
+            if wait >= 1:
+                st.caption(f"⏱️ Límite de uso alcanzado: la generación empezaría en ~{wait:.0f} s (se pone en cola, no se pierde).")
+
+        placeholder = st.container()
+
+        if generate:
+            if not product.strip() or not target.strip():
+                st.warning("Por favor completa producto y mercado objetivo.")
+            else:
+                request = {"mode": MODE_KEYS[mode], "product": product, "target": target, "num_personas": num_personas}
+                offer = None if fresh else _find_similar(request)
+                st.session_state.similar_offer = offer
+                if offer is None:
+                    _submit_job(request, fresh)
+
+        if st.session_state.get("similar_offer"):
+            _show_similar_offer(st.session_state.similar_offer)
+
+        for error in st.session_state.job_errors:
+            st.error(f"Error al generar: {error}")
+        st.session_state.job_errors = []
+
+        if st.session_state.jobs:
+            with placeholder:
+                _job_progress()
+
+        # Results live in session state, so widget reruns redraw them without calling the LLM again
+        if st.session_state.bundles:
+            with placeholder, metrics.stage("render"):
+                _show_results()
+
+
+def _submit_job(request: dict, fresh: bool) -> None:
+    # Runs on the shared job pool: identical in-flight requests from other sessions are joined
+    user = (st.session_state.user_info or {}).get("email")
+    job = get_job_manager().submit(
+        request["mode"], request["product"], request["target"], request["num_personas"], fresh=fresh, user=user,
+    )
+    _track_job(job.id)
+
+
+@st.cache_resource(show_spinner=False)
+def _estimate_client(user: Optional[str]) -> LLMClient:
+    # Only used for wait estimates, so one client per user is shared across reruns and sessions
+    return LLMClient(user=user)
+
+
+def _expected_wait(product: str, target: str, num_personas: int) -> float:
+    if get_governor() is None:
+        return 0.0
+    try:
+        client = _estimate_client((st.session_state.user_info or {}).get("email"))
+    except ValueError:
+        # Missing credentials are reported when generating (failures are not cached)
+        return 0.0
+    return client.expected_wait(product, target, num_personas)
+
+
+def _similarity_index():
+    # similarity and diversity need numpy: they are imported inside the functions that use them
+    # (here, in the job pool and in LLMClient.diversify) so the login page never loads it
+    from similarity import get_similarity_index
+
+    return get_similarity_index()
+
+
+def _show_diversity(bundle: PersonaBundle) -> None:
+    if len(bundle.personas) < 2:
+        return
+    from diversity import analyze
+
+    # Scored on every render (well under a millisecond): regenerated or refined personas count at once
+    report = analyze(bundle, float(os.getenv("DIVERSITY_PAIR_THRESHOLD", "0.8")))
+    st.caption(f"🎯 Diversidad del conjunto: {report.score:.2f} (1 = personas sin solapamiento)")
+    if report.pairs:
+        names = [p.name for p in bundle.personas]
+        pairs = ", ".join(f"{i + 1}. {names[i]} ~ {j + 1}. {names[j]} ({s:.0%})" for i, j, s in report.pairs)
+        st.warning(f"Personas muy parecidas: {pairs}. Usa 🔄 Regenerar en una de ellas para obtener otro perfil.")
+
+
+def _find_similar(request: dict):
+    index = _similarity_index()
+    library = get_persona_library()
+    if index is None or library is None:
+        return None
+    with metrics.stage("similarity_lookup"):
+        match = index.lookup(request["product"], request["target"], request["num_personas"])
+    if match is None:
+        return None
+    generation_id, score = match
+    generation = library.get_generation(generation_id)
+    if generation is None or not generation["bundle"].personas:
+        return None
+    return {"generation": generation, "score": score, "request": request}
+
 
-    col1, col2 = st.columns([1, 2])
-    with col1:
-        generate = st.button("Generar personas")
+def _accept_similar() -> None:
+    offer = st.session_state.similar_offer
+    generation = offer["generation"]
+    _remember_bundle(generation["product"], generation["target"], generation["bundle"], {})
+    index = _similarity_index()
+    if index is not None:
+        index.record_accepted()
+    st.session_state.similar_offer = None
 
-    placeholder = st.container()
 
-    # ===== Helpers UX =====
-    def _mk_kv_table(rows):
-        # rows: list of (label, value)
-        clean = [(k, v) for k, v in rows if v not in (None, "", [])]
-        if not clean:
-            return ""
-        header = "| Campo | Detalle |\n|---|---|"
-        body = "\n".join([f"| {k} | {v} |" for k, v in clean])
-        return f"{header}\n{body}"
+def _decline_similar() -> None:
+    offer = st.session_state.similar_offer
+    st.session_state.similar_offer = None
+    _submit_job(offer["request"], fresh=True)
 
 
-    def _mk_bullets(items, icon="•"):
-        if not items:
-            return ""
-        return "\n".join([f"- {icon} {it}" for it in items])
+def _show_similar_offer(offer: dict) -> None:
+    generation = offer["generation"]
+    st.info(
+        f"🔁 Ya existe un resultado para una solicitud parecida (similitud {offer['score']:.0%}):\n\n"
+        f"**Producto:** {generation['product'][:200]}\n\n**Mercado:** {generation['target'][:200]}"
+    )
+    col_use, col_new = st.columns(2)
+    with col_use:
+        st.button("Usar ese resultado (instantáneo)", on_click=_accept_similar, type="primary")
+    with col_new:
+        st.button("Generar de nuevo", on_click=_decline_similar)
 
 
-    def _mk_segmentation_table(levels):
-        if not levels:
-            return ""
-        header = "| Nivel | Etiqueta | Criterios |\n|---|---|---|"
-        rows = []
-        for lvl in levels:
-            if not isinstance(lvl, dict):
+def _track_job(job_id: str) -> None:
+    if job_id not in st.session_state.jobs:
+        st.session_state.jobs.append(job_id)
+    if job_id not in st.session_state.job_history:
+        st.session_state.job_history.append(job_id)
+    del st.session_state.job_history[:-MAX_SESSION_BUNDLES]
+    st.query_params["jobs"] = ",".join(st.session_state.job_history)
+
+
+@st.fragment(run_every=1.0)
+def _job_progress() -> None:
+    """Poll this session's jobs; finished ones move into the session results"""
+    manager = get_job_manager()
+    finished = False
+    for job_id in list(st.session_state.jobs):
+        job = manager.get(job_id)
+        if job is None or job.done:
+            # Unknown ids are jobs that expired or were lost with a server restart
+            st.session_state.jobs.remove(job_id)
+            finished = True
+            if job is None or _finish_edit(job):
                 continue
-            level_name = lvl.get("level", "")
-            label = lvl.get("label", "")
-            criteria = lvl.get("criteria", [])
-            crit = ", ".join(criteria) if isinstance(criteria, list) else str(criteria or "")
-            rows.append(f"| {level_name} | {label} | {crit} |")
-        if not rows:
-            return ""
-        return f"{header}\n" + "\n".join(rows)
+            if job.status == "error":
+                st.session_state.job_errors.append(job.error)
+            elif job.bundle is not None and job.bundle.personas:
+                _remember_bundle(job.product, job.target, job.bundle, job.usage)
+            else:
+                st.session_state.job_errors.append("No se recibieron personas. Ajusta el prompt o intenta de nuevo.")
+            continue
+        if job.status == "queued":
+            st.info(f"En cola (posición {manager.queue_position(job) + 1}). Generando en cuanto haya un turno libre...")
+            continue
+        elapsed = time.time() - (job.started_at or job.created_at)
+        if job.rate_wait > 0:
+            ahead = f" · {job.rate_waiters_ahead} solicitudes antes que la tuya" if job.rate_waiters_ahead else ""
+            st.info(f"Límite de uso alcanzado: la generación continúa en ~{job.rate_wait:.0f} s{ahead}.")
+        if job.mode in EDIT_MODES:
+            st.info(f"Actualizando persona... {elapsed:.0f} s")
+            continue
+        st.info(f"Generando personas... {len(job.personas)} de {job.num_personas} listas · {elapsed:.0f} s")
+        for idx, p in enumerate(list(job.personas), start=1):
+            with metrics.stage("render"):
+                render_persona(idx, p, expanded=(idx == 1))
+    if finished:
+        st.rerun()
+
+
+def _reset_library_page() -> None:
+    st.session_state.library_page = 0
+
+
+def _move_library_page(step: int) -> None:
+    st.session_state.library_page = max(0, st.session_state.get("library_page", 0) + step)
+
+
+def _show_library() -> None:
+    """Search past generations and reuse stored personas without calling the LLM"""
+    library = get_persona_library()
+    if library is None:
+        st.info("La biblioteca está desactivada (LIBRARY_ENABLED=0).")
+        return
+    col_query, col_age, col_mine = st.columns([3, 1, 1])
+    with col_query:
+        query = st.text_input(
+            "Buscar personas", key="library_query", on_change=_reset_library_page,
+            placeholder="Ej.: motociclista, ahorro, Instagram...",
+        )
+    with col_age:
+        age = st.selectbox("Edad", ["Todas", *library.age_ranges()], key="library_age", on_change=_reset_library_page)
+    with col_mine:
+        mine = st.checkbox("Solo mías", key="library_mine", on_change=_reset_library_page)
+
+    user = (st.session_state.user_info or {}).get("email") if mine else None
+    page = st.session_state.get("library_page", 0)
+    started = time.perf_counter()
+    rows, total = library.search(
+        query, user=user, age_range=None if age == "Todas" else age, page=page, page_size=LIBRARY_PAGE_SIZE,
+    )
+    pages = max(1, -(-total // LIBRARY_PAGE_SIZE))
+    st.caption(f"{total} personas · página {page + 1} de {pages} · {(time.perf_counter() - started) * 1000:.0f} ms")
 
+    selected = []
+    for row in rows:
+        label = f"**{row['name']}** · {row['age_range'] or '—'} · {row['occupation'] or '—'} — _{row['product'][:60]}_"
+        if st.checkbox(label, key=f"library_pick_{row['id']}"):
+            selected.append(row["id"])
 
-    if generate:
+    col_prev, col_use, col_next = st.columns([1, 2, 1])
+    with col_prev:
+        st.button("← Anterior", disabled=page == 0, on_click=_move_library_page, args=(-1,))
+    with col_next:
+        st.button("Siguiente →", disabled=page + 1 >= pages, on_click=_move_library_page, args=(1,))
+    with col_use:
+        if st.button(f"Usar seleccionadas ({len(selected)})", disabled=not selected):
+            personas = library.get_personas(selected)
+            _remember_bundle(f"Biblioteca: {query or 'selección'}", "", PersonaBundle(personas=personas), {})
+            st.success("Agregadas a los resultados de la pestaña Generar.")
+
+
+def _show_study_tab() -> None:
+    """Segmentation studies of 50-500 personas: generated in chunks, stored on disk, shown one page at a time"""
+    st.caption(
+        "Un estudio divide el mercado en segmentos y genera varias personas por segmento en llamadas "
+        "paralelas. Los resultados se guardan en disco y se muestran por páginas."
+    )
+    with st.form("study_form"):
+        product = st.text_area("Producto", height=100, key="study_product")
+        target = st.text_area("Mercado objetivo", height=80, key="study_target")
+        num_personas = st.number_input(
+            "Cantidad de personas", min_value=MIN_PERSONAS, max_value=MAX_PERSONAS, value=100, step=10,
+        )
+        start = st.form_submit_button("Iniciar estudio")
+    if start:
         if not product.strip() or not target.strip():
             st.warning("Por favor completa producto y mercado objetivo.")
         else:
-            with st.spinner("Generando personas..."):
-                try:
-                    client = LLMClient()
-                    bundle: PersonaBundle = client.generate_personas(product, target, num_personas)
-                except Exception as e:
-                    st.error(f"Error al generar: {e}")
-                    st.stop()
+            user = (st.session_state.user_info or {}).get("email")
+            study = get_study_manager().submit(product, target, int(num_personas), user=user)
+            st.session_state.study_id = study.id
+            st.session_state.study_page = 0
+            st.query_params["study"] = study.id
 
-            with placeholder:
-                if not bundle.personas:
-                    st.info("No se recibieron personas. Ajusta el prompt o intenta de nuevo.")
-                else:
-                    for idx, p in enumerate(bundle.personas, start=1):
-                        with st.expander(f"Persona {idx}: {p.name}", expanded=(idx == 1)):
-                            cols = st.columns(3)
-                            with cols[0]:
-                                st.markdown("### 👤 Demográficos")
-                                demo_table = _mk_kv_table([
-                                    ("Edad", p.age_range),
-                                    ("Género", p.gender),
-                                    ("Ubicación", p.location),
-                                    ("Ocupación", p.occupation),
-                                    ("Ingresos", p.income_range),
-                                    ("Educación", p.education),
-                                ])
-                                if demo_table:
-                                    st.markdown(demo_table)
-                                if getattr(p, "behavioral_signals", None):
-                                    st.markdown("### 🧭 Señales conductuales")
-                                    st.markdown(_mk_bullets(getattr(p, "behavioral_signals"), icon="🧩"))
-                            with cols[1]:
-                                st.markdown("### 🧠 Psicográficos")
-                                if p.psychographics.values:
-                                    st.markdown("**Valores**")
-                                    st.markdown(_mk_bullets(p.psychographics.values, icon="💎"))
-                                if p.psychographics.interests:
-                                    st.markdown("**Intereses**")
-                                    st.markdown(_mk_bullets(p.psychographics.interests, icon="🎯"))
-                                if p.psychographics.lifestyle:
-                                    st.markdown("**Estilo de vida**")
-                                    st.markdown(_mk_bullets(p.psychographics.lifestyle, icon="🌱"))
-                                st.markdown("### 🚀 Motivaciones")
-                                if p.motivations:
-                                    st.markdown(_mk_bullets(p.motivations, icon="⚡"))
-                                st.markdown("### 🛑 Frustraciones")
-                                if p.frustrations:
-                                    st.markdown(_mk_bullets(p.frustrations, icon="❗"))
-                            with cols[2]:
-                                st.markdown("### 📣 Canales y Mensaje")
-                                if p.preferred_channels:
-                                    st.markdown("**Canales preferidos**")
-                                    st.markdown(_mk_bullets(p.preferred_channels, icon="📡"))
-                                if p.messaging_tone:
-                                    st.markdown(f"**Tono recomendado**: ✨ {p.messaging_tone}")
-                                if getattr(p, "segmentation_levels", None):
-                                    st.markdown("**🔎 Segmentación multinivel**")
-                                    seg_table = _mk_segmentation_table(getattr(p, "segmentation_levels"))
-                                    if seg_table:
-                                        st.markdown(seg_table)
-                                if getattr(p, "creative_brief", None):
-                                    st.markdown("**📝 Brief narrativo**")
-                                    st.info(getattr(p, "creative_brief"))
-                            # Narrative and frameworks
-                            st.markdown("### 🧩 Canvas de Valor")
-                            vc = getattr(p, "value_canvas", None)
-                            if isinstance(vc, dict) and any(vc.get(k) for k in ["customer_jobs", "pains", "gains", "value_props", "pain_relievers", "gain_creators"]):
-                                c1, c2, c3 = st.columns(3)
-                                with c1:
-                                    if vc.get("customer_jobs"):
-                                        st.markdown("**👔 Customer jobs**")
-                                        st.markdown(_mk_bullets(vc.get("customer_jobs"), icon="🧰"))
-                                    if vc.get("value_props"):
-                                        st.markdown("**💡 Value props**")
-                                        st.markdown(_mk_bullets(vc.get("value_props"), icon="💡"))
-                                with c2:
-                                    if vc.get("pains"):
-                                        st.markdown("**😣 Pains**")
-                                        st.markdown(_mk_bullets(vc.get("pains"), icon="❌"))
-                                    if vc.get("pain_relievers"):
-                                        st.markdown("**🩹 Pain relievers**")
-                                        st.markdown(_mk_bullets(vc.get("pain_relievers"), icon="🩹"))
-                                with c3:
-                                    if vc.get("gains"):
-                                        st.markdown("**📈 Gains**")
-                                        st.markdown(_mk_bullets(vc.get("gains"), icon="✅"))
-                                    if vc.get("gain_creators"):
-                                        st.markdown("**🚀 Gain creators**")
-                                        st.markdown(_mk_bullets(vc.get("gain_creators"), icon="🚀"))
-                            em = getattr(p, "empathy_map", None)
-                            if isinstance(em, dict) and any(em.get(k) for k in ["think", "feel", "see", "say_do", "pains", "gains"]):
-                                st.markdown("### 🤝 Mapa de empatía")
-                                c1, c2, c3 = st.columns(3)
-                                with c1:
-                                    if em.get("think"):
-                                        st.markdown("**🧠 Piensa**")
-                                        st.markdown(_mk_bullets(em.get("think"), icon="🧠"))
-                                    if em.get("feel"):
-                                        st.markdown("**💓 Siente**")
-                                        st.markdown(_mk_bullets(em.get("feel"), icon="💓"))
-                                with c2:
-                                    if em.get("see"):
-                                        st.markdown("**👀 Ve**")
-                                        st.markdown(_mk_bullets(em.get("see"), icon="👀"))
-                                    if em.get("say_do"):
-                                        st.markdown("**🗣️ Dice/Hace**")
-                                        st.markdown(_mk_bullets(em.get("say_do"), icon="🗣️"))
-                                with c3:
-                                    if em.get("pains"):
-                                        st.markdown("**⚠️ Dolores**")
-                                        st.markdown(_mk_bullets(em.get("pains"), icon="⚠️"))
-                                    if em.get("gains"):
-                                        st.markdown("**🏆 Ganancias**")
-                                        st.markdown(_mk_bullets(em.get("gains"), icon="🏆"))
-                            if p.summary:
-                                st.markdown("### 🧾 Resumen ampliado")
-                                st.success(p.summary)
-                    st.divider()
-                    with st.expander("Ver respuesta JSON (opcional)"):
-                        st.code(json.dumps(bundle.model_dump(), ensure_ascii=False, indent=2), language="json")
+    study = get_study_manager().get(st.session_state.study_id)
+    if study is None:
+        return
+    if study.done:
+        _study_view(study)
+    else:
+        _study_live()
+
+
+@st.fragment(run_every=1.0)
+def _study_live() -> None:
+    """Progress of the running study; new chunks appear without rerunning the rest of the app"""
+    study = get_study_manager().get(st.session_state.study_id)
+    if study is None:
+        return
+    if study.done:
+        st.rerun()
+    _study_view(study)
+
+
+def _move_study_page(step: int, pages: int) -> None:
+    st.session_state.study_page = min(max(0, st.session_state.get("study_page", 0) + step), pages - 1)
+
+
+def _study_view(study) -> None:
+    total = len(study.store)
+    if study.status in {"queued", "running"}:
+        st.progress(min(1.0, total / study.num_personas), text=f"{total} de {study.num_personas} personas · "
+                    f"{study.segments} segmentos listos")
+        if study.rate_wait > 0:
+            st.info(f"Límite de uso alcanzado: el estudio continúa en ~{study.rate_wait:.0f} s.")
+    elif study.status == "done":
+        st.success(f"Estudio completo: {total} personas · {study.usage.get('total_tokens', 0)} tokens")
+    elif study.status == "interrupted":
+        st.warning(f"El estudio se interrumpió (reinicio del servidor) con {total} de {study.num_personas} personas.")
+    else:
+        st.error(f"Error en el estudio: {study.error}")
+    if not total:
+        return
+
+    pages = max(1, -(-total // STUDY_PAGE_SIZE))
+    page = min(st.session_state.get("study_page", 0), pages - 1)
+    # Only this page is read from disk; the table scrolls virtually and the detail is built for one row
+    rows = study.store.rows(page * STUDY_PAGE_SIZE, STUDY_PAGE_SIZE)
+    event = st.dataframe(
+        rows, hide_index=True, column_config=STUDY_COLUMNS, on_select="rerun", selection_mode="single-row",
+        key=f"study_table_{study.id}_{page}",
+    )
+    col_prev, col_page, col_next = st.columns([1, 2, 1])
+    with col_prev:
+        st.button("← Anterior", key="study_prev", disabled=page == 0, on_click=_move_study_page, args=(-1, pages))
+    with col_page:
+        st.caption(f"Página {page + 1} de {pages} · {total} personas")
+    with col_next:
+        st.button("Siguiente →", key="study_next", disabled=page + 1 >= pages, on_click=_move_study_page,
+                  args=(1, pages))
+    selected = event.selection.rows if event is not None else []
+    if selected:
+        position = page * STUDY_PAGE_SIZE + selected[0]
+        segment, persona = study.store.read(position, 1)[0]
+        st.caption(f"Segmento: {segment}")
+        render_persona(position + 1, persona, expanded=True)
+    else:
+        st.caption("Selecciona una fila para ver la persona completa.")
+
+    if study.done:
+        col_jsonl, col_parquet = st.columns(2)
+        with col_jsonl, open(study.store.path, "rb") as fh:
+            st.download_button("⬇️ JSONL", fh, file_name=f"estudio_{study.id}.jsonl", mime="application/jsonl")
+        if parquet_available():
+            with col_parquet:
+                parquet_path = os.path.join(study.directory, "personas.parquet")
+                if not os.path.exists(parquet_path):
+                    study.store.export_parquet(parquet_path)
+                with open(parquet_path, "rb") as fh:
+                    st.download_button("⬇️ Parquet", fh, file_name=f"estudio_{study.id}.parquet",
+                                       mime="application/vnd.apache.parquet")
+
+
+@st.fragment
+def _persona_card(entry_index: int, idx: int, expanded: bool = False) -> None:
+    """One persona plus its regenerate/refine actions; only this card reruns on interaction.
+
+    Edits run as jobs on the shared pool; ``_job_progress`` patches the bundle when one finishes
+    and reruns the whole app, so the diversity summary and downloads follow the edit.
+    """
+    if st.session_state.pop("edit_submitted", False):
+        # The edit job is polled by _job_progress, which is only drawn by a full rerun
+        st.rerun(scope="app")
+    entry = st.session_state.bundles[entry_index]
+    personas = entry["bundle"].personas
+    if idx > len(personas):
+        return
+    p = personas[idx - 1]
+    # Content keys are computed when a bundle is stored or patched, never on a rerun
+    p_key = _persona_keys(entry)[idx - 1]
+    render_persona(idx, p, expanded=expanded, key=p_key)
+    edit = entry.get("last_edit")
+    if edit and edit["position"] == idx - 1 and edit["usage"].get("completion_tokens"):
+        verb = "regenerada" if edit["mode"] == "regenerate" else "refinada"
+        st.caption(f"✔ Persona {verb} · {edit['usage']['completion_tokens']} tokens de salida")
+    error = st.session_state.get("persona_errors", {}).pop(f"{entry_index}_{idx}", None)
+    if error:
+        st.error(f"Error al actualizar la persona: {error}")
+    key = f"{entry_index}_{idx}"
+    instruction_key = f"instruction_{key}_{p_key}"
+    busy = idx - 1 in entry.get("pending", {}).values()
+    if busy:
+        st.caption("⏳ Actualizando esta persona...")
+    col_regen, col_instruction, col_refine = st.columns([1, 3, 1])
+    with col_regen:
+        st.button(
+            "🔄 Regenerar", key=f"regen_{key}", on_click=_update_persona, args=(entry_index, idx, None),
+            help="Nueva persona distinta a las demás; el resto no cambia", disabled=busy,
+        )
+    with col_instruction:
+        instruction = st.text_input(
+            "Ajuste", key=instruction_key, label_visibility="collapsed",
+            placeholder="Ej.: más joven, vive en zona rural, usa TikTok...",
+        )
+    with col_refine:
+        st.button(
+            "✏️ Refinar", key=f"refine_{key}", on_click=_update_persona, args=(entry_index, idx, instruction_key),
+            disabled=busy or not instruction.strip(),
+        )
+
+
+def _update_persona(entry_index: int, idx: int, instruction_key) -> None:
+    """Button callback: the edit runs on the shared job pool and ``_job_progress`` applies it"""
+    entry = st.session_state.bundles[entry_index]
+    instruction = st.session_state.get(instruction_key, "").strip() if instruction_key else ""
+    job = get_job_manager().submit_edit(
+        "refine" if instruction else "regenerate", entry["product"], entry["target"], entry["bundle"].personas,
+        idx - 1, instruction=instruction, user=(st.session_state.user_info or {}).get("email"),
+    )
+    entry.setdefault("pending", {})[job.id] = idx - 1
+    # Not in the URL history: an edit only makes sense for a bundle still in this session
+    st.session_state.jobs.append(job.id)
+    st.session_state.edit_submitted = True
+
+
+def _finish_edit(job) -> bool:
+    """Apply a finished edit job to the bundle it belongs to (False if it is not an edit of this session)"""
+    for entry_index, entry in enumerate(st.session_state.bundles):
+        position = entry.get("pending", {}).pop(job.id, None)
+        if position is None:
+            continue
+        if job.status == "error":
+            st.session_state.setdefault("persona_errors", {})[f"{entry_index}_{position + 1}"] = job.error
+        elif job.bundle is not None and job.bundle.personas:
+            _patch_persona(entry, position, job.bundle.personas[0], job.usage, job.mode)
+        return True
+    return False
+
+
+def _patch_persona(entry: dict, position: int, persona, usage: dict, mode: str) -> None:
+    personas = list(entry["bundle"].personas)
+    personas[position] = persona
+    entry["bundle"] = PersonaBundle(personas=personas)
+    _persona_keys(entry)[position] = persona_key(persona)
+    entry["last_edit"] = {"position": position, "mode": mode, "usage": dict(usage)}
+    library = get_persona_library()
+    if library is not None:
+        user = (st.session_state.user_info or {}).get("email")
+        try:
+            library.record(PersonaBundle(personas=[persona]), entry["product"], entry["target"], user=user, mode=mode)
+        except sqlite3.Error:
+            pass
+
+
+def _persona_keys(entry: dict) -> list:
+    # Entries stored before a hot reload of this script may have no keys yet
+    if "keys" not in entry:
+        entry["keys"] = [persona_key(p) for p in entry["bundle"].personas]
+    return entry["keys"]
+
+
+def _remember_bundle(product: str, target: str, bundle: PersonaBundle, usage: dict) -> None:
+    st.session_state.bundles.append({
+        "product": product,
+        "target": target,
+        "bundle": bundle,
+        "keys": [persona_key(p) for p in bundle.personas],
+        "usage": dict(usage),
+        "created_at": datetime.now().strftime("%H:%M:%S"),
+    })
+    del st.session_state.bundles[:-MAX_SESSION_BUNDLES]
+    st.session_state.selected_bundle = len(st.session_state.bundles) - 1
+
+
+def _show_results() -> None:
+    entries = st.session_state.bundles
+    selected = min(st.session_state.get("selected_bundle", len(entries) - 1), len(entries) - 1)
+    if len(entries) > 1:
+        labels = [f"{e['created_at']} · {e['product'][:60]}" for e in entries]
+        selected = st.selectbox(
+            "Resultados de esta sesión", range(len(entries)), index=selected,
+            format_func=lambda i: labels[i],
+        )
+        st.session_state.selected_bundle = selected
+    bundle: PersonaBundle = entries[selected]["bundle"]
+    usage = entries[selected].get("usage") or {}
+    if usage.get("prompt_tokens_est"):
+        caption = (
+            f"📏 Prompt ≈ {usage['prompt_tokens_est']} tokens "
+            f"({usage.get('static_prefix_tokens_est', 0)} en el prefijo estático cacheable)"
+        )
+        if usage.get("prompt_tokens"):
+            caption += (
+                f" · Proveedor: {usage['prompt_tokens']} de entrada, "
+                f"{usage.get('cached_prompt_tokens', 0)} desde su caché, "
+                f"{usage.get('completion_tokens', 0)} de salida"
+            )
+        st.caption(caption)
+    _show_diversity(bundle)
+    for idx in range(1, len(bundle.personas) + 1):
+        _persona_card(selected, idx, expanded=(idx == 1))
+    st.divider()
+    with st.expander("Ver respuesta JSON (opcional)"):
+        st.code(bundle_json(bundle), language="json")
 
 
 # Run the main app
@@ -1,63 +1,48 @@
-import os
 import streamlit as st
-import pandas as pd
 import bcrypt
-from typing import Optional, Dict, Any
-from datetime import datetime
+from typing import TYPE_CHECKING, Optional, Dict, Any
+
+from user_store import MemoryUserStore, UserStore, get_user_store, write_excel_records
+
+if TYPE_CHECKING:
+    import pandas as pd
 
 
 class ExcelAuth:
     def __init__(self, users_file: str = "users.xlsx"):
         self.users_file = users_file
-        self.users_df = self._load_users()
+        # Users from Streamlit secrets cannot be written back, so that store is read-only
+        self.read_only = False
+        self.store = self._load_store()
     
-    def _load_users(self) -> pd.DataFrame:
-        """Load users from Excel file or Streamlit secrets"""
+    def _load_store(self) -> UserStore:
+        """Get the process-wide user store, importing from Streamlit secrets or the Excel file"""
         # Try to load from Streamlit secrets first (for production)
+        records = None
         try:
             if hasattr(st, 'secrets') and hasattr(st.secrets, 'users_data'):
                 users_data = st.secrets['users_data']
                 if isinstance(users_data, list):
-                    df = pd.DataFrame(users_data)
-                    # Ensure required columns exist
-                    required_cols = ['email', 'password_hash', 'created_at', 'last_login']
-                    for col in required_cols:
-                        if col not in df.columns:
-                            df[col] = None
-                    return df
+                    records = [dict(u) for u in users_data]
+                    self.read_only = True
         except Exception:
             # Silently fall back to local file - no warning needed
             pass
         
-        # Fallback to local Excel file (for development)
-        if os.path.exists(self.users_file):
-            try:
-                df = pd.read_excel(self.users_file)
-                # Ensure required columns exist
-                required_cols = ['email', 'password_hash', 'created_at', 'last_login']
-                for col in required_cols:
-                    if col not in df.columns:
-                        df[col] = None
-                return df
-            except Exception as e:
-                st.error(f"Error loading users file: {e}")
-                return pd.DataFrame(columns=['email', 'password_hash', 'created_at', 'last_login'])
-        else:
-            # Create empty DataFrame with required columns
-            return pd.DataFrame(columns=['email', 'password_hash', 'created_at', 'last_login'])
-    
-    def _save_users(self):
-        """Save users to Excel file (only works in development)"""
-        # Only save to Excel file in development (not in production with secrets)
+        # Fallback to local Excel file (for development); only re-read when it changes
         try:
-            if hasattr(st, 'secrets') and hasattr(st.secrets, 'users_data'):
-                # In production with secrets, don't save
-                pass
-            else:
-                # In development, save to Excel
-                self.users_df.to_excel(self.users_file, index=False)
+            return get_user_store(self.users_file, source_records=records)
         except Exception as e:
-            st.error(f"Error saving users file: {e}")
+            st.error(f"Error loading users file: {e}")
+            return MemoryUserStore()
+    
+    @property
+    def users_df(self) -> "pd.DataFrame":
+        """DataFrame view of the store (admin/reporting only, not used on login)"""
+        # pandas is imported here only, so the login page never pays for it
+        import pandas as pd
+
+        return pd.DataFrame(self.store.all(), columns=['email', 'password_hash', 'created_at', 'last_login'])
     
     def _hash_password(self, password: str) -> str:
         """Hash password using bcrypt"""
@@ -81,40 +66,46 @@ class ExcelAuth:
         """Authenticate user with email and password"""
         email = email.lower().strip()
         
-        # Find user
-        user_row = self.users_df[self.users_df['email'] == email]
-        if user_row.empty:
+        # Find user (indexed lookup)
+        user = self.store.get(email)
+        if user is None:
             return None
         
         # Verify password
-        stored_hash = user_row.iloc[0]['password_hash']
+        stored_hash = user['password_hash'] or ''
         if not self._verify_password(password, stored_hash):
             return None
         
-        # Update last login
-        self.users_df.loc[self.users_df['email'] == email, 'last_login'] = datetime.now().isoformat()
-        self._save_users()
+        # Update last login (queued, flushed in the background)
+        last_login = self.store.record_login(email)
         
         return {
             'email': email,
-            'created_at': user_row.iloc[0]['created_at'],
-            'last_login': datetime.now().isoformat()
+            'created_at': user['created_at'],
+            'last_login': last_login
         }
     
-    def get_all_users(self) -> pd.DataFrame:
+    def get_all_users(self) -> "pd.DataFrame":
         """Get all users (for admin purposes)"""
         return self.users_df.copy()
     
     def delete_user(self, email: str) -> bool:
         """Delete a user"""
-        email = email.lower().strip()
-        if email not in self.users_df['email'].values:
+        if self.read_only:
+            st.error("Los usuarios vienen de los secrets de Streamlit y no se pueden eliminar desde la app")
+            return False
+        if not self.store.delete(email):
             return False
-        
-        self.users_df = self.users_df[self.users_df['email'] != email]
         self._save_users()
         return True
 
+    def _save_users(self):
+        """Write the store back to the Excel file (development only, never with secrets)"""
+        try:
+            write_excel_records(self.users_file, self.store.all())
+        except Exception as e:
+            st.error(f"Error saving users file: {e}")
+
 
 def init_auth_session():
     """Initialize authentication session state"""
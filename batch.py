@@ -0,0 +1,173 @@
+from __future__ import annotations
+import argparse
+import hashlib
+import json
+import os
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Any, Dict, Iterator, List, Optional, Set
+
+import metrics
+from llm_client import LLMClient
+from ratelimit import TokenBucket
+from utils import env_flag, load_env
+
+
+def read_requests(path: str) -> Iterator[Dict[str, Any]]:
+    seen: Dict[str, int] = {}
+    with open(path, encoding="utf-8") as fh:
+        for line in fh:
+            line = line.strip()
+            if not line:
+                continue
+            item = json.loads(line)
+            request = {
+                "product_description": item.get("product_description", item.get("product", "")),
+                "target_market": item.get("target_market", item.get("target", "")),
+                "num_personas": int(item.get("num_personas", 4)),
+            }
+            if "id" in item:
+                request["id"] = str(item["id"])
+            else:
+                # Id from the content alone, so resumes match even if lines are reordered or inserted;
+                # repeated briefs are told apart by their occurrence number
+                digest = hashlib.sha256(json.dumps(request, sort_keys=True).encode("utf-8")).hexdigest()[:12]
+                seen[digest] = seen.get(digest, 0) + 1
+                request["id"] = digest if seen[digest] == 1 else f"{digest}-{seen[digest]}"
+            yield request
+
+
+def read_checkpoint(path: str) -> Set[str]:
+    if not os.path.exists(path):
+        return set()
+    with open(path, encoding="utf-8") as fh:
+        return {line.strip() for line in fh if line.strip()}
+
+
+class BatchRunner:
+    def __init__(self, concurrency: int = 4, rpm: float = 60, mode: str = "full", fresh: bool = False,
+                 diversify: bool = True):
+        self.concurrency = concurrency
+        self.bucket = TokenBucket.per_minute(rpm, burst=concurrency)
+        self.mode = mode
+        self.fresh = fresh
+        self.diversify = diversify
+        self._local = threading.local()
+
+    def _client(self) -> LLMClient:
+        # One client per worker thread: last_usage is per instance, the HTTP pool is shared
+        if not hasattr(self._local, "client"):
+            self._local.client = LLMClient()
+            # --rpm limits provider calls: seeds, top-ups, diversity regenerations and retries each take a token
+            self._local.client.call_limiter = self.bucket
+        return self._local.client
+
+    def run_one(self, request: Dict[str, Any]) -> Dict[str, Any]:
+        # Transient errors are retried (and failed over) by the client's router, not here
+        client = self._client()
+        started = time.perf_counter()
+        if self.mode == "fanout":
+            bundle = client.generate_personas_fanout(
+                request["product_description"], request["target_market"], request["num_personas"],
+                fresh=self.fresh,
+            )
+        else:
+            bundle = client.generate_personas(
+                request["product_description"], request["target_market"], request["num_personas"],
+                fresh=self.fresh,
+            )
+        diversity = None
+        if self.diversify and len(bundle.personas) > 1:
+            bundle, report = client.diversify(request["product_description"], request["target_market"], bundle)
+            diversity = {
+                "score": round(report.score, 4),
+                "similar_pairs": [[i, j, round(s, 4)] for i, j, s in report.pairs],
+            }
+        return {
+            "id": request["id"],
+            "request": {k: v for k, v in request.items() if k != "id"},
+            "bundle": bundle.model_dump(),
+            "diversity": diversity,
+            "usage": dict(client.last_usage),
+            "latency": round(time.perf_counter() - started, 3),
+        }
+
+    def run(self, input_path: str, output_path: str, checkpoint_path: str,
+            errors_path: Optional[str] = None) -> Dict[str, Any]:
+        done = read_checkpoint(checkpoint_path)
+        pending = [r for r in read_requests(input_path) if r["id"] not in done]
+        stats = {"skipped": len(done), "completed": 0, "failed": 0, "tokens": 0}
+        started = time.perf_counter()
+
+        # Results are written from this thread only; a line is checkpointed after its output is flushed
+        with open(output_path, "a", encoding="utf-8") as out, \
+                open(checkpoint_path, "a", encoding="utf-8") as ckpt, \
+                ThreadPoolExecutor(max_workers=self.concurrency) as pool:
+            futures = {pool.submit(self.run_one, r): r for r in pending}
+            for future in as_completed(futures):
+                request = futures[future]
+                try:
+                    result = future.result()
+                except Exception as exc:
+                    stats["failed"] += 1
+                    if errors_path:
+                        with open(errors_path, "a", encoding="utf-8") as err:
+                            err.write(json.dumps({"id": request["id"], "error": repr(exc)}, ensure_ascii=False) + "\n")
+                    print(f"[error] {request['id']}: {exc}", file=sys.stderr)
+                    continue
+                out.write(json.dumps(result, ensure_ascii=False) + "\n")
+                out.flush()
+                ckpt.write(request["id"] + "\n")
+                ckpt.flush()
+                stats["completed"] += 1
+                stats["tokens"] += result["usage"].get("total_tokens", 0)
+
+        elapsed = time.perf_counter() - started
+        minutes = elapsed / 60 if elapsed > 0 else 0
+        stats["elapsed_seconds"] = round(elapsed, 2)
+        stats["requests_per_min"] = round(stats["completed"] / minutes, 2) if minutes else 0.0
+        stats["tokens_per_min"] = round(stats["tokens"] / minutes, 1) if minutes else 0.0
+        return stats
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="Generación de personas por lotes (JSONL)")
+    parser.add_argument("input", help="JSONL con product_description, target_market, num_personas")
+    parser.add_argument("output", help="JSONL de salida (se anexa)")
+    parser.add_argument("--checkpoint", help="Archivo de ids completados (por defecto <output>.checkpoint)")
+    parser.add_argument("--errors", help="JSONL donde registrar las solicitudes fallidas")
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument("--rpm", type=float, default=60, help="Llamadas al proveedor por minuto (token bucket; incluye reintentos)")
+    parser.add_argument("--max-retries", type=int, help="Reintentos por proveedor ante errores transitorios (LLM_MAX_RETRIES)")
+    parser.add_argument("--mode", choices=["full", "fanout"], default="full")
+    parser.add_argument("--fresh", action="store_true", help="Ignorar la caché de respuestas")
+    parser.add_argument("--no-diversify", action="store_true",
+                        help="No puntuar la diversidad ni regenerar las personas redundantes")
+    args = parser.parse_args(argv)
+
+    load_env()
+    if args.max_retries is not None:
+        # Read by the router when the first client is built
+        os.environ["LLM_MAX_RETRIES"] = str(args.max_retries)
+    metrics.configure()
+    runner = BatchRunner(
+        concurrency=args.concurrency,
+        rpm=args.rpm,
+        mode=args.mode,
+        fresh=args.fresh,
+        diversify=not args.no_diversify and env_flag("DIVERSITY_ENABLED", True),
+    )
+    stats = runner.run(args.input, args.output, args.checkpoint or f"{args.output}.checkpoint", args.errors)
+    print(
+        f"Completadas: {stats['completed']} · Fallidas: {stats['failed']} · Omitidas: {stats['skipped']} · "
+        f"{stats['requests_per_min']} solicitudes/min · {stats['tokens_per_min']} tokens/min",
+        file=sys.stderr,
+    )
+    print(json.dumps(stats))
+    return 1 if stats["failed"] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,107 @@
+from __future__ import annotations
+import argparse
+import json
+import os
+import sys
+import time
+import tracemalloc
+from typing import Callable, Dict, List, Optional
+
+from pydantic import BaseModel, Field
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from extraction import personas_from_text  # noqa: E402
+from persona_schema import Psychographics, PersonaBundle  # noqa: E402
+
+
+class LegacyPersona(BaseModel):
+    """Schema before typed sub-models (dict fields), kept here only as the baseline"""
+    name: str
+    age_range: str
+    gender: Optional[str] = None
+    location: Optional[str] = None
+    occupation: Optional[str] = None
+    income_range: Optional[str] = None
+    education: Optional[str] = None
+    motivations: List[str] = Field(default_factory=list)
+    frustrations: List[str] = Field(default_factory=list)
+    preferred_channels: List[str] = Field(default_factory=list)
+    messaging_tone: Optional[str] = None
+    psychographics: Psychographics = Field(default_factory=Psychographics)
+    summary: Optional[str] = None
+    behavioral_signals: List[str] = Field(default_factory=list)
+    segmentation_levels: List[dict] = Field(default_factory=list)
+    creative_brief: Optional[str] = None
+    value_canvas: Optional[dict] = None
+    empathy_map: Optional[dict] = None
+
+
+class LegacyBundle(BaseModel):
+    personas: List[LegacyPersona] = Field(default_factory=list)
+
+
+def sample_bundle(num_personas: int) -> bytes:
+    items = [f"elemento de ejemplo número {i} con algo de texto" for i in range(4)]
+    persona = {
+        "name": "Laura Gómez", "age_range": "28-35", "gender": "Femenino", "location": "Bogotá",
+        "occupation": "Gerente de producto", "income_range": "Medio-alto", "education": "Maestría",
+        "motivations": items, "frustrations": items, "preferred_channels": items,
+        "messaging_tone": "Cercano y directo",
+        "psychographics": {"values": items, "interests": items, "lifestyle": items},
+        "behavioral_signals": items,
+        "segmentation_levels": [
+            {"level": level, "label": "Etiqueta", "criteria": items}
+            for level in ("Geográfica", "Demográfica", "Conductual")
+        ],
+        "creative_brief": "Mensaje clave, propuesta de valor, prueba social y CTA. " * 4,
+        "value_canvas": {k: items for k in ("customer_jobs", "pains", "gains", "value_props", "pain_relievers", "gain_creators")},
+        "empathy_map": {k: items for k in ("think", "feel", "see", "say_do", "pains", "gains")},
+        "summary": "Resumen ampliado de la persona. " * 6,
+    }
+    return json.dumps({"personas": [persona] * num_personas}, ensure_ascii=False).encode("utf-8")
+
+
+def measure(fn: Callable[[], object], iterations: int) -> Dict[str, float]:
+    fn()  # warm-up (schema build, caches)
+    started = time.perf_counter()
+    for _ in range(iterations):
+        fn()
+    elapsed = time.perf_counter() - started
+    tracemalloc.start()
+    fn()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {"us_per_bundle": elapsed / iterations * 1e6, "peak_kib_per_bundle": peak / 1024}
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="Tiempo y memoria de parseo + validación por PersonaBundle")
+    parser.add_argument("--personas", type=int, default=5)
+    parser.add_argument("--iterations", type=int, default=2000)
+    parser.add_argument("--json", help="Write results to this JSON file")
+    args = parser.parse_args(argv)
+
+    payload = sample_bundle(args.personas)
+    quirky = payload.replace(b'"age_range": "28-35"', b'"age_range": 30')
+    results = {
+        "before: json.loads + model_validate (dict fields)": measure(
+            lambda: LegacyBundle.model_validate(json.loads(payload)), args.iterations),
+        "typed: json.loads + model_validate": measure(
+            lambda: PersonaBundle.model_validate(json.loads(payload)), args.iterations),
+        "typed: model_validate_json (bytes)": measure(
+            lambda: PersonaBundle.model_validate_json(payload), args.iterations),
+        "typed: quirky output via lenient fallback": measure(
+            lambda: personas_from_text(quirky), args.iterations),
+    }
+    print(f"{args.personas} personas, {len(payload)} bytes, {args.iterations} iteraciones")
+    for name, row in results.items():
+        print(f"{name:<52} {row['us_per_bundle']:>9.1f} µs   {row['peak_kib_per_bundle']:>8.1f} KiB")
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as fh:
+            json.dump({"personas": args.personas, "bytes": len(payload), "results": results}, fh, indent=2)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
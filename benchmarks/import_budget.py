@@ -0,0 +1,107 @@
+from __future__ import annotations
+import argparse
+import json
+import os
+import re
+import subprocess
+import sys
+import tempfile
+from typing import Any, Dict, List, Optional
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+DEFAULT_FORBIDDEN = "pandas,openpyxl,openai,httpx,numpy"
+# "import time: <self us> | <cumulative us> | <two spaces per nesting level><module>"
+_LINE_RE = re.compile(r"^import time:\s+(\d+)\s+\|\s+(\d+)\s+\|( *)(\S+)$")
+
+
+def measure(module: str) -> List[Dict[str, Any]]:
+    """One cold import of ``module``: every imported module with self/cumulative microseconds"""
+    with tempfile.TemporaryDirectory() as tmp:
+        env = dict(os.environ)
+        # Throwaway stores, so the run neither reads nor writes the real ones
+        env.update({
+            "USER_STORE_PATH": os.path.join(tmp, "users.sqlite3"),
+            "LIBRARY_PATH": os.path.join(tmp, "persona_library.sqlite3"),
+            "METRICS_PORT": "",
+            "PYTHONDONTWRITEBYTECODE": "1",
+        })
+        proc = subprocess.run(
+            [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+            cwd=ROOT, env=env, capture_output=True, text=True,
+        )
+    if proc.returncode != 0:
+        raise RuntimeError(f"import {module} falló:\n{proc.stderr[-2000:]}")
+    entries = []
+    for line in proc.stderr.splitlines():
+        match = _LINE_RE.match(line)
+        if match:
+            self_us, cumulative_us, indent, name = match.groups()
+            entries.append({
+                "module": name,
+                "self_ms": int(self_us) / 1000,
+                "cumulative_ms": int(cumulative_us) / 1000,
+                "depth": (len(indent) - 1) // 2,
+            })
+    return entries
+
+
+def summarize(entries: List[Dict[str, Any]], module: str, forbidden: List[str], top: int) -> Dict[str, Any]:
+    imported = {e["module"] for e in entries}
+    # Interpreter start-up (site, encodings) is the same for every app; count only ``module``.
+    # importtime prints children before their parent, so its direct imports precede it.
+    target = None
+    children: List[Dict[str, Any]] = []
+    for entry in entries:
+        if entry["depth"] == 0:
+            if entry["module"] == module:
+                target = entry
+                break
+            children = []
+        elif entry["depth"] == 1:
+            children.append(entry)
+    return {
+        "module": module,
+        "total_ms": round(target["cumulative_ms"], 1) if target else None,
+        "modules": len(entries),
+        "forbidden_imported": [m for m in forbidden if m in imported],
+        "top": [
+            {"module": e["module"], "cumulative_ms": round(e["cumulative_ms"], 1), "self_ms": round(e["self_ms"], 1)}
+            for e in sorted(children, key=lambda e: -e["cumulative_ms"])[:top]
+        ],
+    }
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="Presupuesto de importación de la página de login (python -X importtime)")
+    parser.add_argument("--module", default="app", help="Módulo a importar (por defecto la app sin sesión)")
+    parser.add_argument("--budget-ms", type=float, default=900.0, help="Tiempo máximo de importación en ms")
+    parser.add_argument("--forbid", default=DEFAULT_FORBIDDEN,
+                        help="Módulos que no deben importarse, separados por comas")
+    parser.add_argument("--runs", type=int, default=3, help="Importaciones en frío; se reporta la más rápida")
+    parser.add_argument("--top", type=int, default=10, help="Importaciones directas más costosas a mostrar")
+    parser.add_argument("--json", help="Escribir el resultado en este archivo JSON")
+    args = parser.parse_args(argv)
+    forbidden = [m.strip() for m in args.forbid.split(",") if m.strip()]
+
+    # Import time is noisy (disk cache, CPU frequency); the fastest run is the stable figure
+    runs = [summarize(measure(args.module), args.module, forbidden, args.top) for _ in range(max(1, args.runs))]
+    result = min(runs, key=lambda r: r["total_ms"] or 0.0)
+    result["budget_ms"] = args.budget_ms
+    result["runs_ms"] = [r["total_ms"] for r in runs]
+    result["ok"] = not result["forbidden_imported"] and (result["total_ms"] or 0.0) <= args.budget_ms
+
+    print(f"import {args.module}: {result['total_ms']:.0f} ms (presupuesto {args.budget_ms:.0f} ms) · "
+          f"{result['modules']} módulos")
+    for entry in result["top"]:
+        print(f"  {entry['cumulative_ms']:>8.1f} ms  {entry['module']}")
+    if result["forbidden_imported"]:
+        print(f"Importados sin necesidad: {', '.join(result['forbidden_imported'])}")
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as fh:
+            json.dump(result, fh, indent=2)
+    return 0 if result["ok"] else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,191 @@
+from __future__ import annotations
+import argparse
+import json
+import os
+import resource
+import subprocess
+import sys
+import threading
+import time
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import asdict
+from typing import Any, Dict, List, Optional
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from mock_server import add_config_arguments, config_from_args, start_mock_server  # noqa: E402
+
+
+def percentile(values: List[float], pct: float) -> Optional[float]:
+    if not values:
+        return None
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, int(round(pct / 100 * len(ordered) + 0.5)) - 1))
+    return ordered[index]
+
+
+def _git_commit() -> Optional[str]:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True,
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def _peak_rss_mib() -> float:
+    # ru_maxrss is KiB on Linux, bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+
+def run_level(concurrency: int, requests: int, num_personas: int, mode: str) -> Dict[str, Any]:
+    from llm_client import LLMClient
+    from persona_schema import PersonaBundle
+
+    local = threading.local()
+    latencies: List[float] = []
+    outcomes = {"ok": 0, "incomplete": 0, "parse_failures": 0, "errors": 0}
+    tokens = {"prompt_tokens": 0, "completion_tokens": 0}
+    lock = threading.Lock()
+
+    def one(i: int) -> None:
+        if not hasattr(local, "client"):
+            local.client = LLMClient()
+        client = local.client
+        started = time.perf_counter()
+        outcome = "ok"
+        try:
+            if mode == "stream":
+                bundle = PersonaBundle(personas=list(client.stream_personas(f"Producto {i}", "Mercado", num_personas, fresh=True)))
+            elif mode == "fanout":
+                bundle = client.generate_personas_fanout(f"Producto {i}", "Mercado", num_personas, fresh=True)
+            else:
+                bundle = client.generate_personas(f"Producto {i}", "Mercado", num_personas, fresh=True)
+            if len(bundle.personas) < num_personas:
+                outcome = "incomplete"
+        except ValueError:
+            # Nothing salvageable (fan-out raises ValueError when every slot failed)
+            outcome = "parse_failures"
+        except Exception:
+            outcome = "errors"
+        elapsed = time.perf_counter() - started
+        with lock:
+            outcomes[outcome] += 1
+            if outcome != "errors":
+                latencies.append(elapsed)
+            for field in tokens:
+                tokens[field] += client.last_usage.get(field, 0)
+
+    tracemalloc.start()
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        list(pool.map(one, range(requests)))
+    wall = time.perf_counter() - started
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return {
+        "concurrency": concurrency,
+        "requests": requests,
+        "wall_seconds": round(wall, 3),
+        "throughput_rps": round(requests / wall, 3) if wall else 0.0,
+        "personas_per_sec": round((outcomes["ok"] + outcomes["incomplete"]) * num_personas / wall, 3) if wall else 0.0,
+        "p50": percentile(latencies, 50),
+        "p95": percentile(latencies, 95),
+        "p99": percentile(latencies, 99),
+        **outcomes,
+        "error_rate": round(outcomes["errors"] / requests, 4),
+        "parse_failure_rate": round((outcomes["parse_failures"] + outcomes["incomplete"]) / requests, 4),
+        "python_peak_mib": round(peak / (1024 * 1024), 2),
+        "rss_peak_mib": round(_peak_rss_mib(), 1),
+        **tokens,
+    }
+
+
+def compare(before_path: str, after_path: str) -> int:
+    with open(before_path, encoding="utf-8") as fh:
+        before = {row["concurrency"]: row for row in json.load(fh)["levels"]}
+    with open(after_path, encoding="utf-8") as fh:
+        after = {row["concurrency"]: row for row in json.load(fh)["levels"]}
+    print(f"{'conc':>5} {'rps antes':>10} {'rps después':>12} {'p95 antes':>10} {'p95 después':>12} {'Δp95':>8}")
+    for conc in sorted(set(before) & set(after)):
+        b, a = before[conc], after[conc]
+        delta = (a["p95"] / b["p95"] - 1) if a.get("p95") and b.get("p95") else 0.0
+        print(f"{conc:>5} {b['throughput_rps']:>10.2f} {a['throughput_rps']:>12.2f} "
+              f"{b['p95'] or 0:>10.3f} {a['p95'] or 0:>12.3f} {delta:>+8.1%}")
+    return 0
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="Prueba de carga de LLMClient contra el servidor simulado")
+    parser.add_argument("--levels", default="1,2,4,8,16", help="Niveles de concurrencia separados por comas")
+    parser.add_argument("--requests", type=int, default=32, help="Solicitudes por nivel")
+    parser.add_argument("--personas", type=int, default=4)
+    parser.add_argument("--mode", choices=["full", "stream", "fanout"], default="full")
+    parser.add_argument("--provider", choices=["openai", "huggingface", "local"], default="openai",
+                        help="'local' usa el modelo GGUF de LOCAL_MODEL_PATH en vez del servidor")
+    parser.add_argument("--url", help="Servidor ya en marcha (por defecto se inicia el mock en proceso)")
+    parser.add_argument("--json", help="Escribir los resultados en este archivo JSON")
+    parser.add_argument("--compare", nargs=2, metavar=("ANTES", "DESPUES"), help="Comparar dos resultados JSON")
+    add_config_arguments(parser)
+    args = parser.parse_args(argv)
+    if args.compare:
+        return compare(*args.compare)
+
+    config = config_from_args(args)
+    server = None
+    url = args.url
+    if url is None and args.provider != "local":
+        server, url = start_mock_server(config)
+    # Mock credentials, no response cache, failover, rate governor or diversity rewrites, so every
+    # request reaches the server exactly once
+    os.environ.update({
+        "LLM_PROVIDER": args.provider,
+        "PERSONA_CACHE_ENABLED": "0",
+        "LLM_FAILOVER": "0",
+        "GOVERNOR_ENABLED": "0",
+        "DIVERSITY_ENABLED": "0",
+    })
+    if url is not None:
+        os.environ.update({
+            "OPENAI_BASE_URL": url,
+            "HF_API_URL": f"{url}/models",
+            "OPENAI_API_KEY": os.environ.get("OPENAI_API_KEY", "mock"),
+            "HF_API_TOKEN": os.environ.get("HF_API_TOKEN", "mock"),
+        })
+
+    levels = []
+    for concurrency in (int(c) for c in args.levels.split(",") if c.strip()):
+        row = run_level(concurrency, args.requests, args.personas, args.mode)
+        levels.append(row)
+        print(
+            f"conc {row['concurrency']:>3} · {row['throughput_rps']:>7.2f} req/s · "
+            f"p50 {row['p50'] or 0:.3f}s p95 {row['p95'] or 0:.3f}s p99 {row['p99'] or 0:.3f}s · "
+            f"errores {row['error_rate']:.1%} · parseo fallido {row['parse_failure_rate']:.1%} · "
+            f"pico {row['python_peak_mib']:.1f} MiB"
+        )
+    if server is not None:
+        server.shutdown()
+
+    if args.json:
+        result = {
+            "commit": _git_commit(),
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "mode": args.mode,
+            "provider": args.provider,
+            "personas": args.personas,
+            "mock": None if args.url or server is None else asdict(config),
+            # Injected faults, to read parse_failure_rate against what the server actually broke
+            "server_counts": None if server is None else dict(server.RequestHandlerClass.state.counts),
+            "levels": levels,
+        }
+        with open(args.json, "w", encoding="utf-8") as fh:
+            json.dump(result, fh, indent=2)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,258 @@
+from __future__ import annotations
+import argparse
+import json
+import random
+import re
+import sys
+import threading
+import time
+from dataclasses import asdict, dataclass
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+
+_COUNT_RE = re.compile(r"Cantidad de personas: (\d+)")
+_SEEDS_RE = re.compile(r"Propón (\d+) segmentos")
+MALFORMED_KINDS = ("fence", "truncate", "single_quotes", "trailing_comma", "garbage")
+
+
+@dataclass
+class MockConfig:
+    # Time to first byte: log-normal around the median, like real provider queues
+    latency_ms: float = 300.0
+    latency_sigma: float = 0.35
+    # Generation speed after the first byte; 0 disables pacing
+    tokens_per_sec: float = 0.0
+    # Fraction of requests answered with 429/503 (with Retry-After)
+    error_rate: float = 0.0
+    retry_after: float = 0.5
+    # Fraction of 200 responses whose JSON is malformed (see MALFORMED_KINDS)
+    malformed_rate: float = 0.0
+    seed: Optional[int] = None
+
+
+class MockState:
+    def __init__(self, config: MockConfig):
+        self.config = config
+        self._rng = random.Random(config.seed)
+        self._lock = threading.Lock()
+        self.counts: Dict[str, int] = {"requests": 0, "errors": 0, "malformed": 0, "streams": 0}
+
+    def roll(self) -> Tuple[float, float, float]:
+        with self._lock:
+            return self._rng.random(), self._rng.random(), self._rng.lognormvariate(0.0, self.config.latency_sigma)
+
+    def choice(self, options: Tuple[str, ...]) -> str:
+        with self._lock:
+            return self._rng.choice(options)
+
+    def count(self, key: str) -> None:
+        with self._lock:
+            self.counts[key] += 1
+
+
+def _persona(index: int) -> Dict[str, Any]:
+    items = [f"elemento {i} de la persona {index} con algo de texto descriptivo" for i in range(4)]
+    return {
+        "name": f"Persona {index}", "age_range": f"{20 + index * 5}-{26 + index * 5}", "gender": "Femenino",
+        "location": "Bogotá", "occupation": "Gerente de producto", "income_range": "Medio-alto",
+        "education": "Maestría", "motivations": items, "frustrations": items, "preferred_channels": items,
+        "messaging_tone": "Cercano y directo",
+        "psychographics": {"values": items, "interests": items, "lifestyle": items},
+        "summary": "Resumen ampliado de la persona. " * 4,
+        "behavioral_signals": items,
+        "segmentation_levels": [
+            {"level": level, "label": "Etiqueta", "criteria": items[:2]}
+            for level in ("Geográfica", "Demográfica", "Conductual")
+        ],
+        "creative_brief": "Mensaje clave, propuesta de valor, prueba social y CTA. " * 3,
+        "value_canvas": {k: items[:2] for k in ("customer_jobs", "pains", "gains", "value_props", "pain_relievers", "gain_creators")},
+        "empathy_map": {k: items[:2] for k in ("think", "feel", "see", "say_do", "pains", "gains")},
+    }
+
+
+def synthetic_answer(prompt: str) -> str:
+    """Persona bundle (or segment seeds) sized from the prompt's requested count"""
+    seeds = _SEEDS_RE.search(prompt)
+    if seeds:
+        n = int(seeds.group(1))
+        return json.dumps({"seeds": [{"label": f"Segmento {i}", "description": "Descripción breve."} for i in range(1, n + 1)]})
+    match = _COUNT_RE.search(prompt)
+    n = int(match.group(1)) if match else 4
+    return json.dumps({"personas": [_persona(i) for i in range(1, n + 1)]}, ensure_ascii=False)
+
+
+def malform(text: str, kind: str) -> str:
+    if kind == "fence":
+        return f"Claro, aquí tienes:\n```json\n{text}\n```\nEspero que sirva."
+    if kind == "truncate":
+        return text[: int(len(text) * 0.7)]
+    if kind == "single_quotes":
+        return text.replace('"', "'")
+    if kind == "trailing_comma":
+        return text.replace("]", ",]")
+    return "Lo siento, no puedo generar personas ahora mismo."
+
+
+def _chunks(text: str, size: int = 16) -> Iterator[str]:
+    # ~4 chars per token, so a 16-char chunk is about 4 tokens
+    for i in range(0, len(text), size):
+        yield text[i:i + size]
+
+
+class MockHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    state: MockState
+
+    def log_message(self, format: str, *args: object) -> None:
+        return None
+
+    def do_GET(self) -> None:  # noqa: N802 (http.server API)
+        if self.path == "/stats":
+            self._send_json(200, {"config": asdict(self.state.config), **self.state.counts})
+        else:
+            self._send_json(404, {"error": "not found"})
+
+    def do_POST(self) -> None:  # noqa: N802 (http.server API)
+        length = int(self.headers.get("Content-Length", 0))
+        body = json.loads(self.rfile.read(length) or b"{}")
+        path = self.path.split("?")[0]
+        if path.endswith("/chat/completions"):
+            prompt = "\n".join(m.get("content", "") for m in body.get("messages", []) if m.get("role") == "user")
+            handler = self._openai
+        elif path.startswith("/models/"):
+            prompt = body.get("inputs", "")
+            handler = self._hf
+        else:
+            self._send_json(404, {"error": "not found"})
+            return
+
+        config = self.state.config
+        self.state.count("requests")
+        error_roll, malformed_roll, latency_factor = self.state.roll()
+        time.sleep(config.latency_ms * latency_factor / 1000)
+        if error_roll < config.error_rate:
+            self.state.count("errors")
+            status = 429 if error_roll < config.error_rate / 2 else 503
+            self._send_json(status, {"error": {"message": "mock overload"}}, {"Retry-After": f"{config.retry_after:g}"})
+            return
+        text = synthetic_answer(prompt)
+        if malformed_roll < config.malformed_rate:
+            self.state.count("malformed")
+            text = malform(text, self.state.choice(MALFORMED_KINDS))
+        handler(body, prompt, text)
+
+    def _openai(self, body: Dict[str, Any], prompt: str, text: str) -> None:
+        model = body.get("model", "mock")
+        usage = {
+            "prompt_tokens": len(prompt) // 4,
+            "completion_tokens": len(text) // 4,
+            "total_tokens": (len(prompt) + len(text)) // 4,
+            "prompt_cache_hit_tokens": 0,
+        }
+        if not body.get("stream"):
+            self._pace(len(text))
+            self._send_json(200, {
+                "id": "mock", "object": "chat.completion", "created": int(time.time()), "model": model,
+                "choices": [{"index": 0, "finish_reason": "stop", "message": {"role": "assistant", "content": text}}],
+                "usage": usage,
+            })
+            return
+        self.state.count("streams")
+        events = [
+            {"id": "mock", "object": "chat.completion.chunk", "created": 0, "model": model,
+             "choices": [{"index": 0, "delta": {"content": piece}, "finish_reason": None}]}
+            for piece in _chunks(text)
+        ]
+        events.append({"id": "mock", "object": "chat.completion.chunk", "created": 0, "model": model,
+                       "choices": [], "usage": usage})
+        self._send_sse(events, done=True)
+
+    def _hf(self, body: Dict[str, Any], prompt: str, text: str) -> None:
+        if not body.get("stream"):
+            self._pace(len(text))
+            self._send_json(200, [{"generated_text": text}])
+            return
+        self.state.count("streams")
+        self._send_sse([{"token": {"text": piece, "special": False}} for piece in _chunks(text)], done=False)
+
+    def _pace(self, chars: int) -> None:
+        rate = self.state.config.tokens_per_sec
+        if rate > 0:
+            time.sleep(chars / 4 / rate)
+
+    def _send_json(self, status: int, payload: Any, headers: Optional[Dict[str, str]] = None) -> None:
+        data = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _send_sse(self, events: List[Dict[str, Any]], done: bool) -> None:
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        rate = self.state.config.tokens_per_sec
+        for event in events:
+            if rate > 0:
+                time.sleep(4 / rate)
+            self._write_chunk(f"data: {json.dumps(event, ensure_ascii=False)}\n\n".encode("utf-8"))
+        if done:
+            self._write_chunk(b"data: [DONE]\n\n")
+        self._write_chunk(b"")
+
+    def _write_chunk(self, data: bytes) -> None:
+        self.wfile.write(f"{len(data):x}\r\n".encode("ascii") + data + b"\r\n")
+        self.wfile.flush()
+
+
+def start_mock_server(config: MockConfig, host: str = "127.0.0.1", port: int = 0) -> Tuple[ThreadingHTTPServer, str]:
+    """Start the server on a daemon thread; returns (server, base url)"""
+    handler = type("BoundMockHandler", (MockHandler,), {"state": MockState(config)})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="mock-llm", daemon=True).start()
+    return server, f"http://{host}:{server.server_address[1]}"
+
+
+def add_config_arguments(parser: argparse.ArgumentParser) -> None:
+    parser.add_argument("--latency-ms", type=float, default=300.0, help="Mediana del tiempo hasta el primer byte")
+    parser.add_argument("--latency-sigma", type=float, default=0.35, help="Dispersión log-normal de la latencia")
+    parser.add_argument("--tokens-per-sec", type=float, default=0.0, help="Velocidad de generación (0 = sin pausa)")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Fracción de respuestas 429/503")
+    parser.add_argument("--malformed-rate", type=float, default=0.0, help="Fracción de respuestas con JSON defectuoso")
+    parser.add_argument("--seed", type=int, default=None)
+
+
+def config_from_args(args: argparse.Namespace) -> MockConfig:
+    return MockConfig(
+        latency_ms=args.latency_ms,
+        latency_sigma=args.latency_sigma,
+        tokens_per_sec=args.tokens_per_sec,
+        error_rate=args.error_rate,
+        malformed_rate=args.malformed_rate,
+        seed=args.seed,
+    )
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="Servidor simulado compatible con OpenAI y Hugging Face")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8089)
+    add_config_arguments(parser)
+    args = parser.parse_args(argv)
+    server, url = start_mock_server(config_from_args(args), args.host, args.port)
+    print(f"Mock LLM en {url} (OPENAI_BASE_URL={url}, HF_API_URL={url}/models)", file=sys.stderr)
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,178 @@
+from __future__ import annotations
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, Optional, Tuple
+
+from utils import env_flag
+
+
+def make_cache_key(provider: str, model: str, temperature: float, num_personas: int, prompt: str) -> str:
+    """Build a stable key from the generation parameters and a hash of the prompt"""
+    prompt_hash = hashlib.sha256(prompt.encode("utf-8")).hexdigest()
+    raw = json.dumps([provider, model, round(float(temperature), 3), int(num_personas), prompt_hash])
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+class ResponseCache:
+    """Two-tier cache for validated PersonaBundle JSON: in-process LRU + SQLite on disk"""
+
+    def __init__(self, db_path: str, ttl_seconds: float = 7 * 24 * 3600,
+                 max_entries: int = 5000, memory_entries: int = 256):
+        self.db_path = db_path
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self.memory_entries = memory_entries
+        self._lock = threading.Lock()
+        # key -> (payload, expires_at, latency, tokens)
+        self._memory: "OrderedDict[str, Tuple[str, float, float, int]]" = OrderedDict()
+        self._stats: Dict[str, float] = {
+            "memory_hits": 0,
+            "disk_hits": 0,
+            "misses": 0,
+            "stores": 0,
+            "evictions": 0,
+            "saved_seconds": 0.0,
+            "saved_tokens": 0,
+        }
+        self._conn = self._connect()
+
+    def _connect(self) -> Optional[sqlite3.Connection]:
+        try:
+            directory = os.path.dirname(self.db_path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            conn = sqlite3.connect(self.db_path, check_same_thread=False, timeout=5)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS responses ("
+                " key TEXT PRIMARY KEY, payload TEXT NOT NULL, created_at REAL NOT NULL,"
+                " last_access REAL NOT NULL, latency REAL NOT NULL DEFAULT 0,"
+                " tokens INTEGER NOT NULL DEFAULT 0)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_responses_access ON responses(last_access)")
+            conn.commit()
+            return conn
+        except sqlite3.Error:
+            # Disk tier is best-effort; keep serving from memory
+            return None
+
+    def get(self, key: str) -> Optional[str]:
+        now = time.time()
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None:
+                payload, expires_at, latency, tokens = entry
+                if expires_at > now:
+                    self._memory.move_to_end(key)
+                    self._record_hit("memory_hits", latency, tokens)
+                    return payload
+                del self._memory[key]
+
+            if self._conn is not None:
+                try:
+                    row = self._conn.execute(
+                        "SELECT payload, created_at, latency, tokens FROM responses WHERE key = ?", (key,)
+                    ).fetchone()
+                    if row is not None:
+                        payload, created_at, latency, tokens = row
+                        if created_at + self.ttl_seconds > now:
+                            self._conn.execute("UPDATE responses SET last_access = ? WHERE key = ?", (now, key))
+                            self._conn.commit()
+                            self._remember(key, payload, created_at + self.ttl_seconds, latency, tokens)
+                            self._record_hit("disk_hits", latency, tokens)
+                            return payload
+                        self._conn.execute("DELETE FROM responses WHERE key = ?", (key,))
+                        self._conn.commit()
+                except sqlite3.Error:
+                    pass
+
+            self._stats["misses"] += 1
+            return None
+
+    def set(self, key: str, payload: str, latency: float = 0.0, tokens: int = 0) -> None:
+        now = time.time()
+        with self._lock:
+            self._remember(key, payload, now + self.ttl_seconds, latency, tokens)
+            self._stats["stores"] += 1
+            if self._conn is None:
+                return
+            try:
+                self._conn.execute(
+                    "INSERT OR REPLACE INTO responses (key, payload, created_at, last_access, latency, tokens)"
+                    " VALUES (?, ?, ?, ?, ?, ?)",
+                    (key, payload, now, now, latency, tokens),
+                )
+                self._evict_disk(now)
+                self._conn.commit()
+            except sqlite3.Error:
+                pass
+
+    def clear(self) -> None:
+        with self._lock:
+            self._memory.clear()
+            if self._conn is not None:
+                try:
+                    self._conn.execute("DELETE FROM responses")
+                    self._conn.commit()
+                except sqlite3.Error:
+                    pass
+
+    def stats(self) -> Dict[str, float]:
+        with self._lock:
+            stats = dict(self._stats)
+            stats["memory_entries"] = len(self._memory)
+        hits = stats["memory_hits"] + stats["disk_hits"]
+        lookups = hits + stats["misses"]
+        stats["hit_rate"] = (hits / lookups) if lookups else 0.0
+        return stats
+
+    def _remember(self, key: str, payload: str, expires_at: float, latency: float, tokens: int) -> None:
+        self._memory[key] = (payload, expires_at, latency, tokens)
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.memory_entries:
+            self._memory.popitem(last=False)
+
+    def _record_hit(self, tier: str, latency: float, tokens: int) -> None:
+        self._stats[tier] += 1
+        self._stats["saved_seconds"] += latency
+        self._stats["saved_tokens"] += tokens
+
+    def _evict_disk(self, now: float) -> None:
+        assert self._conn is not None
+        cur = self._conn.execute("DELETE FROM responses WHERE created_at < ?", (now - self.ttl_seconds,))
+        evicted = cur.rowcount if cur.rowcount and cur.rowcount > 0 else 0
+        count = self._conn.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+        overflow = count - self.max_entries
+        if overflow > 0:
+            self._conn.execute(
+                "DELETE FROM responses WHERE key IN"
+                " (SELECT key FROM responses ORDER BY last_access ASC LIMIT ?)",
+                (overflow,),
+            )
+            evicted += overflow
+        self._stats["evictions"] += evicted
+
+
+_cache: Optional[ResponseCache] = None
+_cache_lock = threading.Lock()
+
+
+def get_response_cache() -> Optional[ResponseCache]:
+    """Process-wide cache shared by every LLMClient (None when disabled)"""
+    global _cache
+    if not env_flag("PERSONA_CACHE_ENABLED", True):
+        return None
+    with _cache_lock:
+        if _cache is None:
+            _cache = ResponseCache(
+                db_path=os.getenv("PERSONA_CACHE_PATH", os.path.join(".cache", "persona_cache.sqlite3")),
+                ttl_seconds=float(os.getenv("PERSONA_CACHE_TTL", str(7 * 24 * 3600))),
+                max_entries=int(os.getenv("PERSONA_CACHE_MAX_ENTRIES", "5000")),
+                memory_entries=int(os.getenv("PERSONA_CACHE_MEMORY_ENTRIES", "256")),
+            )
+        return _cache
@@ -0,0 +1,186 @@
+from __future__ import annotations
+import hashlib
+import os
+import threading
+import time
+from typing import TYPE_CHECKING, Any, Dict, List, Tuple
+
+import metrics
+from utils import env_flag
+
+if TYPE_CHECKING:
+    import httpx
+    from openai import AsyncOpenAI, OpenAI
+
+
+# Module-level state lives once per process, so Streamlit sessions and reruns share it
+_lock = threading.Lock()
+_http_clients: Dict[str, httpx.Client] = {}
+_openai_clients: Dict[Tuple[str, str], OpenAI] = {}
+_request_counts: Dict[str, int] = {}
+
+
+def _http2_available() -> bool:
+    if not env_flag("HTTP2_ENABLED", True):
+        return False
+    try:
+        import h2  # noqa: F401
+    except ImportError:
+        return False
+    return True
+
+
+def _limits() -> httpx.Limits:
+    # httpx (and below, the openai SDK) is imported on first use so the login page starts without it
+    import httpx
+
+    return httpx.Limits(
+        max_connections=int(os.getenv("HTTP_MAX_CONNECTIONS", "32")),
+        max_keepalive_connections=int(os.getenv("HTTP_MAX_KEEPALIVE", "16")),
+        keepalive_expiry=float(os.getenv("HTTP_KEEPALIVE_EXPIRY", "120")),
+    )
+
+
+def _timeout() -> httpx.Timeout:
+    import httpx
+
+    # Short connect timeout to fail fast; long read timeout for full-length generations
+    return httpx.Timeout(
+        connect=float(os.getenv("HTTP_CONNECT_TIMEOUT", "5")),
+        read=float(os.getenv("HTTP_READ_TIMEOUT", "120")),
+        write=float(os.getenv("HTTP_WRITE_TIMEOUT", "10")),
+        pool=float(os.getenv("HTTP_POOL_TIMEOUT", "10")),
+    )
+
+
+def _counting_hook(name: str):
+    def hook(request: httpx.Request) -> None:
+        with _lock:
+            _request_counts[name] = _request_counts.get(name, 0) + 1
+    return hook
+
+
+def _ttfb_hooks(name: str) -> Dict[str, list]:
+    # Response hooks run once headers arrive (before the body is read), i.e. at first byte
+    def on_request(request: httpx.Request) -> None:
+        request.extensions["metrics_started"] = time.perf_counter()
+
+    def on_response(response: httpx.Response) -> None:
+        started = response.request.extensions.get("metrics_started")
+        if started is not None:
+            metrics.observe("llm_ttfb_seconds", time.perf_counter() - started, pool=name)
+
+    return {"request": [on_request], "response": [on_response]}
+
+
+def _async_ttfb_hooks(name: str) -> Dict[str, list]:
+    hooks = _ttfb_hooks(name)
+    on_request, on_response = hooks["request"][0], hooks["response"][0]
+
+    async def aon_request(request: httpx.Request) -> None:
+        on_request(request)
+
+    async def aon_response(response: httpx.Response) -> None:
+        on_response(response)
+
+    return {"request": [aon_request], "response": [aon_response]}
+
+
+def get_http_client(name: str = "default") -> httpx.Client:
+    """Shared keep-alive httpx client for ``name`` (created on first use, thread-safe)"""
+    import httpx
+
+    with _lock:
+        client = _http_clients.get(name)
+        if client is None or client.is_closed:
+            event_hooks: Dict[str, list] = {"request": [_counting_hook(name)]}
+            if metrics.enabled():
+                ttfb = _ttfb_hooks(name)
+                event_hooks["request"] += ttfb["request"]
+                event_hooks["response"] = ttfb["response"]
+            client = httpx.Client(
+                http2=_http2_available(),
+                limits=_limits(),
+                timeout=_timeout(),
+                event_hooks=event_hooks,
+            )
+            _http_clients[name] = client
+        return client
+
+
+def get_openai_client(api_key: str, base_url: str) -> OpenAI:
+    """Shared OpenAI-compatible client per (api key, base url) on its own connection pool"""
+    key = (hashlib.sha256(api_key.encode("utf-8")).hexdigest(), base_url)
+    with _lock:
+        client = _openai_clients.get(key)
+    if client is not None:
+        return client
+    from openai import OpenAI
+
+    http_client = get_http_client(f"openai:{base_url}")
+    with _lock:
+        client = _openai_clients.get(key)
+        if client is None:
+            # The router is the only retry layer: SDK retries would multiply its attempts and hide latency
+            client = OpenAI(api_key=api_key, base_url=base_url, http_client=http_client, max_retries=0)
+            _openai_clients[key] = client
+        return client
+
+
+def new_async_http_client(name: str = "async") -> httpx.AsyncClient:
+    """Async client with the shared pool settings.
+
+    Async connections are bound to the event loop that opened them, so these are created per
+    ``asyncio.run`` and closed by the caller instead of being registered process-wide.
+    """
+    import httpx
+
+    event_hooks = _async_ttfb_hooks(name) if metrics.enabled() else {}
+    return httpx.AsyncClient(http2=_http2_available(), limits=_limits(), timeout=_timeout(), event_hooks=event_hooks)
+
+
+def new_async_openai_client(api_key: str, base_url: str) -> AsyncOpenAI:
+    from openai import AsyncOpenAI
+
+    return AsyncOpenAI(api_key=api_key, base_url=base_url, http_client=new_async_http_client(f"openai:{base_url}"),
+                       max_retries=0)
+
+
+def _connection_stats(client: httpx.Client) -> Dict[str, Any]:
+    # httpcore does not expose a public API for this; report what is available
+    try:
+        connections = list(client._transport._pool.connections)  # type: ignore[attr-defined]
+    except AttributeError:
+        return {}
+    idle = sum(1 for c in connections if getattr(c, "is_idle", lambda: False)())
+    return {"connections": len(connections), "idle": idle, "active": len(connections) - idle}
+
+
+def pool_stats() -> List[Dict[str, Any]]:
+    """Per-pool snapshot: request count, open/idle connections and configuration"""
+    with _lock:
+        clients = list(_http_clients.items())
+        counts = dict(_request_counts)
+    limits = _limits()
+    stats = []
+    for name, client in clients:
+        entry: Dict[str, Any] = {
+            "pool": name,
+            "requests": counts.get(name, 0),
+            "http2": _http2_available(),
+            "max_connections": limits.max_connections,
+            "max_keepalive": limits.max_keepalive_connections,
+            "closed": client.is_closed,
+        }
+        entry.update(_connection_stats(client))
+        stats.append(entry)
+    return stats
+
+
+def close_all() -> None:
+    with _lock:
+        clients = list(_http_clients.values())
+        _http_clients.clear()
+        _openai_clients.clear()
+    for client in clients:
+        client.close()
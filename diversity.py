@@ -0,0 +1,205 @@
+from __future__ import annotations
+import argparse
+import json
+import math
+import re
+import sys
+import zlib
+from dataclasses import dataclass, field
+from functools import lru_cache
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+
+from persona_schema import Persona, PersonaBundle
+from similarity import normalize
+
+
+TEXT_DIM = 2048
+INCOME_DIM = 32
+CHANNEL_DIM = 128
+# Age coverage in 5-year bins from 15 to 80: overlapping ranges share bins
+AGE_BINS = np.arange(15, 85, 5)
+# Block weights (sum to 1, so similarities stay in [0, 1])
+WEIGHTS = {"text": 0.55, "age": 0.15, "income": 0.1, "channels": 0.2}
+
+_AGE_RE = re.compile(r"\d+")
+
+
+@lru_cache(maxsize=1 << 16)
+def _bucket(token: str, dim: int) -> int:
+    # crc32 rather than hash(): stable across processes, so batch scores are reproducible.
+    # Cached: the vocabulary of a market repeats across personas and bundles
+    return zlib.crc32(token.encode("utf-8")) % dim
+
+
+def _persona_text(p: Persona) -> str:
+    # The name is left out: every persona has a different one, clones included
+    parts = [p.occupation, p.location, p.education, p.messaging_tone, p.summary, p.creative_brief]
+    parts += p.motivations + p.frustrations + p.behavioral_signals
+    parts += p.psychographics.values + p.psychographics.interests + p.psychographics.lifestyle
+    for level in p.segmentation_levels:
+        parts += [level.label, *level.criteria]
+    return "\n".join(part for part in parts if part)
+
+
+def _text_tokens(text: str, dim: int) -> List[int]:
+    words = normalize(text)
+    return [_bucket(w, dim) for w in words] + [_bucket(f"{a}_{b}", dim) for a, b in zip(words, words[1:])]
+
+
+def _age_vector(age_range: str) -> np.ndarray:
+    numbers = [int(n) for n in _AGE_RE.findall(age_range or "")][:2]
+    vector = np.zeros(len(AGE_BINS), dtype=np.float32)
+    if numbers:
+        low, high = min(numbers), max(numbers)
+        if "+" in (age_range or "") and len(numbers) == 1:
+            high = 80
+        vector[(AGE_BINS + 5 > low) & (AGE_BINS <= high)] = 1.0
+    return vector
+
+
+def _multi_hot(tokens: Iterable[str], dim: int) -> np.ndarray:
+    vector = np.zeros(dim, dtype=np.float32)
+    for token in tokens:
+        vector[_bucket(token, dim)] = 1.0
+    return vector
+
+
+def _normalize_rows(block: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(block, axis=-1, keepdims=True)
+    return np.divide(block, norms, out=np.zeros_like(block), where=norms > 0)
+
+
+def vectorize(bundles: List[List[Persona]]) -> Tuple[np.ndarray, np.ndarray]:
+    """Feature tensor (bundles, max personas, dims) and the mask of real (non-padding) rows.
+
+    IDF is computed within each bundle: words every persona shares (the product, the market)
+    say nothing about how the personas differ.
+    """
+    size = max((len(b) for b in bundles), default=0)
+    mask = np.zeros((len(bundles), size), dtype=bool)
+    rows: List[int] = []
+    cols: List[int] = []
+    age = np.zeros((len(bundles), size, len(AGE_BINS)), dtype=np.float32)
+    income = np.zeros((len(bundles), size, INCOME_DIM), dtype=np.float32)
+    channels = np.zeros((len(bundles), size, CHANNEL_DIM), dtype=np.float32)
+    for b, personas in enumerate(bundles):
+        for i, p in enumerate(personas):
+            mask[b, i] = True
+            tokens = _text_tokens(_persona_text(p), TEXT_DIM)
+            rows += [b * size + i] * len(tokens)
+            cols += tokens
+            age[b, i] = _age_vector(p.age_range)
+            income[b, i] = _multi_hot(normalize(p.income_range or ""), INCOME_DIM)
+            channels[b, i] = _multi_hot((w for c in p.preferred_channels for w in normalize(c)), CHANNEL_DIM)
+
+    # Term counts for every persona at once: one bincount over flattened (row, bucket) ids
+    flat = np.asarray(rows, dtype=np.int64) * TEXT_DIM + np.asarray(cols, dtype=np.int64)
+    counts = np.bincount(flat, minlength=len(bundles) * size * TEXT_DIM).astype(np.float32)
+    tf = np.log1p(counts.reshape(len(bundles), size, TEXT_DIM))
+    docs = mask.sum(axis=1, keepdims=True).astype(np.float32)
+    df = (tf > 0).sum(axis=1).astype(np.float32)
+    idf = np.log((1.0 + docs) / (1.0 + df)) + 1.0
+    text = tf * idf[:, None, :]
+
+    blocks = [(text, "text"), (age, "age"), (income, "income"), (channels, "channels")]
+    features = np.concatenate([_normalize_rows(block) * math.sqrt(WEIGHTS[name]) for block, name in blocks], axis=-1)
+    return features, mask
+
+
+# Bundles scored per matrix product: bounds memory on large batch outputs
+CHUNK = 256
+
+
+@dataclass
+class DiversityReport:
+    """Pairwise similarities of one bundle and the personas worth regenerating"""
+    score: float
+    similarity: np.ndarray
+    pairs: List[Tuple[int, int, float]] = field(default_factory=list)
+    redundant: List[int] = field(default_factory=list)
+
+    def nearest(self, index: int) -> Optional[Tuple[int, float]]:
+        """Most similar other persona and its similarity"""
+        if len(self.similarity) < 2:
+            return None
+        row = self.similarity[index].copy()
+        row[index] = -1.0
+        other = int(row.argmax())
+        return other, float(row[other])
+
+    def to_regenerate(self, min_score: float) -> List[int]:
+        """Personas to replace when the bundle scores below ``min_score``"""
+        if self.score >= min_score or len(self.similarity) < 2:
+            return []
+        if self.redundant:
+            return list(self.redundant)
+        # No pair crosses the threshold but the bundle is uniform: replace its most typical persona
+        n = len(self.similarity)
+        mean = (self.similarity.sum(axis=1) - np.diag(self.similarity)) / (n - 1)
+        return [int(mean.argmax())]
+
+
+def _report(sim: np.ndarray, pair_threshold: float) -> DiversityReport:
+    n = len(sim)
+    if n < 2:
+        return DiversityReport(score=1.0, similarity=sim)
+    others = sim - 2.0 * np.eye(n, dtype=sim.dtype)
+    score = float(1.0 - np.clip(others.max(axis=1), 0.0, 1.0).mean())
+    i, j = np.nonzero(np.triu(sim >= pair_threshold, k=1))
+    pairs = sorted(((int(a), int(b), float(sim[a, b])) for a, b in zip(i, j)), key=lambda pair: -pair[2])
+    # Keep the first persona of each near-clone pair, replace the other
+    redundant: List[int] = []
+    for a, b, _ in pairs:
+        if a not in redundant and b not in redundant:
+            redundant.append(b)
+    return DiversityReport(score=score, similarity=sim, pairs=pairs, redundant=sorted(redundant))
+
+
+def analyze_many(bundles: List[PersonaBundle], pair_threshold: float = 0.8) -> List[DiversityReport]:
+    """Score many bundles with one batched similarity product per chunk (e.g. a batch.py output file)"""
+    reports: List[DiversityReport] = []
+    for start in range(0, len(bundles), CHUNK):
+        features, mask = vectorize([list(b.personas) for b in bundles[start:start + CHUNK]])
+        similarity = features @ features.transpose(0, 2, 1)
+        for b, n in enumerate(mask.sum(axis=1)):
+            reports.append(_report(similarity[b, :n, :n], pair_threshold))
+    return reports
+
+
+def analyze(bundle: PersonaBundle, pair_threshold: float = 0.8) -> DiversityReport:
+    return analyze_many([bundle], pair_threshold)[0]
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="Diversidad de los bundles de una salida de batch.py")
+    parser.add_argument("input", help="JSONL de salida de batch.py")
+    parser.add_argument("--pair-threshold", type=float, default=0.8, help="Similitud a partir de la cual dos personas son casi iguales")
+    args = parser.parse_args(argv)
+
+    ids: List[str] = []
+    bundles: List[PersonaBundle] = []
+    with open(args.input, encoding="utf-8") as fh:
+        for line in fh:
+            if line.strip():
+                item = json.loads(line)
+                ids.append(str(item.get("id", len(ids))))
+                bundles.append(PersonaBundle.model_validate(item["bundle"]))
+    reports = analyze_many(bundles, args.pair_threshold)
+    for item_id, report in zip(ids, reports):
+        if report.pairs:
+            pairs = ", ".join(f"{i + 1}~{j + 1} ({s:.2f})" for i, j, s in report.pairs)
+            print(f"{item_id}: diversidad {report.score:.2f} · casi iguales: {pairs}")
+    scores = [r.score for r in reports]
+    summary: Dict[str, float] = {
+        "bundles": len(reports),
+        "mean_score": round(float(np.mean(scores)), 4) if scores else 0.0,
+        "with_near_clones": sum(1 for r in reports if r.pairs),
+    }
+    print(json.dumps(summary))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,204 @@
+from __future__ import annotations
+import json
+import re
+from typing import Any, Iterator, List, Tuple, Union
+
+from pydantic import ValidationError
+
+import metrics
+from persona_schema import Persona, PersonaBundle, validate_persona
+
+
+_FENCE_RE = re.compile(r"```(?:json|JSON)?\s*")
+_OPENER_RE = re.compile(r"[{\[]")
+_TRAILING_COMMA_RE = re.compile(r",(\s*[}\]])")
+_PY_LITERALS = {"True": "true", "False": "false", "None": "null"}
+_CLOSERS = {"{": "}", "[": "]"}
+
+
+def extract_json_span(text: str) -> str:
+    """Return the JSON document inside model output (drops fences, preambles and trailing prose).
+
+    If the document never closes (truncated output), everything from its start is returned.
+    """
+    return next(json_spans(text))
+
+
+def json_spans(text: str) -> Iterator[str]:
+    """Candidate JSON documents in model output: one from each ``{``/``[``, in order.
+
+    Prose can hold brackets of its own ("Aquí {va} el resultado: {...}"), so a caller that cannot
+    parse (or repair) a span moves on to the one starting at the next ``{``/``[``.
+    """
+    text = _FENCE_RE.sub("", text)
+    match = _OPENER_RE.search(text)
+    if match is None:
+        yield text.strip()
+        return
+    while match is not None:
+        yield _span_at(text, match.start())
+        match = _OPENER_RE.search(text, match.start() + 1)
+
+
+def _span_at(text: str, start: int) -> str:
+    depth = 0
+    in_string = False
+    escape = False
+    quote = ""
+    for i in range(start, len(text)):
+        ch = text[i]
+        if in_string:
+            if escape:
+                escape = False
+            elif ch == "\\":
+                escape = True
+            elif ch == quote:
+                in_string = False
+            continue
+        if ch in "\"'":
+            in_string, quote = True, ch
+        elif ch in "{[":
+            depth += 1
+        elif ch in "}]":
+            depth -= 1
+            if depth == 0:
+                return text[start:i + 1]
+    return text[start:].strip()
+
+
+def _normalize_tokens(text: str) -> str:
+    """Single-quoted strings -> double-quoted, Python literals -> JSON, outside of strings"""
+    out: List[str] = []
+    i = 0
+    n = len(text)
+    while i < n:
+        ch = text[i]
+        if ch in "\"'":
+            quote = ch
+            j = i + 1
+            buf: List[str] = []
+            while j < n:
+                c = text[j]
+                if c == "\\" and j + 1 < n:
+                    nxt = text[j + 1]
+                    # \' is not a valid JSON escape
+                    buf.append("'" if nxt == "'" else c + nxt)
+                    j += 2
+                    continue
+                if c == quote:
+                    break
+                buf.append('\\"' if c == '"' and quote == "'" else c)
+                j += 1
+            out.append('"' + "".join(buf) + ('"' if j < n else ""))
+            i = j + 1
+            continue
+        if ch.isalpha():
+            j = i
+            while j < n and (text[j].isalnum() or text[j] == "_"):
+                j += 1
+            word = text[i:j]
+            out.append(_PY_LITERALS.get(word, word))
+            i = j
+            continue
+        out.append(ch)
+        i += 1
+    return "".join(out)
+
+
+def close_truncated(text: str) -> str:
+    """Cut a truncated document back to its last complete value and close the open containers"""
+    stack: List[str] = []
+    in_string = False
+    escape = False
+    last_cut = -1
+    last_stack: List[str] = []
+    for i, ch in enumerate(text):
+        if in_string:
+            if escape:
+                escape = False
+            elif ch == "\\":
+                escape = True
+            elif ch == '"':
+                in_string = False
+            continue
+        if ch == '"':
+            in_string = True
+        elif ch in "{[":
+            stack.append(ch)
+        elif ch in "}]":
+            if stack:
+                stack.pop()
+            if stack:
+                last_cut, last_stack = i, list(stack)
+    if not stack and not in_string:
+        return text
+    if last_cut < 0:
+        # Nothing complete inside: close the string (if any) and every container
+        return text + ('"' if in_string else "") + "".join(_CLOSERS[c] for c in reversed(stack))
+    return text[:last_cut + 1] + "".join(_CLOSERS[c] for c in reversed(last_stack))
+
+
+def repair_json(text: str) -> str:
+    text = _normalize_tokens(text)
+    text = close_truncated(text)
+    return _TRAILING_COMMA_RE.sub(r"\1", text)
+
+
+def parse_lenient(text: str) -> Any:
+    """json.loads, falling back to span extraction and repair of common model defects"""
+    try:
+        return json.loads(text)
+    except ValueError:
+        pass
+    error: Exception = ValueError("sin JSON")
+    for span in json_spans(text):
+        try:
+            return json.loads(span)
+        except ValueError:
+            pass
+        try:
+            return json.loads(repair_json(span))
+        except ValueError as exc:
+            error = exc
+    raise ValueError(f"No se pudo extraer JSON de la respuesta: {error}") from error
+
+
+def salvage_personas(data: Any) -> Tuple[List[Persona], int]:
+    """Validate personas one by one (lenient); returns (valid personas, number rejected)"""
+    if isinstance(data, dict):
+        items = data.get("personas", [data] if "name" in data else [])
+    elif isinstance(data, list):
+        items = data
+    else:
+        items = []
+    personas: List[Persona] = []
+    rejected = 0
+    for item in items if isinstance(items, list) else []:
+        try:
+            personas.append(validate_persona(item))
+        except ValidationError:
+            rejected += 1
+    return personas, rejected
+
+
+def personas_from_text(text: Union[str, bytes]) -> Tuple[List[Persona], int]:
+    """Validate raw model output, salvaging what it can.
+
+    Well-formed bundles go straight through pydantic's JSON parser (no intermediate dicts);
+    only responses that fail it pay for repair and per-persona validation.
+    """
+    try:
+        # pydantic-core parses and validates in a single pass, so both are timed together
+        with metrics.stage("parse_validate"):
+            personas = PersonaBundle.model_validate_json(text).personas
+        # An empty list may just mean a bare persona or list at the top level
+        if personas:
+            return personas, 0
+    except ValidationError:
+        pass
+    if isinstance(text, bytes):
+        text = text.decode("utf-8", errors="replace")
+    with metrics.stage("json_parse"):
+        data = parse_lenient(text)
+    with metrics.stage("validation"):
+        return salvage_personas(data)
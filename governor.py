@@ -0,0 +1,298 @@
+from __future__ import annotations
+import asyncio
+import os
+import sqlite3
+import threading
+import time
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from utils import env_flag
+
+
+# A waiter that stopped polling (crashed process, closed tab) no longer holds its place
+STALE_SECONDS = 30.0
+POLL_SECONDS = 1.0
+
+WaitCallback = Callable[[float, int], None]
+
+
+class RateDeferred(RuntimeError):
+    """Raised instead of waiting when a call would wait longer than the caller's ``max_wait``.
+
+    The call keeps its place in the queue: ``ticket`` is passed back to ``acquire`` to resume
+    there, and :meth:`RateGovernor.keep` must be called meanwhile so it does not go stale.
+    """
+
+    def __init__(self, wait: float, ahead: int, ticket: Optional[int] = None):
+        super().__init__(f"Límite de uso alcanzado: reintentar en {wait:.0f} s")
+        self.wait = wait
+        self.ahead = ahead
+        self.ticket = ticket
+
+
+class Budget:
+    """``per_minute`` units per minute with bursts of up to a minute's worth (0 disables it)"""
+
+    def __init__(self, per_minute: float):
+        self.per_minute = max(0.0, per_minute)
+        # GCRA: each unit moves the bucket's theoretical arrival time (TAT) forward by ``interval``;
+        # a request fits while the TAT stays within ``tolerance`` of now
+        self.interval = 60.0 / self.per_minute if self.per_minute else 0.0
+        self.tolerance = 60.0
+
+    def cost(self, amount: float) -> float:
+        # Requests bigger than the whole burst are let through once the bucket is full
+        return min(amount, self.per_minute) * self.interval
+
+    def wait(self, tat: float, now: float, amount: float) -> float:
+        """Seconds until ``amount`` fits, given the bucket's TAT"""
+        if not self.per_minute:
+            return 0.0
+        return max(0.0, max(tat, now) + self.cost(amount) - self.tolerance - now)
+
+
+class RateGovernor:
+    """Per-user and global request/token budgets shared by every process through SQLite.
+
+    Buckets are GCRA token buckets (one TAT per key, so a grant is a single row update under
+    ``BEGIN IMMEDIATE``). Over-limit calls are queued, not rejected: each waiter gets a turn when
+    it is enqueued and waiters are served by turn, so users are served round-robin (FIFO within a
+    user), and every waiter's expected wait accounts for the reservations of the waiters ahead of it.
+    """
+
+    def __init__(self, db_path: str, global_rpm: float = 60, global_tpm: float = 200_000,
+                 user_rpm: float = 12, user_tpm: float = 40_000):
+        self.db_path = db_path
+        self.budgets: Dict[str, Budget] = {
+            "global:req": Budget(global_rpm),
+            "global:tok": Budget(global_tpm),
+            "user:req": Budget(user_rpm),
+            "user:tok": Budget(user_tpm),
+        }
+        self._lock = threading.Lock()
+        self._stats = {"granted": 0, "queued": 0, "waited_seconds": 0.0}
+        directory = os.path.dirname(db_path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        # Autocommit mode: transactions are opened explicitly with BEGIN IMMEDIATE
+        self._conn = sqlite3.connect(db_path, check_same_thread=False, timeout=10, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS buckets (key TEXT PRIMARY KEY, tat REAL NOT NULL)")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS waiters ("
+            " id INTEGER PRIMARY KEY, user TEXT NOT NULL, provider TEXT NOT NULL, tokens REAL NOT NULL,"
+            " enqueued_at REAL NOT NULL, heartbeat REAL NOT NULL, turn INTEGER NOT NULL DEFAULT 0)"
+        )
+        columns = {row[1] for row in self._conn.execute("PRAGMA table_info(waiters)")}
+        if "turn" not in columns:
+            self._conn.execute("ALTER TABLE waiters ADD COLUMN turn INTEGER NOT NULL DEFAULT 0")
+
+    def _keys(self, user: str, provider: str) -> List[Tuple[str, str, float]]:
+        # (bucket key, budget name, unit: 1 = request, 0 = tokens)
+        keys = [(f"global:{provider}:req", "global:req", 1.0), (f"global:{provider}:tok", "global:tok", 0.0)]
+        if user:
+            keys += [(f"user:{user}:req", "user:req", 1.0), (f"user:{user}:tok", "user:tok", 0.0)]
+        return keys
+
+    @staticmethod
+    def _turn(queue: List[Tuple[Any, ...]], user: str) -> int:
+        """Turn for a new waiter of ``user``: after the user's own waiters, never before the current round.
+
+        ``queue`` rows are ``(..., user, turn)`` in the last two columns. A user with nothing queued
+        joins the round being served, so a backlog cannot push newcomers behind all of it.
+        """
+        current = min((w[-1] for w in queue), default=1)
+        own = max((w[-1] for w in queue if w[-2] == user), default=0)
+        return max(own + 1, current)
+
+    def _attempt(self, user: str, provider: str, tokens: float,
+                 ticket: Optional[int]) -> Tuple[float, int, Optional[int]]:
+        """One scheduling round: (seconds to wait or 0 when granted, waiters ahead, queue ticket)"""
+        now = time.time()
+        conn = self._conn
+        with self._lock:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                conn.execute("DELETE FROM waiters WHERE heartbeat < ?", (now - STALE_SECONDS,))
+                if ticket is not None:
+                    # A resumed call may go to another provider or with another estimate than when it queued
+                    conn.execute(
+                        "UPDATE waiters SET heartbeat = ?, provider = ?, tokens = ? WHERE id = ? AND user = ?",
+                        (now, provider, tokens, ticket, user),
+                    )
+                # Turns are fixed at enqueue time, so serving a user's oldest waiter does not move
+                # the rest of that user's backlog ahead of other users
+                queue = conn.execute("SELECT id, provider, tokens, user, turn FROM waiters ORDER BY turn, id").fetchall()
+                if ticket is not None and all(w[0] != ticket or w[3] != user for w in queue):
+                    # Lost its place (went stale; ids of deleted rows can be reused): queue again like a new call
+                    ticket = None
+                turn = 0
+                if ticket is None:
+                    turn = self._turn(queue, user)
+                    ahead = [w for w in queue if w[4] <= turn]
+                else:
+                    position = next((i for i, w in enumerate(queue) if w[0] == ticket), len(queue))
+                    ahead = queue[:position]
+                tats = dict(conn.execute("SELECT key, tat FROM buckets").fetchall())
+
+                # Reserve what the waiters ahead will take, then see whether this call still fits
+                simulated = dict(tats)
+                for _, w_provider, w_tokens, w_user, _ in ahead:
+                    for key, budget_name, unit in self._keys(w_user, w_provider):
+                        budget = self.budgets[budget_name]
+                        amount = unit or w_tokens
+                        simulated[key] = max(simulated.get(key, now), now) + budget.cost(amount)
+                keys = self._keys(user, provider)
+                wait = max(
+                    self.budgets[name].wait(simulated.get(key, now), now, unit or tokens) for key, name, unit in keys
+                )
+                if wait <= 0:
+                    conn.executemany(
+                        "INSERT INTO buckets (key, tat) VALUES (?, ?)"
+                        " ON CONFLICT(key) DO UPDATE SET tat = excluded.tat",
+                        [(key, max(tats.get(key, now), now) + self.budgets[name].cost(unit or tokens))
+                         for key, name, unit in keys],
+                    )
+                    if ticket is not None:
+                        conn.execute("DELETE FROM waiters WHERE id = ?", (ticket,))
+                    ticket = None
+                elif ticket is None:
+                    ticket = conn.execute(
+                        "INSERT INTO waiters (user, provider, tokens, enqueued_at, heartbeat, turn)"
+                        " VALUES (?, ?, ?, ?, ?, ?)",
+                        (user, provider, tokens, now, now, turn),
+                    ).lastrowid
+                conn.execute("COMMIT")
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+        return wait, len(ahead), ticket
+
+    def _release(self, ticket: Optional[int]) -> None:
+        # A caller that gives up (timeout, cancelled task) must not keep others waiting
+        if ticket is None:
+            return
+        with self._lock:
+            self._conn.execute("DELETE FROM waiters WHERE id = ?", (ticket,))
+
+    def keep(self, ticket: int) -> None:
+        """Keep the place of a deferred call (see :class:`RateDeferred`) while it is parked"""
+        with self._lock:
+            self._conn.execute("UPDATE waiters SET heartbeat = ? WHERE id = ?", (time.time(), ticket))
+
+    def _granted(self, waited: float) -> None:
+        with self._lock:
+            self._stats["granted"] += 1
+            if waited > 0:
+                self._stats["queued"] += 1
+                self._stats["waited_seconds"] += waited
+
+    def acquire(self, user: Optional[str], provider: str, tokens: float,
+                on_wait: Optional[WaitCallback] = None, max_wait: Optional[float] = None,
+                ticket: Optional[int] = None) -> float:
+        """Block until one call of ``tokens`` estimated tokens fits every budget; returns seconds waited.
+
+        ``on_wait(seconds, waiters_ahead)`` is called each time the expected wait is re-estimated.
+        When the first estimate exceeds ``max_wait``, :class:`RateDeferred` is raised instead of
+        waiting; ``ticket`` resumes a deferred call at the place it kept in the queue.
+        """
+        started = time.time()
+        queued = False
+        parked = False
+        try:
+            while True:
+                wait, ahead, ticket = self._attempt(user or "", provider, tokens, ticket)
+                if wait <= 0:
+                    break
+                if not queued and max_wait is not None and wait > max_wait:
+                    parked = True
+                    raise RateDeferred(wait, ahead, ticket)
+                queued = True
+                if on_wait is not None:
+                    on_wait(wait, ahead)
+                time.sleep(min(wait, POLL_SECONDS))
+        finally:
+            if not parked:
+                self._release(ticket)
+        waited = time.time() - started if queued else 0.0
+        self._granted(waited)
+        return waited
+
+    async def aacquire(self, user: Optional[str], provider: str, tokens: float,
+                       on_wait: Optional[WaitCallback] = None, max_wait: Optional[float] = None,
+                       ticket: Optional[int] = None) -> float:
+        """``acquire`` for coroutines: waits with ``asyncio.sleep`` instead of blocking the loop"""
+        started = time.time()
+        queued = False
+        parked = False
+        try:
+            while True:
+                wait, ahead, ticket = self._attempt(user or "", provider, tokens, ticket)
+                if wait <= 0:
+                    break
+                if not queued and max_wait is not None and wait > max_wait:
+                    parked = True
+                    raise RateDeferred(wait, ahead, ticket)
+                queued = True
+                if on_wait is not None:
+                    on_wait(wait, ahead)
+                await asyncio.sleep(min(wait, POLL_SECONDS))
+        finally:
+            if not parked:
+                self._release(ticket)
+        waited = time.time() - started if queued else 0.0
+        self._granted(waited)
+        return waited
+
+    def expected_wait(self, user: Optional[str], provider: str, tokens: float) -> float:
+        """Seconds a call submitted now would wait (read-only; nothing is reserved)"""
+        now = time.time()
+        with self._lock:
+            tats = dict(self._conn.execute("SELECT key, tat FROM buckets").fetchall())
+            queue = self._conn.execute(
+                "SELECT provider, tokens, user, turn FROM waiters WHERE heartbeat >= ?", (now - STALE_SECONDS,)
+            ).fetchall()
+        # Only the waiters a new call would queue behind
+        turn = self._turn(queue, user or "")
+        for w_provider, w_tokens, w_user, w_turn in queue:
+            if w_turn > turn:
+                continue
+            for key, name, unit in self._keys(w_user, w_provider):
+                tats[key] = max(tats.get(key, now), now) + self.budgets[name].cost(unit or w_tokens)
+        return max(self.budgets[name].wait(tats.get(key, now), now, unit or tokens)
+                   for key, name, unit in self._keys(user or "", provider))
+
+    def stats(self) -> Dict[str, float]:
+        now = time.time()
+        with self._lock:
+            stats: Dict[str, float] = dict(self._stats)
+            stats["waiting"] = self._conn.execute(
+                "SELECT COUNT(*) FROM waiters WHERE heartbeat >= ?", (now - STALE_SECONDS,)
+            ).fetchone()[0]
+        stats["avg_wait"] = stats["waited_seconds"] / stats["queued"] if stats["queued"] else 0.0
+        return stats
+
+
+_governor: Optional[RateGovernor] = None
+_governor_lock = threading.Lock()
+
+
+def get_governor() -> Optional[RateGovernor]:
+    """Process-wide governor (None when disabled or its database cannot be opened)"""
+    global _governor
+    if not env_flag("GOVERNOR_ENABLED", True):
+        return None
+    with _governor_lock:
+        if _governor is None:
+            try:
+                _governor = RateGovernor(
+                    os.getenv("GOVERNOR_PATH", os.path.join(".cache", "governor.sqlite3")),
+                    global_rpm=float(os.getenv("LLM_GLOBAL_RPM", "60")),
+                    global_tpm=float(os.getenv("LLM_GLOBAL_TPM", "200000")),
+                    user_rpm=float(os.getenv("LLM_USER_RPM", "12")),
+                    user_tpm=float(os.getenv("LLM_USER_TPM", "40000")),
+                )
+            except sqlite3.Error:
+                return None
+        return _governor
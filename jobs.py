@@ -0,0 +1,286 @@
+from __future__ import annotations
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from typing import TYPE_CHECKING, Any, Dict, List, Optional
+
+import metrics
+from governor import STALE_SECONDS, RateDeferred, get_governor
+from library import get_persona_library
+from llm_client import LLMClient
+from persona_schema import Persona, PersonaBundle
+from utils import env_flag
+
+if TYPE_CHECKING:
+    from diversity import DiversityReport
+
+
+MODES = ("stream", "fanout", "full")
+# Single-persona edits of an existing bundle (see JobManager.submit_edit)
+EDIT_MODES = ("regenerate", "refine")
+
+
+class Job:
+    """One generation running on the shared pool; may be followed by several sessions"""
+
+    def __init__(self, job_id: str, key: str, mode: str, product: str, target: str, num_personas: int, fresh: bool,
+                 user: Optional[str] = None):
+        self.id = job_id
+        self.key = key
+        self.mode = mode
+        self.product = product
+        self.target = target
+        self.num_personas = num_personas
+        self.fresh = fresh
+        self.user = user
+        self.status = "queued"
+        # Personas completed so far (streaming jobs fill this progressively)
+        self.personas: List[Persona] = []
+        self.bundle: Optional[PersonaBundle] = None
+        # Diversity report of the final bundle (after redundant personas were regenerated)
+        self.diversity: Optional[DiversityReport] = None
+        self.usage: Dict[str, int] = {}
+        self.error: Optional[str] = None
+        self.created_at = time.time()
+        self.started_at: Optional[float] = None
+        self.finished_at: Optional[float] = None
+        # Set while a call is queued by the rate governor: expected start and waiters ahead
+        self.rate_wait_until: Optional[float] = None
+        self.rate_waiters_ahead = 0
+        # Governor ticket kept while the job is parked after a RateDeferred
+        self.rate_ticket: Optional[int] = None
+        self.subscribers = 1
+        # Edit jobs: the bundle being edited, the position to replace and the refine instruction
+        self.edit_personas: List[Persona] = []
+        self.edit_index = 0
+        self.instruction = ""
+
+    @property
+    def done(self) -> bool:
+        return self.status in {"done", "error"}
+
+    @property
+    def rate_wait(self) -> float:
+        """Seconds until the governor lets the current call through (0 when not throttled)"""
+        return max(0.0, (self.rate_wait_until or 0.0) - time.time())
+
+    def _on_rate_wait(self, seconds: float, ahead: int) -> None:
+        self.rate_wait_until = time.time() + seconds
+        self.rate_waiters_ahead = ahead
+
+
+def _diversity_enabled() -> bool:
+    return env_flag("DIVERSITY_ENABLED", True)
+
+
+def job_key(mode: str, product: str, target: str, num_personas: int, fresh: bool = False) -> str:
+    # Everything that changes the answer is part of the key: a fresh request never joins a cached
+    # one, and differently configured processes (provider, model, temperature) never share results
+    raw = json.dumps(
+        [mode, product.strip(), target.strip(), num_personas, bool(fresh),
+         os.getenv("LLM_PROVIDER", "openai"), os.getenv("OPENAI_MODEL", ""), os.getenv("HF_MODEL", ""),
+         os.getenv("LOCAL_MODEL_PATH", ""), os.getenv("LLM_TEMPERATURE", "0.7")],
+        ensure_ascii=False,
+    )
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+class JobManager:
+    """Bounded thread pool for generations, decoupled from the Streamlit script thread.
+
+    Identical requests submitted while one is queued or running join that job instead of
+    starting another call. The call is made once, so its usage is charged once, to the user who
+    submitted it; subscribers that joined it are not charged. Finished jobs stay available for ``ttl_seconds`` so a session can
+    pick its results up after a browser refresh.
+    """
+
+    def __init__(self, max_workers: int = 4, ttl_seconds: float = 3600, max_rate_wait: Optional[float] = 1.0):
+        self.max_workers = max_workers
+        self.ttl_seconds = ttl_seconds
+        # Longest governor wait a job sleeps through on a worker (None: always wait in place)
+        self.max_rate_wait = max_rate_wait
+        self._pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="persona-job")
+        self._lock = threading.Lock()
+        self._jobs: Dict[str, Job] = {}
+        self._inflight: Dict[str, str] = {}
+        self._stats = {"submitted": 0, "coalesced": 0, "deferred": 0, "completed": 0, "failed": 0}
+
+    def submit(self, mode: str, product: str, target: str, num_personas: int, fresh: bool = False,
+               user: Optional[str] = None) -> Job:
+        if mode not in MODES:
+            raise ValueError(f"Modo desconocido: {mode}")
+        key = job_key(mode, product, target, num_personas, fresh)
+        with self._lock:
+            self._expire()
+            running = self._jobs.get(self._inflight.get(key, ""))
+            if running is not None and not running.done:
+                running.subscribers += 1
+                self._stats["coalesced"] += 1
+                metrics.inc("jobs_total", result="coalesced")
+                return running
+            job = Job(uuid.uuid4().hex[:12], key, mode, product, target, num_personas, fresh, user)
+            self._jobs[job.id] = job
+            self._inflight[key] = job.id
+            self._stats["submitted"] += 1
+        metrics.inc("jobs_total", result="submitted")
+        self._pool.submit(self._run, job)
+        return job
+
+    def submit_edit(self, mode: str, product: str, target: str, personas: List[Persona], index: int,
+                    instruction: str = "", user: Optional[str] = None) -> Job:
+        """Regenerate or refine ``personas[index]`` on the pool; the new persona is the job's only one.
+
+        Edits are never coalesced: two clicks on Regenerar are meant to give two different personas.
+        """
+        if mode not in EDIT_MODES:
+            raise ValueError(f"Modo desconocido: {mode}")
+        job_id = uuid.uuid4().hex[:12]
+        job = Job(job_id, job_id, mode, product, target, 1, True, user)
+        job.edit_personas = list(personas)
+        job.edit_index = index
+        job.instruction = instruction
+        with self._lock:
+            self._expire()
+            self._jobs[job.id] = job
+            self._stats["submitted"] += 1
+        metrics.inc("jobs_total", result="submitted")
+        self._pool.submit(self._run, job)
+        return job
+
+    def get(self, job_id: str) -> Optional[Job]:
+        with self._lock:
+            self._expire()
+            return self._jobs.get(job_id)
+
+    def queue_position(self, job: Job) -> int:
+        """Number of queued jobs ahead of ``job`` (0 once it is running)"""
+        if job.status != "queued":
+            return 0
+        with self._lock:
+            return sum(1 for j in self._jobs.values() if j.status == "queued" and j.created_at < job.created_at)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            jobs = list(self._jobs.values())
+            stats: Dict[str, Any] = dict(self._stats)
+        stats["queued"] = sum(1 for j in jobs if j.status == "queued")
+        stats["running"] = sum(1 for j in jobs if j.status == "running")
+        stats["max_workers"] = self.max_workers
+        return stats
+
+    def _run(self, job: Job) -> None:
+        job.status = "running"
+        job.started_at = time.time()
+        try:
+            client = LLMClient(user=job.user)
+            client.on_rate_wait = job._on_rate_wait
+            # A throttled job gives its worker back instead of sleeping on it, so one user's
+            # backlog cannot fill the pool while other users' calls fit their budgets
+            client.rate_defer = self.max_rate_wait
+            client.rate_ticket, job.rate_ticket = job.rate_ticket, None
+            if job.mode == "refine":
+                bundle = PersonaBundle(personas=[client.refine_persona(
+                    job.product, job.target, job.edit_personas, job.edit_index, job.instruction,
+                )])
+            elif job.mode == "regenerate":
+                bundle = PersonaBundle(personas=[client.regenerate_persona(
+                    job.product, job.target, job.edit_personas, job.edit_index,
+                )])
+            elif job.mode == "stream":
+                for persona in client.stream_personas(job.product, job.target, job.num_personas, fresh=job.fresh):
+                    job.personas.append(persona)
+                bundle = PersonaBundle(personas=list(job.personas))
+            elif job.mode == "fanout":
+                bundle = client.generate_personas_fanout(job.product, job.target, job.num_personas, fresh=job.fresh)
+            else:
+                bundle = client.generate_personas(job.product, job.target, job.num_personas, fresh=job.fresh)
+            if _diversity_enabled() and len(bundle.personas) > 1:
+                bundle, job.diversity = client.diversify(job.product, job.target, bundle)
+            job.personas = list(bundle.personas)
+            job.bundle = bundle
+            job.usage = dict(client.last_usage)
+            job.status = "done"
+            if job.mode not in EDIT_MODES:
+                # Edits are recorded by the session that applies them to its bundle
+                self._record(job, client)
+        except RateDeferred as exc:
+            self._defer(job, exc)
+            return
+        except Exception as exc:
+            job.error = str(exc) or type(exc).__name__
+            job.status = "error"
+        job.finished_at = time.time()
+        with self._lock:
+            self._stats["completed" if job.status == "done" else "failed"] += 1
+            if self._inflight.get(job.key) == job.id:
+                del self._inflight[job.key]
+
+    def _defer(self, job: Job, exc: RateDeferred) -> None:
+        # Nothing was generated yet: the worker is given back and the job parks until the governor
+        # expects its turn. It keeps its ticket, so it stays in the round-robin queue meanwhile
+        # (wake-ups follow queue order, not one shared timeout)
+        job.status = "queued"
+        job.started_at = None
+        job.rate_ticket = exc.ticket
+        job._on_rate_wait(exc.wait, exc.ahead)
+        with self._lock:
+            self._stats["deferred"] += 1
+        metrics.inc("jobs_total", result="deferred")
+        self._park(job, time.time() + exc.wait)
+
+    def _park(self, job: Job, until: float) -> None:
+        remaining = until - time.time()
+        if remaining <= 0:
+            self._pool.submit(self._run, job)
+            return
+        governor = get_governor()
+        if governor is not None and job.rate_ticket is not None:
+            governor.keep(job.rate_ticket)
+        # Heartbeats well inside the stale window keep the parked ticket in the queue
+        timer = threading.Timer(min(remaining, STALE_SECONDS / 3), self._park, (job, until))
+        timer.daemon = True
+        timer.start()
+
+    def _record(self, job: Job, client: LLMClient) -> None:
+        library = get_persona_library()
+        if library is None or job.bundle is None or not job.bundle.personas:
+            return
+        try:
+            generation_id = library.record(job.bundle, job.product, job.target, user=job.user, mode=job.mode,
+                                           provider=client.last_provider, model=client.model_for(client.last_provider))
+        except sqlite3.Error:
+            # The library is a convenience; a write failure must not fail the generation
+            return
+        from similarity import get_similarity_index
+
+        index = get_similarity_index()
+        if index is not None:
+            index.add(generation_id, job.product, job.target, len(job.bundle.personas))
+
+    def _expire(self) -> None:
+        # Caller holds the lock
+        cutoff = time.time() - self.ttl_seconds
+        for job_id in [j.id for j in self._jobs.values() if j.done and (j.finished_at or 0) < cutoff]:
+            del self._jobs[job_id]
+
+
+_manager: Optional[JobManager] = None
+_manager_lock = threading.Lock()
+
+
+def get_job_manager() -> JobManager:
+    """Process-wide job manager, so every Streamlit session shares the concurrency cap"""
+    global _manager
+    with _manager_lock:
+        if _manager is None:
+            _manager = JobManager(
+                max_workers=int(os.getenv("JOBS_MAX_WORKERS", "4")),
+                ttl_seconds=float(os.getenv("JOBS_TTL", "3600")),
+                max_rate_wait=float(os.getenv("JOBS_MAX_RATE_WAIT", "1")),
+            )
+        return _manager
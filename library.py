@@ -0,0 +1,206 @@
+from __future__ import annotations
+import hashlib
+import os
+import re
+import sqlite3
+import threading
+import time
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+from persona_schema import Persona, PersonaBundle
+from utils import env_flag
+
+
+_TOKEN_RE = re.compile(r"\w+", re.UNICODE)
+
+# Columns indexed by FTS5; list fields are flattened to one line per item
+FTS_COLUMNS = ("name", "occupation", "motivations", "frustrations", "channels", "summary", "creative_brief")
+
+
+def fts_query(text: str) -> str:
+    """User text -> safe FTS5 query: every word must match, as a prefix ("moto" finds "motivación")"""
+    return " ".join(f'"{token}"*' for token in _TOKEN_RE.findall(text.lower()))
+
+
+def _fts_row(p: Persona) -> Tuple[str, ...]:
+    return (
+        p.name,
+        p.occupation or "",
+        "\n".join(p.motivations),
+        "\n".join(p.frustrations),
+        "\n".join(p.preferred_channels),
+        p.summary or "",
+        p.creative_brief or "",
+    )
+
+
+class PersonaLibrary:
+    """Every generated bundle, persisted in SQLite with an FTS5 index for search.
+
+    Personas are stored as validated JSON, so reusing one is a row read plus
+    ``model_validate_json`` instead of an LLM call.
+    """
+
+    def __init__(self, db_path: str):
+        self.db_path = db_path
+        self._lock = threading.Lock()
+        directory = os.path.dirname(db_path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._conn = sqlite3.connect(db_path, check_same_thread=False, timeout=5)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript(
+            "CREATE TABLE IF NOT EXISTS generations ("
+            " id INTEGER PRIMARY KEY, created_at REAL NOT NULL, user TEXT, product TEXT NOT NULL,"
+            " target TEXT NOT NULL, num_personas INTEGER NOT NULL, mode TEXT, provider TEXT, model TEXT,"
+            " bundle_hash TEXT NOT NULL);"
+            "CREATE UNIQUE INDEX IF NOT EXISTS idx_generations_hash ON generations(bundle_hash);"
+            "CREATE TABLE IF NOT EXISTS personas ("
+            " id INTEGER PRIMARY KEY, generation_id INTEGER NOT NULL REFERENCES generations(id),"
+            " position INTEGER NOT NULL, created_at REAL NOT NULL, user TEXT, name TEXT NOT NULL,"
+            " age_range TEXT, occupation TEXT, location TEXT, payload TEXT NOT NULL);"
+            "CREATE INDEX IF NOT EXISTS idx_personas_generation ON personas(generation_id);"
+            "CREATE INDEX IF NOT EXISTS idx_personas_user ON personas(user, id);"
+            "CREATE INDEX IF NOT EXISTS idx_personas_age ON personas(age_range, id);"
+            # Contentless: the text lives in personas.payload, the index only maps terms to rowids
+            "CREATE VIRTUAL TABLE IF NOT EXISTS personas_fts USING fts5("
+            + ", ".join(FTS_COLUMNS)
+            + ", content='', tokenize='unicode61 remove_diacritics 2');"
+        )
+        self._conn.commit()
+
+    def record(self, bundle: PersonaBundle, product: str, target: str, user: Optional[str] = None,
+               mode: Optional[str] = None, provider: Optional[str] = None, model: Optional[str] = None) -> int:
+        """Store a generation and its personas; the same bundle twice (cache hits) is stored once"""
+        payloads = [p.model_dump_json() for p in bundle.personas]
+        bundle_hash = hashlib.sha256("\n".join([product, target, *payloads]).encode("utf-8")).hexdigest()
+        now = time.time()
+        with self._lock, self._conn:
+            row = self._conn.execute("SELECT id FROM generations WHERE bundle_hash = ?", (bundle_hash,)).fetchone()
+            if row is not None:
+                return row[0]
+            generation_id = self._conn.execute(
+                "INSERT INTO generations (created_at, user, product, target, num_personas, mode, provider, model,"
+                " bundle_hash) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (now, user, product, target, len(payloads), mode, provider, model, bundle_hash),
+            ).lastrowid
+            for position, (p, payload) in enumerate(zip(bundle.personas, payloads)):
+                persona_id = self._conn.execute(
+                    "INSERT INTO personas (generation_id, position, created_at, user, name, age_range, occupation,"
+                    " location, payload) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                    (generation_id, position, now, user, p.name, p.age_range, p.occupation, p.location, payload),
+                ).lastrowid
+                self._conn.execute(
+                    f"INSERT INTO personas_fts (rowid, {', '.join(FTS_COLUMNS)}) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                    (persona_id, *_fts_row(p)),
+                )
+            return generation_id
+
+    def search(self, query: str = "", user: Optional[str] = None, age_range: Optional[str] = None,
+               page: int = 0, page_size: int = 20) -> Tuple[List[Dict[str, Any]], int]:
+        """One page of matches (best match first with a query, newest first otherwise) and the total count.
+
+        Rows carry display columns only; call ``get_personas`` for the ones the user opens.
+        """
+        filters: List[str] = []
+        params: List[Any] = []
+        if user:
+            filters.append("p.user = ?")
+            params.append(user)
+        if age_range:
+            filters.append("p.age_range = ?")
+            params.append(age_range)
+        columns = ("p.id, p.name, p.age_range, p.occupation, p.location, p.created_at, p.user, g.product, g.target"
+                   " FROM personas p JOIN generations g ON g.id = p.generation_id")
+        match = fts_query(query)
+        if match:
+            # bm25 ranking happens inside FTS5; the filters apply to the (usually small) match set
+            clause = " ".join(f"AND {f}" for f in filters)
+            count_sql = (f"SELECT COUNT(*) FROM personas p WHERE p.id IN"
+                         f" (SELECT rowid FROM personas_fts WHERE personas_fts MATCH ?) {clause}")
+            sql = (f"SELECT {columns} JOIN (SELECT rowid, rank FROM personas_fts WHERE personas_fts MATCH ?) f"
+                   f" ON f.rowid = p.id WHERE 1 {clause} ORDER BY f.rank LIMIT ? OFFSET ?")
+            params = [match, *params]
+        else:
+            # Newest first straight from the primary key (or idx_personas_user / idx_personas_age)
+            clause = f"WHERE {' AND '.join(filters)}" if filters else ""
+            count_sql = f"SELECT COUNT(*) FROM personas p {clause}"
+            sql = f"SELECT {columns} {clause} ORDER BY p.id DESC LIMIT ? OFFSET ?"
+        with self._lock:
+            total = self._conn.execute(count_sql, params).fetchone()[0]
+            rows = self._conn.execute(sql, [*params, page_size, page * page_size]).fetchall()
+        keys = ("id", "name", "age_range", "occupation", "location", "created_at", "user", "product", "target")
+        return [dict(zip(keys, row)) for row in rows], total
+
+    def get_personas(self, persona_ids: List[int]) -> List[Persona]:
+        if not persona_ids:
+            return []
+        placeholders = ",".join("?" for _ in persona_ids)
+        with self._lock:
+            rows = self._conn.execute(
+                f"SELECT id, payload FROM personas WHERE id IN ({placeholders})", persona_ids
+            ).fetchall()
+        by_id = {row[0]: Persona.model_validate_json(row[1]) for row in rows}
+        return [by_id[i] for i in persona_ids if i in by_id]
+
+    def get_generation(self, generation_id: int) -> Optional[Dict[str, Any]]:
+        """A stored generation with its inputs and the bundle in original order"""
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT product, target, created_at, user FROM generations WHERE id = ?", (generation_id,)
+            ).fetchone()
+            payloads = self._conn.execute(
+                "SELECT payload FROM personas WHERE generation_id = ? ORDER BY position", (generation_id,)
+            ).fetchall()
+        if row is None:
+            return None
+        bundle = PersonaBundle(personas=[Persona.model_validate_json(p[0]) for p in payloads])
+        return {"product": row[0], "target": row[1], "created_at": row[2], "user": row[3], "bundle": bundle}
+
+    def requests(self, batch_size: int = 5000) -> Iterator[Tuple[int, str, str, int]]:
+        """(generation id, product, target, num personas) for every stored generation, oldest first"""
+        last_id = 0
+        while True:
+            with self._lock:
+                rows = self._conn.execute(
+                    "SELECT id, product, target, num_personas FROM generations WHERE id > ? ORDER BY id LIMIT ?",
+                    (last_id, batch_size),
+                ).fetchall()
+            if not rows:
+                return
+            yield from rows
+            last_id = rows[-1][0]
+
+    def age_ranges(self, limit: int = 50) -> List[str]:
+        # Served from idx_personas_age
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT DISTINCT age_range FROM personas WHERE age_range IS NOT NULL ORDER BY age_range LIMIT ?",
+                (limit,),
+            ).fetchall()
+        return [row[0] for row in rows]
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            generations = self._conn.execute("SELECT COUNT(*) FROM generations").fetchone()[0]
+            personas = self._conn.execute("SELECT COUNT(*) FROM personas").fetchone()[0]
+        return {"generations": generations, "personas": personas}
+
+
+_library: Optional[PersonaLibrary] = None
+_library_lock = threading.Lock()
+
+
+def get_persona_library() -> Optional[PersonaLibrary]:
+    """Process-wide library (None when disabled or the database cannot be opened)"""
+    global _library
+    if not env_flag("LIBRARY_ENABLED", True):
+        return None
+    with _library_lock:
+        if _library is None:
+            try:
+                _library = PersonaLibrary(os.getenv("LIBRARY_PATH", os.path.join(".cache", "persona_library.sqlite3")))
+            except sqlite3.Error:
+                return None
+        return _library
@@ -1,81 +1,823 @@
 from __future__ import annotations
+import asyncio
 import json
 import os
-from typing import Any, Dict
+import time
+from typing import TYPE_CHECKING, Any, Callable, Dict, Iterator, List, Optional, Tuple
 
-import httpx
-from openai import OpenAI
+import metrics
+from cache import get_response_cache, make_cache_key
+from clients import get_http_client, get_openai_client, new_async_http_client, new_async_openai_client
+from extraction import parse_lenient, personas_from_text
+from governor import get_governor
+from local_provider import get_local_model
+from ratelimit import TokenBucket
+from router import get_router
+from prompt import (
+    SYSTEM_PROMPT,
+    adaptive_max_tokens,
+    build_refine_prompt,
+    build_regenerate_prompt,
+    build_seed_prompt,
+    build_segment_prompt,
+    build_single_persona_prompt,
+    build_topup_prompt,
+    build_user_prompt,
+    observe_persona_tokens,
+    prompt_report,
+)
+from persona_schema import Persona, PersonaBundle, bundle_json_schema
+from streaming import IncrementalPersonaParser
+from utils import env_flag
 
-from prompt import SYSTEM_PROMPT, build_user_prompt
-from persona_schema import PersonaBundle
+if TYPE_CHECKING:
+    # The SDKs load on the first call through clients.py, not when the app starts
+    import httpx
+    from openai import AsyncOpenAI, OpenAI
+
+    from diversity import DiversityReport
+
+
+OPENAI_BASE_URL = "https://api.deepseek.com"
+HF_API_URL = "https://api-inference.huggingface.co/models"
+SEED_MAX_TOKENS = 400
+# A seed is a label plus a one-line description
+SEED_TOKENS_PER_SEED = 40
 
 
 class LLMClient:
-    def __init__(self) -> None:
+    def __init__(self, user: Optional[str] = None) -> None:
         self.provider = os.getenv("LLM_PROVIDER", "openai").strip().lower()
-        if self.provider not in {"openai", "huggingface"}:
-            raise ValueError("LLM_PROVIDER debe ser 'openai' o 'huggingface'")
+        if self.provider not in {"openai", "huggingface", "local"}:
+            raise ValueError("LLM_PROVIDER debe ser 'openai', 'huggingface' o 'local'")
 
         self.openai_model = os.getenv("OPENAI_MODEL", "gpt-4o-mini")
         self.hf_model = os.getenv("HF_MODEL", "meta-llama/Llama-3.1-8B-Instruct")
+        # GGUF file for the offline llama.cpp provider
+        self.local_model_path = os.getenv("LOCAL_MODEL_PATH", "")
+        self.local_model = os.getenv("LOCAL_MODEL_NAME") or os.path.basename(self.local_model_path)
+        self.temperature = float(os.getenv("LLM_TEMPERATURE", "0.7"))
+        # Overridable endpoints (self-hosted gateways, the local benchmark mock server)
+        self.openai_base_url = os.getenv("OPENAI_BASE_URL", OPENAI_BASE_URL)
+        self.hf_api_url = os.getenv("HF_API_URL", HF_API_URL).rstrip("/")
+        self.compact_schema = env_flag("LLM_COMPACT_SCHEMA")
+        # TGI-compatible chat route with the PersonaBundle schema as a decoding grammar (HF_CHAT_URL overrides
+        # the route, e.g. for a dedicated endpoint)
+        self.hf_structured = env_flag("HF_STRUCTURED")
+        self.hf_chat_url = os.getenv("HF_CHAT_URL", "")
+        # Token usage reported by the provider for the last call, plus estimated prompt sizes
+        self.last_usage: Dict[str, int] = {}
+        # Response cache entry of the last bundle (None without a cache or when it was not stored)
+        # and whether it was a hit
+        self.last_cache_key: Optional[str] = None
+        self.last_cache_hit = False
+        # Calls are charged to ``user``'s budget in the rate governor; ``on_rate_wait(seconds, ahead)``
+        # is told the expected wait while a call is queued there
+        self.user = user
+        self.on_rate_wait: Optional[Callable[[float, int], None]] = None
+        # Until a call is granted, a governor wait longer than this raises RateDeferred instead of
+        # blocking (set by callers that would rather requeue, e.g. the job pool)
+        self.rate_defer: Optional[float] = None
+        # Governor ticket of a deferred call (RateDeferred.ticket): the next governed call resumes its place
+        self.rate_ticket: Optional[int] = None
+        # Local limit on provider calls (e.g. batch.py --rpm): every attempt takes one token, retries included
+        self.call_limiter: Optional[TokenBucket] = None
+
+        self._openai: Optional[OpenAI] = None
+        self._async_openai: Optional[AsyncOpenAI] = None
+        self._async_http: Optional[httpx.AsyncClient] = None
+        if self.provider == "openai" and not os.getenv("OPENAI_API_KEY"):
+            raise ValueError("Falta OPENAI_API_KEY")
+        if self.provider == "huggingface" and not os.getenv("HF_API_TOKEN"):
+            raise ValueError("Falta HF_API_TOKEN")
+        if self.provider == "local" and not self.local_model_path:
+            raise ValueError("Falta LOCAL_MODEL_PATH")
+
+        # The other provider is a failover target when its credentials are configured too
+        self.providers = [self.provider]
+        if env_flag("LLM_FAILOVER", True):
+            credentials = {"openai": "OPENAI_API_KEY", "huggingface": "HF_API_TOKEN", "local": "LOCAL_MODEL_PATH"}
+            self.providers += [p for p, env in credentials.items() if p != self.provider and os.getenv(env)]
+        self._router = get_router({p: self.model_for(p) for p in self.providers})
+        # Provider that served the last completion (differs from ``provider`` after a failover)
+        self.last_provider = self.provider
+
+    @property
+    def model(self) -> str:
+        return self.model_for(self.provider)
+
+    def model_for(self, provider: str) -> str:
+        if provider == "local":
+            return self.local_model
+        return self.openai_model if provider == "openai" else self.hf_model
+
+    def generate_personas(self, product_description: str, target_market: str, num_personas: int,
+                          fresh: bool = False) -> PersonaBundle:
+        """Generate a bundle, serving repeated requests from the response cache.
+
+        With ``fresh=True`` the cache lookup is skipped (the new result still refreshes it).
+        """
+        user_prompt = self._user_prompt(product_description, target_market, num_personas)
+        cache = get_response_cache()
+        key = make_cache_key(self.provider, self.model, self.temperature, num_personas, user_prompt)
+        cached = self._cache_lookup(cache, key, fresh, "full", num_personas)
+        if cached is not None:
+            return cached
+
+        self.last_usage = dict(prompt_report(user_prompt, self.compact_schema))
+        started = time.perf_counter()
+        personas = self._salvage(self._complete(user_prompt, adaptive_max_tokens(self.model, num_personas), num_personas))
+        personas += self._top_up(product_description, target_market, num_personas, personas)
+        bundle = PersonaBundle(personas=personas)
+        latency = time.perf_counter() - started
+        self._cache_store(cache, key, bundle, num_personas, latency)
+        self._log_request("full", num_personas, len(bundle.personas), latency)
+        return bundle
+
+    def stream_personas(self, product_description: str, target_market: str, num_personas: int,
+                        fresh: bool = False) -> Iterator[Persona]:
+        """Yield each persona as soon as its JSON object is complete and valid.
+
+        The full bundle is stored in the response cache once the stream ends.
+        """
+        user_prompt = self._user_prompt(product_description, target_market, num_personas)
+        cache = get_response_cache()
+        key = make_cache_key(self.provider, self.model, self.temperature, num_personas, user_prompt)
+        cached = self._cache_lookup(cache, key, fresh, "stream", num_personas)
+        if cached is not None:
+            yield from cached.personas
+            return
+
+        self.last_usage = dict(prompt_report(user_prompt, self.compact_schema))
+        budget = adaptive_max_tokens(self.model, num_personas)
+        # A stream cannot fail over half-way, so the router only picks the healthiest provider
+        provider = self._router.pick(self.provider)
+        self.last_provider = provider
+        try:
+            # Charged to the provider actually called, as the router's before hook does
+            self._govern(provider, user_prompt, budget)
+        except BaseException:
+            self._router.release(provider)
+            raise
+        started = time.perf_counter()
+        parser = IncrementalPersonaParser()
+        if provider == "openai":
+            chunks = self._stream_openai(user_prompt, budget)
+        elif provider == "local":
+            chunks = self._stream_local(user_prompt, budget)
+        else:
+            chunks = self._stream_hf(user_prompt, budget, num_personas)
+        first_persona = True
+        try:
+            for chunk in chunks:
+                for persona in parser.feed(chunk):
+                    if first_persona:
+                        first_persona = False
+                        metrics.observe("pipeline_stage_seconds", time.perf_counter() - started, stage="first_persona",
+                                        provider=provider, model=self.model_for(provider))
+                    yield persona
+        except Exception as exc:
+            self._router.record(provider, time.perf_counter() - started, False, exc)
+            metrics.inc("llm_errors_total", provider=provider, model=self.model_for(provider), type=type(exc).__name__)
+            raise
+        finally:
+            # A consumer that stops early (Streamlit rerun) closes the generator with no outcome:
+            # the half-open probe must still be released or the provider stays open for good
+            self._router.release(provider)
+            close = getattr(chunks, "close", None)
+            if close is not None:
+                close()
+        self._router.record(provider, time.perf_counter() - started, True)
+        metrics.observe("llm_request_seconds", time.perf_counter() - started, provider=provider, model=self.model_for(provider))
+
+        personas = list(parser.personas)
+        if not personas:
+            # Documents the scanner could not split (fences, truncation, single quotes) go through repair
+            personas = self._salvage(parser.text)
+            yield from personas
+        extra = self._top_up(product_description, target_market, num_personas, personas)
+        yield from extra
+        personas += extra
+        latency = time.perf_counter() - started
+        self._cache_store(cache, key, PersonaBundle(personas=personas), num_personas, latency)
+        self._log_request("stream", num_personas, len(personas), latency)
+
+    def generate_personas_fanout(self, product_description: str, target_market: str, num_personas: int,
+                                 fresh: bool = False, max_retries: int = 2) -> PersonaBundle:
+        """Plan one segment seed per persona, then generate every persona concurrently.
+
+        Only the slots that fail to parse or validate are retried, up to ``max_retries`` times.
+        """
+        user_prompt = self._user_prompt(product_description, target_market, num_personas)
+        cache = get_response_cache()
+        key = make_cache_key(self.provider, self.model, self.temperature, num_personas, "fanout\n" + user_prompt)
+        cached = self._cache_lookup(cache, key, fresh, "fanout", num_personas)
+        if cached is not None:
+            return cached
+
+        self.last_usage = dict(prompt_report(user_prompt, self.compact_schema))
+        started = time.perf_counter()
+        personas = asyncio.run(self._fanout(product_description, target_market, num_personas, max_retries))
+        if not personas:
+            raise ValueError("No se pudo generar ninguna persona")
+        bundle = PersonaBundle(personas=personas)
+        latency = time.perf_counter() - started
+        self._cache_store(cache, key, bundle, num_personas, latency)
+        self._log_request("fanout", num_personas, len(bundle.personas), latency)
+        return bundle
+
+    def regenerate_persona(self, product_description: str, target_market: str, personas: List[Persona],
+                           index: int) -> Persona:
+        """Replace ``personas[index]`` with a new persona that does not overlap the others.
+
+        Only one persona is requested (≈1/N of the bundle's output tokens); the rest of the
+        bundle is sent as one-line digests.
+        """
+        others = [persona_digest(p) for i, p in enumerate(personas) if i != index]
+        prompt = build_regenerate_prompt(product_description, target_market, others, compact=self.compact_schema)
+        return self._single_persona(prompt, "regenerate")
+
+    def diversify(self, product_description: str, target_market: str, bundle: PersonaBundle,
+                  min_score: Optional[float] = None, pair_threshold: Optional[float] = None,
+                  max_rounds: Optional[int] = None) -> Tuple[PersonaBundle, DiversityReport]:
+        """Regenerate only the redundant personas of a bundle that scores below ``min_score``.
+
+        A round is kept only if it raises the score. Usage of the extra calls is added to
+        ``last_usage``, and the improved bundle replaces the cached one. Bundles served from
+        the cache were already diversified and are scored only.
+        """
+        from diversity import analyze
+
+        min_score = float(os.getenv("DIVERSITY_MIN_SCORE", "0.65")) if min_score is None else min_score
+        pair_threshold = float(os.getenv("DIVERSITY_PAIR_THRESHOLD", "0.8")) if pair_threshold is None else pair_threshold
+        max_rounds = int(os.getenv("DIVERSITY_ROUNDS", "1")) if max_rounds is None else max_rounds
+        report = analyze(bundle, pair_threshold)
+        if self.last_cache_hit:
+            return bundle, report
+
+        usage = dict(self.last_usage)
+        improved = False
+        started = time.perf_counter()
+        for _ in range(max_rounds):
+            targets = report.to_regenerate(min_score)
+            if not targets:
+                break
+            personas = list(bundle.personas)
+            try:
+                for index in targets:
+                    personas[index] = self.regenerate_persona(product_description, target_market, personas, index)
+                    for field, value in self.last_usage.items():
+                        usage[field] = usage.get(field, 0) + value
+            except Exception:
+                # The bundle is already usable; a failed rewrite keeps it as it is
+                break
+            metrics.inc("diversity_regenerated_total", amount=len(targets), provider=self.last_provider)
+            candidate = PersonaBundle(personas=personas)
+            new_report = analyze(candidate, pair_threshold)
+            if new_report.score <= report.score:
+                break
+            bundle, report, improved = candidate, new_report, True
+        self.last_usage = usage
+        cache = get_response_cache()
+        if improved and cache is not None and self.last_cache_key is not None:
+            cache.set(self.last_cache_key, bundle.model_dump_json(), latency=time.perf_counter() - started,
+                      tokens=usage.get("total_tokens", 0))
+        return bundle, report
+
+    def refine_persona(self, product_description: str, target_market: str, personas: List[Persona],
+                       index: int, instruction: str) -> Persona:
+        """Apply ``instruction`` to ``personas[index]`` and return the edited persona"""
+        others = [persona_digest(p) for i, p in enumerate(personas) if i != index]
+        current = personas[index].model_dump_json(exclude_none=True)
+        prompt = build_refine_prompt(
+            product_description, target_market, current, instruction, others, compact=self.compact_schema,
+        )
+        return self._single_persona(prompt, "refine")
+
+    def _single_persona(self, prompt: str, mode: str) -> Persona:
+        self.last_usage = dict(prompt_report(prompt, self.compact_schema))
+        started = time.perf_counter()
+        persona = _first_persona(self._complete(prompt, adaptive_max_tokens(self.model, 1), 1))
+        self._log_request(mode, 1, 1, time.perf_counter() - started)
+        return persona
+
+    def plan_seeds(self, product_description: str, target_market: str, num_personas: int,
+                   personas_per_seed: int = 1) -> List[Dict[str, str]]:
+        """Ask for ``num_personas`` distinct segment seeds (label + one-line description)"""
+        try:
+            seed_prompt = build_seed_prompt(product_description, target_market, num_personas, personas_per_seed)
+            max_tokens = max(SEED_MAX_TOKENS, SEED_TOKENS_PER_SEED * num_personas)
+            data = parse_lenient(self._complete(seed_prompt, max_tokens))
+            raw = data.get("seeds", []) if isinstance(data, dict) else data
+        except ValueError:
+            raw = []
+        seeds = [
+            {"label": str(s.get("label", "")).strip(), "description": str(s.get("description", "")).strip()}
+            for s in raw if isinstance(s, dict) and s.get("label")
+        ][:num_personas]
+        while len(seeds) < num_personas:
+            seeds.append({"label": f"Segmento {len(seeds) + 1}", "description": ""})
+        return seeds
+
+    def generate_study(self, product_description: str, target_market: str, num_personas: int,
+                       on_personas: Callable[[int, Dict[str, str], List[Persona]], None],
+                       chunk_size: int = 5, max_retries: int = 2) -> int:
+        """Generate a large study in chunks of ``chunk_size`` personas, one planned segment per chunk.
+
+        Chunks run concurrently and never overlap: each gets its own segment seed and is told the
+        other segments to avoid. ``on_personas(index, seed, personas)`` receives every chunk as soon as
+        it is valid, so the caller can write it to disk instead of holding the study in memory.
+        Short chunks are re-asked only for their missing personas, delivered under the same ``index``.
+        Returns the personas delivered.
+        """
+        chunk_size = max(1, chunk_size)
+        self.last_usage = {}
+        started = time.perf_counter()
+        delivered = asyncio.run(
+            self._study(product_description, target_market, num_personas, on_personas, chunk_size, max_retries)
+        )
+        if not delivered:
+            raise ValueError("No se pudo generar ninguna persona")
+        self._log_request("study", num_personas, delivered, time.perf_counter() - started)
+        return delivered
+
+    async def _study(self, product_description: str, target_market: str, num_personas: int,
+                     on_personas: Callable[[int, Dict[str, str], List[Persona]], None],
+                     chunk_size: int, max_retries: int) -> int:
+        sizes = [min(chunk_size, num_personas - start) for start in range(0, num_personas, chunk_size)]
+        seeds = await asyncio.to_thread(self.plan_seeds, product_description, target_market, len(sizes), chunk_size)
+        labels = [s["label"] for s in seeds]
+        semaphore = asyncio.Semaphore(int(os.getenv("STUDY_CONCURRENCY", "4")))
+        names: List[List[str]] = [[] for _ in sizes]
+        errors: List[Exception] = []
+
+        async def run_chunk(index: int) -> None:
+            seed = seeds[index]
+            missing = sizes[index] - len(names[index])
+            prompt = build_segment_prompt(
+                product_description, target_market, seed["label"], seed["description"], missing,
+                avoid=[label for i, label in enumerate(labels) if i != index], existing_names=names[index],
+                compact=self.compact_schema,
+            )
+            async with semaphore:
+                try:
+                    budget = adaptive_max_tokens(self.model, missing)
+                    personas = self._salvage(await self._acomplete(prompt, budget, missing))[:missing]
+                except Exception as exc:
+                    # Retried in the next round; kept to explain a study that produced nothing
+                    errors.append(exc)
+                    metrics.inc("generation_part_errors_total", mode="study", type=type(exc).__name__)
+                    return
+            if personas:
+                # Runs on the event loop thread, so chunks are handed over one at a time
+                names[index] += [p.name for p in personas]
+                on_personas(index, seed, personas)
+
+        pending = list(range(len(sizes)))
+        try:
+            for _ in range(max_retries + 1):
+                await asyncio.gather(*(run_chunk(i) for i in pending))
+                pending = [i for i in pending if len(names[i]) < sizes[i]]
+                if not pending:
+                    break
+        finally:
+            await self._aclose()
+        delivered = sum(len(n) for n in names)
+        if not delivered and errors:
+            raise errors[-1]
+        return delivered
+
+    async def _fanout(self, product_description: str, target_market: str, num_personas: int,
+                      max_retries: int) -> List[Persona]:
+        seeds = await asyncio.to_thread(self.plan_seeds, product_description, target_market, num_personas)
+        labels = [s["label"] for s in seeds]
+        semaphore = asyncio.Semaphore(int(os.getenv("LLM_FANOUT_CONCURRENCY", "4")))
+        results: List[Optional[Persona]] = [None] * num_personas
+        errors: List[Exception] = []
+
+        async def run_slot(index: int) -> None:
+            seed = seeds[index]
+            prompt = build_single_persona_prompt(
+                product_description, target_market, seed["label"], seed["description"],
+                avoid=[label for i, label in enumerate(labels) if i != index], compact=self.compact_schema,
+            )
+            async with semaphore:
+                try:
+                    text = await self._acomplete(prompt, adaptive_max_tokens(self.model, 1), 1)
+                    results[index] = _first_persona(text)
+                except Exception as exc:
+                    errors.append(exc)
+                    metrics.inc("generation_part_errors_total", mode="fanout", type=type(exc).__name__)
+                    results[index] = None
+
+        pending = list(range(num_personas))
+        try:
+            for _ in range(max_retries + 1):
+                await asyncio.gather(*(run_slot(i) for i in pending))
+                pending = [i for i in pending if results[i] is None]
+                if not pending:
+                    break
+        finally:
+            await self._aclose()
+        personas = [p for p in results if p is not None]
+        if not personas and errors:
+            raise errors[-1]
+        return personas
+
+    def _user_prompt(self, product_description: str, target_market: str, num_personas: int) -> str:
+        with metrics.stage("prompt_build"):
+            return build_user_prompt(product_description, target_market, num_personas, compact=self.compact_schema)
+
+    def _cache_lookup(self, cache: Any, key: str, fresh: bool, mode: str, num_personas: int) -> Optional[PersonaBundle]:
+        self.last_cache_key = key if cache is not None else None
+        self.last_cache_hit = False
+        if cache is None or fresh:
+            return None
+        cached = cache.get(key)
+        metrics.inc("response_cache_total", result="miss" if cached is None else "hit")
+        if cached is None:
+            return None
+        self.last_cache_hit = True
+        self.last_usage = {}
+        bundle = PersonaBundle.model_validate_json(cached)
+        self._log_request(mode, num_personas, len(bundle.personas), 0.0, cache_hit=True)
+        return bundle
+
+    def _cache_store(self, cache: Any, key: str, bundle: PersonaBundle, num_personas: int, latency: float) -> None:
+        # A short bundle is returned but never cached: the next request asks again instead of
+        # replaying the gap for the whole TTL
+        if cache is None or len(bundle.personas) != num_personas:
+            self.last_cache_key = None
+            return
+        cache.set(key, bundle.model_dump_json(), latency=latency, tokens=self.last_usage.get("total_tokens", 0))
+
+    def _log_request(self, mode: str, num_personas: int, returned: int, latency: float, cache_hit: bool = False) -> None:
+        if not metrics.enabled():
+            return
+        if not cache_hit:
+            metrics.observe("generation_seconds", latency, mode=mode, provider=self.last_provider,
+                            model=self.model_for(self.last_provider))
+        metrics.log_request(
+            event="generate",
+            mode=mode,
+            provider=self.last_provider,
+            model=self.model_for(self.last_provider),
+            num_personas=num_personas,
+            personas=returned,
+            latency_seconds=round(latency, 3),
+            cache_hit=cache_hit,
+            usage=self.last_usage,
+        )
+
+    def _salvage(self, text: str) -> List[Persona]:
+        """Keep every valid persona in ``text``; unparseable output yields an empty list"""
+        try:
+            return personas_from_text(text)[0]
+        except ValueError:
+            return []
+
+    def _top_up(self, product_description: str, target_market: str, num_personas: int,
+                personas: List[Persona]) -> List[Persona]:
+        """Request only the personas missing from a partially valid answer"""
+        extra: List[Persona] = []
+        for _ in range(int(os.getenv("LLM_TOPUP_ROUNDS", "1"))):
+            missing = num_personas - len(personas) - len(extra)
+            if missing <= 0:
+                break
+            prompt = build_topup_prompt(
+                product_description, target_market, missing, [p.name for p in personas + extra],
+                compact=self.compact_schema,
+            )
+            try:
+                extra += self._salvage(self._complete(prompt, adaptive_max_tokens(self.model, missing), missing))[:missing]
+            except Exception:
+                # Keep what was already salvaged; an empty result is reported upstream
+                if personas or extra:
+                    break
+                raise
+        return extra
+
+    def _complete(self, user_prompt: str, max_tokens: int, personas: Optional[int] = None) -> str:
+        """Single blocking completion with retries and failover; returns raw text.
+
+        ``personas`` is the number of personas the answer must hold (None for other JSON, e.g. seeds).
+        """
+        # Charged before every attempt, so retries and failover count against the budgets too
+        provider, text = self._router.call(
+            self.provider, lambda p: self._complete_on(p, user_prompt, max_tokens, personas),
+            before=lambda p: self._govern(p, user_prompt, max_tokens),
+        )
+        self.last_provider = provider
+        return text
 
-        self._openai = None
-        if self.provider == "openai":
-            api_key = os.getenv("OPENAI_API_KEY")
-            if not api_key:
-                raise ValueError("Falta OPENAI_API_KEY")
-            self._openai = OpenAI(api_key=api_key, base_url="https://api.deepseek.com")
-
-        if self.provider == "huggingface":
-            if not os.getenv("HF_API_TOKEN"):
-                raise ValueError("Falta HF_API_TOKEN")
-
-    def generate_personas(self, product_description: str, target_market: str, num_personas: int) -> PersonaBundle:
-        user_prompt = build_user_prompt(product_description, target_market, num_personas)
-        if self.provider == "openai":
-            return self._generate_openai(user_prompt)
-        return self._generate_hf(user_prompt)
-
-    def _generate_openai(self, user_prompt: str) -> PersonaBundle:
-        assert self._openai is not None
-        result = self._openai.chat.completions.create(
+    async def _acomplete(self, user_prompt: str, max_tokens: int, personas: Optional[int] = None) -> str:
+        provider, text = await self._router.acall(
+            self.provider, lambda p: self._acomplete_on(p, user_prompt, max_tokens, personas),
+            before=lambda p: self._agovern(p, user_prompt, max_tokens),
+        )
+        self.last_provider = provider
+        return text
+
+    def expected_wait(self, product_description: str, target_market: str, num_personas: int) -> float:
+        """Seconds the rate governor would queue a generation submitted now (0 when within budget)"""
+        governor = get_governor()
+        if governor is None:
+            return 0.0
+        user_prompt = build_user_prompt(product_description, target_market, num_personas, compact=self.compact_schema)
+        return governor.expected_wait(self.user, self.provider, _estimate_tokens(user_prompt, adaptive_max_tokens(self.model, num_personas)))
+
+    def _govern(self, provider: str, user_prompt: str, max_tokens: int) -> None:
+        # Runs outside the router's latency window, so the wait never counts as provider latency
+        if self.call_limiter is not None:
+            self.call_limiter.acquire()
+        governor = get_governor()
+        if governor is None:
+            return
+        ticket, self.rate_ticket = self.rate_ticket, None
+        waited = governor.acquire(self.user, provider, _estimate_tokens(user_prompt, max_tokens),
+                                  on_wait=self.on_rate_wait, max_wait=self.rate_defer, ticket=ticket)
+        self.rate_defer = None
+        metrics.observe("governor_wait_seconds", waited, provider=provider)
+
+    async def _agovern(self, provider: str, user_prompt: str, max_tokens: int) -> None:
+        if self.call_limiter is not None:
+            wait = self.call_limiter.try_acquire()
+            while wait > 0:
+                await asyncio.sleep(wait)
+                wait = self.call_limiter.try_acquire()
+        governor = get_governor()
+        if governor is None:
+            return
+        ticket, self.rate_ticket = self.rate_ticket, None
+        waited = await governor.aacquire(self.user, provider, _estimate_tokens(user_prompt, max_tokens),
+                                         on_wait=self.on_rate_wait, max_wait=self.rate_defer, ticket=ticket)
+        self.rate_defer = None
+        metrics.observe("governor_wait_seconds", waited, provider=provider)
+
+    def _complete_on(self, provider: str, user_prompt: str, max_tokens: int, personas: Optional[int] = None) -> str:
+        try:
+            with metrics.timer("llm_request_seconds", provider=provider, model=self.model_for(provider)):
+                if provider == "openai":
+                    return self._complete_openai(user_prompt, max_tokens)
+                if provider == "local":
+                    return self._complete_local(user_prompt, max_tokens)
+                return self._complete_hf(user_prompt, max_tokens, personas)
+        except Exception as exc:
+            metrics.inc("llm_errors_total", provider=provider, model=self.model_for(provider), type=type(exc).__name__)
+            raise
+
+    async def _acomplete_on(self, provider: str, user_prompt: str, max_tokens: int,
+                            personas: Optional[int] = None) -> str:
+        try:
+            with metrics.timer("llm_request_seconds", provider=provider, model=self.model_for(provider)):
+                if provider == "openai":
+                    return await self._acomplete_openai(user_prompt, max_tokens)
+                if provider == "local":
+                    return await self._acomplete_local(user_prompt, max_tokens)
+                return await self._acomplete_hf(user_prompt, max_tokens, personas)
+        except Exception as exc:
+            metrics.inc("llm_errors_total", provider=provider, model=self.model_for(provider), type=type(exc).__name__)
+            raise
+
+    def _openai_messages(self, user_prompt: str) -> List[Dict[str, str]]:
+        return [
+            {"role": "system", "content": SYSTEM_PROMPT},
+            {"role": "user", "content": user_prompt},
+        ]
+
+    def _record_usage(self, usage: Any) -> None:
+        if usage is None:
+            return
+        call = {field: getattr(usage, field, 0) or 0 for field in ("prompt_tokens", "completion_tokens", "total_tokens")}
+        # Prompt prefix cache hits: DeepSeek reports prompt_cache_hit_tokens, OpenAI prompt_tokens_details
+        cached = getattr(usage, "prompt_cache_hit_tokens", None)
+        if cached is None:
+            cached = getattr(getattr(usage, "prompt_tokens_details", None), "cached_tokens", None)
+        call["cached_prompt_tokens"] = cached or 0
+        self._add_usage("openai", call)
+
+    def _add_usage(self, provider: str, call: Dict[str, int]) -> None:
+        # Accumulates, so fan-out calls add up to the cost of the whole bundle
+        for field, value in call.items():
+            self.last_usage[field] = self.last_usage.get(field, 0) + value
+        metrics.record_usage(provider, self.model_for(provider), call)
+
+    def _openai_client(self) -> OpenAI:
+        if self._openai is None:
+            # Pooled client shared across instances, sessions and reruns
+            self._openai = get_openai_client(os.getenv("OPENAI_API_KEY", ""), self.openai_base_url)
+        return self._openai
+
+    def _complete_openai(self, user_prompt: str, max_tokens: int) -> str:
+        result = self._openai_client().chat.completions.create(
             model=self.openai_model,
-            messages=([
-                {"role": "system", "content": SYSTEM_PROMPT},
-                {"role": "user", "content": user_prompt},
-            ]),
+            messages=self._openai_messages(user_prompt),
             response_format={"type": "json_object"},
-            temperature=0.7,
+            temperature=self.temperature,
+            max_tokens=max_tokens,
         )
-        text = result.choices[0].message.content or "{}"
-        data = json.loads(text)
-        return PersonaBundle.model_validate(data)
+        self._record_usage(result.usage)
+        return result.choices[0].message.content or "{}"
 
-    def _generate_hf(self, user_prompt: str) -> PersonaBundle:
-        # Simple call to HF text generation inference API
+    async def _acomplete_openai(self, user_prompt: str, max_tokens: int) -> str:
+        if self._async_openai is None:
+            self._async_openai = new_async_openai_client(os.getenv("OPENAI_API_KEY", ""), self.openai_base_url)
+        result = await self._async_openai.chat.completions.create(
+            model=self.openai_model,
+            messages=self._openai_messages(user_prompt),
+            response_format={"type": "json_object"},
+            temperature=self.temperature,
+            max_tokens=max_tokens,
+        )
+        self._record_usage(result.usage)
+        return result.choices[0].message.content or "{}"
+
+    def _stream_openai(self, user_prompt: str, max_tokens: int) -> Iterator[str]:
+        stream = self._openai_client().chat.completions.create(
+            model=self.openai_model,
+            messages=self._openai_messages(user_prompt),
+            response_format={"type": "json_object"},
+            temperature=self.temperature,
+            max_tokens=max_tokens,
+            stream=True,
+            stream_options={"include_usage": True},
+        )
+        for chunk in stream:
+            if chunk.usage is not None:
+                self._record_usage(chunk.usage)
+            if chunk.choices and chunk.choices[0].delta.content:
+                yield chunk.choices[0].delta.content
+
+    def _local(self):
+        return get_local_model(self.local_model_path, compact=self.compact_schema)
+
+    def _complete_local(self, user_prompt: str, max_tokens: int) -> str:
+        text, usage = self._local().complete(user_prompt, max_tokens, self.temperature)
+        self._add_usage("local", usage)
+        return text
+
+    async def _acomplete_local(self, user_prompt: str, max_tokens: int) -> str:
+        # Waits on the model's request queue from a thread; usage is added back on the event loop
+        text, usage = await asyncio.to_thread(self._local().complete, user_prompt, max_tokens, self.temperature)
+        self._add_usage("local", usage)
+        return text
+
+    def _stream_local(self, user_prompt: str, max_tokens: int) -> Iterator[str]:
+        usage: Dict[str, int] = {}
+        yield from self._local().stream(user_prompt, max_tokens, self.temperature, usage)
+        self._add_usage("local", usage)
+
+    def _hf_request(self, user_prompt: str, max_tokens: int, stream: bool = False) -> Tuple[str, Dict[str, str], Dict[str, Any]]:
         token = os.getenv("HF_API_TOKEN")
-        model = self.hf_model
         headers = {"Authorization": f"Bearer {token}"}
         # Many instruct models respect system prefixes; we prepend system guidance
         prompt = f"[SYSTEM]\n{SYSTEM_PROMPT}\n[USER]\n{user_prompt}\n[ASSISTANT]"
         payload: Dict[str, Any] = {
             "inputs": prompt,
             "parameters": {
-                "max_new_tokens": 1200,
-                "temperature": 0.7,
+                "max_new_tokens": max_tokens,
+                "temperature": self.temperature,
                 "return_full_text": False,
             },
             "options": {"use_cache": True},
         }
-        url = f"https://api-inference.huggingface.co/models/{model}"
-        with httpx.Client(timeout=60) as client:
-            resp = client.post(url, headers=headers, json=payload)
+        if stream:
+            payload["stream"] = True
+        url = f"{self.hf_api_url}/{self.hf_model}"
+        return url, headers, payload
+
+    def _hf_chat_request(self, user_prompt: str, max_tokens: int, personas: Optional[int],
+                         stream: bool = False) -> Tuple[str, Dict[str, str], Dict[str, Any]]:
+        """TGI ``/v1/chat/completions``: the server applies the model's chat template, and a persona
+        answer is constrained to the PersonaBundle schema, so it is valid JSON in one pass"""
+        headers = {"Authorization": f"Bearer {os.getenv('HF_API_TOKEN')}"}
+        payload: Dict[str, Any] = {
+            "model": self.hf_model,
+            "messages": self._openai_messages(user_prompt),
+            "max_tokens": max_tokens,
+            "temperature": self.temperature,
+        }
+        if personas:
+            payload["response_format"] = {"type": "json_object", "value": bundle_json_schema(personas)}
+        if stream:
+            payload["stream"] = True
+            payload["stream_options"] = {"include_usage": True}
+        url = self.hf_chat_url or f"{self.hf_api_url}/{self.hf_model}/v1/chat/completions"
+        return url, headers, payload
+
+    def _hf_chat_done(self, personas: Optional[int], usage: Optional[Dict[str, Any]], finish_reason: Optional[str]) -> None:
+        if not usage:
+            return
+        call = {field: int(usage.get(field) or 0) for field in ("prompt_tokens", "completion_tokens", "total_tokens")}
+        self._add_usage("huggingface", call)
+        if personas:
+            observe_persona_tokens(self.hf_model, personas, call["completion_tokens"], truncated=finish_reason == "length")
+
+    def _hf_chat_text(self, data: Dict[str, Any], personas: Optional[int]) -> str:
+        choice = (data.get("choices") or [{}])[0]
+        self._hf_chat_done(personas, data.get("usage"), choice.get("finish_reason"))
+        return (choice.get("message") or {}).get("content") or ""
+
+    def _stream_hf(self, user_prompt: str, max_tokens: int, personas: Optional[int] = None) -> Iterator[str]:
+        if self.hf_structured:
+            yield from self._stream_hf_chat(user_prompt, max_tokens, personas)
+            return
+        # Text generation inference streams server-sent events: data:{"token": {"text": ...}}
+        url, headers, payload = self._hf_request(user_prompt, max_tokens, stream=True)
+        with get_http_client("huggingface").stream("POST", url, headers=headers, json=payload) as resp:
+            resp.raise_for_status()
+            for line in resp.iter_lines():
+                if not line.startswith("data:"):
+                    continue
+                event = json.loads(line[len("data:"):])
+                token = event.get("token") or {}
+                if token.get("text") and not token.get("special"):
+                    yield token["text"]
+
+    def _stream_hf_chat(self, user_prompt: str, max_tokens: int, personas: Optional[int]) -> Iterator[str]:
+        # OpenAI-style chunks: data:{"choices": [{"delta": {"content": ...}}]}, usage in the last one
+        url, headers, payload = self._hf_chat_request(user_prompt, max_tokens, personas, stream=True)
+        usage = None
+        finish_reason = None
+        with get_http_client("huggingface").stream("POST", url, headers=headers, json=payload) as resp:
             resp.raise_for_status()
-            outputs = resp.json()
-            if isinstance(outputs, list) and outputs and "generated_text" in outputs[0]:
-                text = outputs[0]["generated_text"]
-            else:
-                text = json.dumps(outputs)
-        data = json.loads(text)
-        return PersonaBundle.model_validate(data)
+            for line in resp.iter_lines():
+                if not line.startswith("data:"):
+                    continue
+                data = line[len("data:"):].strip()
+                if data == "[DONE]":
+                    break
+                event = json.loads(data)
+                usage = event.get("usage") or usage
+                for choice in event.get("choices") or []:
+                    finish_reason = choice.get("finish_reason") or finish_reason
+                    text = (choice.get("delta") or {}).get("content")
+                    if text:
+                        yield text
+        self._hf_chat_done(personas, usage, finish_reason)
+
+    def _complete_hf(self, user_prompt: str, max_tokens: int, personas: Optional[int] = None) -> str:
+        if self.hf_structured:
+            url, headers, payload = self._hf_chat_request(user_prompt, max_tokens, personas)
+            resp = get_http_client("huggingface").post(url, headers=headers, json=payload)
+            resp.raise_for_status()
+            return self._hf_chat_text(resp.json(), personas)
+        # Simple call to HF text generation inference API
+        url, headers, payload = self._hf_request(user_prompt, max_tokens)
+        resp = get_http_client("huggingface").post(url, headers=headers, json=payload)
+        resp.raise_for_status()
+        return _hf_text(resp.json())
+
+    async def _acomplete_hf(self, user_prompt: str, max_tokens: int, personas: Optional[int] = None) -> str:
+        if self._async_http is None:
+            self._async_http = new_async_http_client("huggingface")
+        if self.hf_structured:
+            url, headers, payload = self._hf_chat_request(user_prompt, max_tokens, personas)
+            resp = await self._async_http.post(url, headers=headers, json=payload)
+            resp.raise_for_status()
+            return self._hf_chat_text(resp.json(), personas)
+        url, headers, payload = self._hf_request(user_prompt, max_tokens)
+        resp = await self._async_http.post(url, headers=headers, json=payload)
+        resp.raise_for_status()
+        return _hf_text(resp.json())
+
+    async def _aclose(self) -> None:
+        # Async clients are bound to the event loop of the current asyncio.run()
+        if self._async_openai is not None:
+            await self._async_openai.close()
+            self._async_openai = None
+        if self._async_http is not None:
+            await self._async_http.aclose()
+            self._async_http = None
+
+
+def _estimate_tokens(user_prompt: str, max_tokens: int) -> int:
+    # Providers count max_tokens against TPM limits up front; ~4 chars/token for the prompt
+    return (len(SYSTEM_PROMPT) + len(user_prompt)) // 4 + max_tokens
+
+
+def _hf_text(outputs: Any) -> str:
+    if isinstance(outputs, list) and outputs and "generated_text" in outputs[0]:
+        return outputs[0]["generated_text"]
+    return json.dumps(outputs)
+
+
+def persona_digest(p: Persona) -> str:
+    """One line per persona for "avoid overlap" context (a fraction of its full JSON)"""
+    parts = [p.age_range, p.occupation, p.income_range]
+    head = ", ".join(part for part in parts if part)
+    digest = f"{p.name} ({head})" if head else p.name
+    if p.motivations:
+        digest += f": {p.motivations[0]}"
+    if p.preferred_channels:
+        digest += f" · canales: {', '.join(p.preferred_channels[:3])}"
+    return digest
+
+
+def _first_persona(text: str) -> Persona:
+    """Accept ``{"personas": [{...}]}``, ``[{...}]`` or a bare persona object, repairing if needed"""
+    personas, _ = personas_from_text(text)
+    if not personas:
+        raise ValueError("Respuesta sin personas")
+    return personas[0]
 
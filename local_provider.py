@@ -0,0 +1,204 @@
+from __future__ import annotations
+import os
+import queue
+import threading
+import time
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+from prompt import SYSTEM_PROMPT, static_prefix
+
+
+# Tokens at the end of the warm-up prompt (end of turn, assistant header) that real prompts do not share
+PREFIX_TAIL = 8
+_DONE = object()
+
+
+def _common_prefix(a: List[int], b: List[int]) -> int:
+    n = 0
+    for x, y in zip(a, b):
+        if x != y:
+            break
+        n += 1
+    return n
+
+
+class _Request:
+    def __init__(self, messages: List[Dict[str, str]], max_tokens: int, temperature: float):
+        self.messages = messages
+        self.max_tokens = max_tokens
+        self.temperature = temperature
+        self.chunks: "queue.Queue[Any]" = queue.Queue()
+        self.usage: Dict[str, int] = {}
+
+
+class LocalModel:
+    """GGUF instruct model on CPU through llama.cpp (``llama-cpp-python``), for offline use.
+
+    The KV cache for SYSTEM_PROMPT + the static instructions is computed once per context
+    and restored before any request whose prompt diverged from it, so a request only
+    evaluates its variable suffix. Output is constrained by llama.cpp's JSON grammar.
+    Concurrent requests share one queue served by ``parallel`` contexts; the weights are
+    memory-mapped, so extra contexts only add their KV cache.
+    """
+
+    def __init__(self, model_path: str, n_ctx: int = 8192, n_threads: Optional[int] = None,
+                 parallel: int = 1, compact: bool = False):
+        self.model_path = model_path
+        self.n_ctx = n_ctx
+        self.parallel = max(1, parallel)
+        # Cores are split between contexts; decoding is memory-bound, so oversubscribing only hurts
+        self.n_threads = max(1, (n_threads or os.cpu_count() or 1) // self.parallel)
+        self.compact = compact
+        self._queue: "queue.Queue[_Request]" = queue.Queue()
+        self._lock = threading.Lock()
+        self._workers: List[threading.Thread] = []
+        self._stats = {"requests": 0, "prefix_restores": 0, "prompt_tokens": 0, "reused_tokens": 0,
+                       "completion_tokens": 0, "decode_seconds": 0.0}
+
+    def _start(self) -> None:
+        with self._lock:
+            if self._workers:
+                return
+            for i in range(self.parallel):
+                worker = threading.Thread(target=self._serve, name=f"local-llm-{i}", daemon=True)
+                worker.start()
+                self._workers.append(worker)
+
+    def _load(self) -> Tuple[Any, Any]:
+        # Imported here: the package is optional and only needed with LLM_PROVIDER=local
+        from llama_cpp import Llama
+
+        llm = Llama(
+            model_path=self.model_path,
+            n_ctx=self.n_ctx,
+            n_threads=self.n_threads,
+            n_batch=int(os.getenv("LOCAL_BATCH", "512")),
+            verbose=False,
+        )
+        # One token is enough to get the whole prefix evaluated into the KV cache
+        llm.create_chat_completion(
+            messages=[{"role": "system", "content": SYSTEM_PROMPT},
+                      {"role": "user", "content": static_prefix(self.compact)}],
+            max_tokens=1,
+            temperature=0.0,
+        )
+        return llm, llm.save_state()
+
+    def _serve(self) -> None:
+        try:
+            llm, prefix = self._load()
+        except Exception as exc:
+            self._reject(RuntimeError(f"No se pudo cargar el modelo local: {exc}"))
+            return
+        from llama_cpp.llama_grammar import JSON_GBNF, LlamaGrammar
+
+        prefix_ids = [int(t) for t in prefix.input_ids[: max(0, prefix.n_tokens - PREFIX_TAIL)]]
+        while True:
+            request = self._queue.get()
+            try:
+                if llm.n_tokens < len(prefix_ids) or [int(t) for t in llm.input_ids[: len(prefix_ids)]] != prefix_ids:
+                    # A prompt without the shared prefix (e.g. segment seeds) overwrote it
+                    llm.load_state(prefix)
+                    with self._lock:
+                        self._stats["prefix_restores"] += 1
+                started = time.perf_counter()
+                parts: List[str] = []
+                # llama.cpp keeps the longest common token prefix already in the KV cache
+                for chunk in llm.create_chat_completion(
+                    messages=request.messages,
+                    max_tokens=request.max_tokens,
+                    temperature=request.temperature,
+                    grammar=LlamaGrammar.from_string(JSON_GBNF, verbose=False),
+                    stream=True,
+                ):
+                    text = chunk["choices"][0]["delta"].get("content")
+                    if text:
+                        parts.append(text)
+                        request.chunks.put(text)
+                # Chunks are not tokens (multi-byte characters arrive merged), so count them again
+                completion = len(llm.tokenize("".join(parts).encode("utf-8"), add_bos=False))
+                ids = [int(t) for t in llm.input_ids[: llm.n_tokens]]
+                prompt_tokens = max(0, len(ids) - completion)
+                reused = min(_common_prefix(ids, prefix_ids), prompt_tokens)
+                request.usage = {
+                    "prompt_tokens": prompt_tokens,
+                    "completion_tokens": completion,
+                    "total_tokens": prompt_tokens + completion,
+                    "cached_prompt_tokens": reused,
+                }
+                with self._lock:
+                    self._stats["requests"] += 1
+                    self._stats["prompt_tokens"] += prompt_tokens
+                    self._stats["reused_tokens"] += reused
+                    self._stats["completion_tokens"] += completion
+                    self._stats["decode_seconds"] += time.perf_counter() - started
+                request.chunks.put(_DONE)
+            except Exception as exc:
+                request.chunks.put(exc)
+
+    def _reject(self, error: Exception) -> None:
+        # A context that failed to load answers every request it takes with the reason
+        while True:
+            self._queue.get().chunks.put(error)
+
+    def stream(self, user_prompt: str, max_tokens: int, temperature: float,
+               usage: Optional[Dict[str, int]] = None) -> Iterator[str]:
+        """Yield the completion as it is generated; ``usage`` is filled in once it ends"""
+        self._start()
+        request = _Request(
+            [{"role": "system", "content": SYSTEM_PROMPT}, {"role": "user", "content": user_prompt}],
+            max_tokens, temperature,
+        )
+        self._queue.put(request)
+        while True:
+            item = request.chunks.get()
+            if item is _DONE:
+                break
+            if isinstance(item, Exception):
+                raise item
+            yield item
+        if usage is not None:
+            usage.update(request.usage)
+
+    def complete(self, user_prompt: str, max_tokens: int, temperature: float) -> Tuple[str, Dict[str, int]]:
+        usage: Dict[str, int] = {}
+        text = "".join(self.stream(user_prompt, max_tokens, temperature, usage))
+        return text, usage
+
+    def stats(self) -> Dict[str, float]:
+        with self._lock:
+            stats: Dict[str, float] = dict(self._stats)
+        stats["queued"] = self._queue.qsize()
+        stats["tokens_per_sec"] = stats["completion_tokens"] / stats["decode_seconds"] if stats["decode_seconds"] else 0.0
+        stats["reuse_rate"] = stats["reused_tokens"] / stats["prompt_tokens"] if stats["prompt_tokens"] else 0.0
+        return stats
+
+
+_models: Dict[Tuple[str, bool], LocalModel] = {}
+_models_lock = threading.Lock()
+
+
+def get_local_model(model_path: str, compact: bool = False) -> LocalModel:
+    """Process-wide model per GGUF file and schema variant, so every session shares its contexts and warm prefix"""
+    # The warm prefix is the static prompt, which differs between the full and the compact schema
+    key = (model_path, compact)
+    with _models_lock:
+        model = _models.get(key)
+        if model is None:
+            if not os.path.exists(model_path):
+                raise ValueError(f"No existe LOCAL_MODEL_PATH: {model_path}")
+            model = LocalModel(
+                model_path,
+                n_ctx=int(os.getenv("LOCAL_CTX", "8192")),
+                n_threads=int(os.getenv("LOCAL_THREADS", "0")) or None,
+                parallel=int(os.getenv("LOCAL_PARALLEL", "1")),
+                compact=compact,
+            )
+            _models[key] = model
+        return model
+
+
+def local_model_stats() -> List[Dict[str, Any]]:
+    with _models_lock:
+        models = list(_models.items())
+    return [{"model": os.path.basename(path), "compact": compact, **model.stats()} for (path, compact), model in models]
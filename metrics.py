@@ -0,0 +1,264 @@
+from __future__ import annotations
+import json
+import logging
+import os
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List, Optional, Tuple
+
+from utils import env_flag
+
+
+# Latency buckets in seconds, from sub-millisecond stages (prompt build, render) to full generations
+DEFAULT_BUCKETS = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120)
+
+logger = logging.getLogger("persona_generator.metrics")
+
+LabelKey = Tuple[Tuple[str, str], ...]
+
+
+def _enabled_from_env() -> bool:
+    return env_flag("METRICS_ENABLED")
+
+
+class _Histogram:
+    __slots__ = ("buckets", "counts", "sum", "count")
+
+    def __init__(self, buckets: Tuple[float, ...]):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float) -> None:
+        self.sum += value
+        self.count += 1
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+
+
+class MetricsRegistry:
+    """Counters and histograms rendered in the Prometheus text exposition format"""
+
+    def __init__(self, buckets: Tuple[float, ...] = DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self._lock = threading.Lock()
+        self._counters: Dict[str, Dict[LabelKey, float]] = {}
+        self._histograms: Dict[str, Dict[LabelKey, _Histogram]] = {}
+        self._help: Dict[str, str] = {}
+
+    def describe(self, name: str, text: str) -> None:
+        self._help[name] = text
+
+    def inc(self, name: str, amount: float = 1.0, **labels: str) -> None:
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            series = self._counters.setdefault(name, {})
+            series[key] = series.get(key, 0.0) + amount
+
+    def observe(self, name: str, value: float, **labels: str) -> None:
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            series = self._histograms.setdefault(name, {})
+            hist = series.get(key)
+            if hist is None:
+                hist = series[key] = _Histogram(self.buckets)
+            hist.observe(value)
+
+    def render_prometheus(self) -> str:
+        lines: List[str] = []
+        with self._lock:
+            for name, series in sorted(self._counters.items()):
+                if name in self._help:
+                    lines.append(f"# HELP {name} {self._help[name]}")
+                lines.append(f"# TYPE {name} counter")
+                for key, value in sorted(series.items()):
+                    lines.append(f"{name}{_labels(key)} {value:g}")
+            for name, series in sorted(self._histograms.items()):
+                if name in self._help:
+                    lines.append(f"# HELP {name} {self._help[name]}")
+                lines.append(f"# TYPE {name} histogram")
+                for key, hist in sorted(series.items()):
+                    cumulative = 0
+                    for bound, count in zip(hist.buckets, hist.counts):
+                        cumulative += count
+                        lines.append(f"{name}_bucket{_labels(key + (('le', f'{bound:g}'),))} {cumulative}")
+                    lines.append(f"{name}_bucket{_labels(key + (('le', '+Inf'),))} {hist.count}")
+                    lines.append(f"{name}_sum{_labels(key)} {hist.sum:.6f}")
+                    lines.append(f"{name}_count{_labels(key)} {hist.count}")
+        return "\n".join(lines) + "\n"
+
+    def reset(self) -> None:
+        with self._lock:
+            self._counters.clear()
+            self._histograms.clear()
+
+
+def _labels(key: LabelKey) -> str:
+    if not key:
+        return ""
+    body = ",".join(f'{k}="{str(v).replace(chr(92), chr(92) * 2).replace(chr(34), chr(92) + chr(34))}"' for k, v in key)
+    return "{" + body + "}"
+
+
+REGISTRY = MetricsRegistry()
+REGISTRY.describe("pipeline_stage_seconds", "Duration of each generation pipeline stage")
+REGISTRY.describe("generation_seconds", "End-to-end generation latency by mode (cache misses only)")
+REGISTRY.describe("llm_request_seconds", "Provider call latency (total)")
+REGISTRY.describe("llm_ttfb_seconds", "Time to first byte of provider responses")
+REGISTRY.describe("llm_tokens_total", "Tokens reported by the provider usage fields")
+REGISTRY.describe("llm_errors_total", "Failed provider calls by exception type")
+REGISTRY.describe("response_cache_total", "Response cache lookups by result")
+REGISTRY.describe("governor_wait_seconds", "Time calls spent queued by the rate governor")
+REGISTRY.describe("diversity_regenerated_total", "Personas regenerated because their bundle was too uniform")
+REGISTRY.describe("generation_part_errors_total", "Failed study chunks and fan-out slots by exception type")
+
+_enabled = False
+
+
+def enabled() -> bool:
+    return _enabled
+
+
+def configure(enabled: Optional[bool] = None) -> None:
+    """Re-read METRICS_ENABLED (call after load_env) or force the switch"""
+    global _enabled
+    _enabled = _enabled_from_env() if enabled is None else enabled
+    if _enabled and not logger.handlers:
+        # Request logs go to METRICS_LOG (JSON lines) or stderr
+        path = os.getenv("METRICS_LOG")
+        handler = logging.FileHandler(path, encoding="utf-8") if path else logging.StreamHandler()
+        handler.setFormatter(logging.Formatter("%(message)s"))
+        logger.addHandler(handler)
+        logger.setLevel(logging.INFO)
+        logger.propagate = False
+
+
+configure()
+
+
+class _NoopTimer:
+    __slots__ = ()
+
+    def __enter__(self) -> "_NoopTimer":
+        return self
+
+    def __exit__(self, *exc: object) -> None:
+        return None
+
+
+_NOOP = _NoopTimer()
+
+
+class _Timer:
+    __slots__ = ("name", "labels", "started", "elapsed")
+
+    def __init__(self, name: str, labels: Dict[str, str]):
+        self.name = name
+        self.labels = labels
+        self.elapsed = 0.0
+
+    def __enter__(self) -> "_Timer":
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc: object) -> None:
+        self.elapsed = time.perf_counter() - self.started
+        REGISTRY.observe(self.name, self.elapsed, **self.labels)
+
+
+def stage(name: str, **labels: str):
+    """Context manager timing one pipeline stage; a shared no-op when metrics are disabled"""
+    if not _enabled:
+        return _NOOP
+    return _Timer("pipeline_stage_seconds", {"stage": name, **labels})
+
+
+def timer(metric: str, **labels: str):
+    if not _enabled:
+        return _NOOP
+    return _Timer(metric, labels)
+
+
+def inc(name: str, amount: float = 1.0, **labels: str) -> None:
+    if _enabled:
+        REGISTRY.inc(name, amount, **labels)
+
+
+def observe(name: str, value: float, **labels: str) -> None:
+    if _enabled:
+        REGISTRY.observe(name, value, **labels)
+
+
+def record_usage(provider: str, model: str, usage: Dict[str, int]) -> None:
+    if not _enabled:
+        return
+    for field, kind in (("prompt_tokens", "prompt"), ("completion_tokens", "completion"),
+                        ("cached_prompt_tokens", "cached_prompt")):
+        if usage.get(field):
+            REGISTRY.inc("llm_tokens_total", usage[field], provider=provider, model=model, kind=kind)
+
+
+def log_request(**fields: object) -> None:
+    """One structured JSON log line per generation request"""
+    if not _enabled:
+        return
+    logger.info(json.dumps(fields, ensure_ascii=False, default=str))
+    path = os.getenv("METRICS_FILE")
+    if path:
+        write_file(path)
+
+
+_file_lock = threading.Lock()
+
+
+def write_file(path: str) -> None:
+    # Write-then-rename so scrapers (e.g. node_exporter textfile collector) never read a partial file
+    text = REGISTRY.render_prometheus()
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with _file_lock:
+        with open(tmp, "w", encoding="utf-8") as fh:
+            fh.write(text)
+        os.replace(tmp, path)
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self) -> None:  # noqa: N802 (http.server API)
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = REGISTRY.render_prometheus().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format: str, *args: object) -> None:
+        return None
+
+
+_server: Optional[ThreadingHTTPServer] = None
+_server_lock = threading.Lock()
+
+
+def start_http_server(port: Optional[int] = None, host: str = "127.0.0.1") -> Optional[int]:
+    """Serve /metrics once per process (METRICS_PORT); returns the bound port or None"""
+    global _server
+    if not _enabled:
+        return None
+    port = port if port is not None else int(os.getenv("METRICS_PORT", "0") or 0)
+    if not port:
+        return None
+    with _server_lock:
+        if _server is None:
+            try:
+                _server = ThreadingHTTPServer((host, port), _MetricsHandler)
+            except OSError:
+                # Another Streamlit process already serves this port
+                return None
+            threading.Thread(target=_server.serve_forever, name="metrics-http", daemon=True).start()
+        return _server.server_address[1]
@@ -1,6 +1,8 @@
 from __future__ import annotations
-from typing import List, Optional
-from pydantic import BaseModel, Field
+import json
+from functools import lru_cache
+from typing import Any, Dict, List, Optional
+from pydantic import AliasChoices, BaseModel, Field, ValidationError
 
 
 class Psychographics(BaseModel):
@@ -9,6 +11,36 @@ class Psychographics(BaseModel):
     lifestyle: List[str] = Field(default_factory=list)
 
 
+class SegmentationLevel(BaseModel):
+    level: str = ""
+    label: str = ""
+    criteria: List[str] = Field(default_factory=list)
+
+
+class ValueCanvas(BaseModel):
+    customer_jobs: List[str] = Field(default_factory=list)
+    pains: List[str] = Field(default_factory=list)
+    gains: List[str] = Field(default_factory=list)
+    value_props: List[str] = Field(default_factory=list)
+    pain_relievers: List[str] = Field(default_factory=list)
+    gain_creators: List[str] = Field(default_factory=list)
+
+    def is_empty(self) -> bool:
+        return not any(getattr(self, name) for name in type(self).model_fields)
+
+
+class EmpathyMap(BaseModel):
+    think: List[str] = Field(default_factory=list)
+    feel: List[str] = Field(default_factory=list)
+    see: List[str] = Field(default_factory=list)
+    say_do: List[str] = Field(default_factory=list, validation_alias=AliasChoices("say_do", "say/do", "says_does"))
+    pains: List[str] = Field(default_factory=list)
+    gains: List[str] = Field(default_factory=list)
+
+    def is_empty(self) -> bool:
+        return not any(getattr(self, name) for name in type(self).model_fields)
+
+
 class Persona(BaseModel):
     name: str
     age_range: str
@@ -26,15 +58,93 @@ class Persona(BaseModel):
     # Conductual/behavioral segmentation signals
     behavioral_signals: List[str] = Field(default_factory=list)
     # Multi-level segmentation: e.g., Macro > Micro > Niche
-    segmentation_levels: List[dict] = Field(default_factory=list)
+    segmentation_levels: List[SegmentationLevel] = Field(default_factory=list)
     # Narrative brief for message recipients (channels + key message, CTA, rationale)
     creative_brief: Optional[str] = None
     # Value canvas-like structure
-    value_canvas: Optional[dict] = None
+    value_canvas: Optional[ValueCanvas] = None
     # Empathy map-like structure
-    empathy_map: Optional[dict] = None
+    empathy_map: Optional[EmpathyMap] = None
 
 
 class PersonaBundle(BaseModel):
     personas: List[Persona] = Field(default_factory=list)
 
+
+@lru_cache(maxsize=16)
+def _bundle_schema_json(num_personas: int) -> str:
+    schema = PersonaBundle.model_json_schema()
+    schema["properties"]["personas"].update(minItems=num_personas, maxItems=num_personas)
+    schema["required"] = ["personas"]
+    return json.dumps(schema, ensure_ascii=False)
+
+
+def bundle_json_schema(num_personas: int) -> Dict[str, Any]:
+    """JSON schema of a bundle with exactly ``num_personas`` personas, for grammar-constrained decoding"""
+    return json.loads(_bundle_schema_json(num_personas))
+
+
+# --- Lenient mode -------------------------------------------------------------------------
+# The models above validate in pydantic-core without Python callbacks (fast path). Model
+# quirks are normalized here, and only for personas that failed strict validation.
+
+_STR_LIST_FIELDS = ("motivations", "frustrations", "preferred_channels", "behavioral_signals")
+_NESTED_STR_LISTS = {
+    "psychographics": list(Psychographics.model_fields),
+    "value_canvas": list(ValueCanvas.model_fields),
+    "empathy_map": ["think", "feel", "see", "say_do", "say/do", "says_does", "pains", "gains"],
+}
+
+
+def _str_list(value: Any) -> Any:
+    """null for empty lists, a single "a; b" string, numbers or {"k": "v"} objects -> [str]"""
+    if value is None:
+        return []
+    if isinstance(value, str):
+        parts = [part.strip(" -•\t") for part in value.replace(";", "\n").split("\n")]
+        return [part for part in parts if part]
+    if isinstance(value, dict):
+        value = list(value.values())
+    if isinstance(value, list):
+        return [item if isinstance(item, str) else str(item) for item in value if item not in (None, "")]
+    return value
+
+
+def lenient_persona_data(data: Dict[str, Any]) -> Dict[str, Any]:
+    """Normalize common model quirks in a raw persona dict (returns a new dict)"""
+    data = dict(data)
+    age = data.get("age_range")
+    if isinstance(age, (int, float)):
+        data["age_range"] = str(age)
+    elif isinstance(age, list):
+        data["age_range"] = "-".join(str(v) for v in age)
+    for field in _STR_LIST_FIELDS:
+        if field in data:
+            data[field] = _str_list(data[field])
+    for field, keys in _NESTED_STR_LISTS.items():
+        nested = data.get(field)
+        if nested is None and field == "psychographics":
+            data[field] = {}
+        elif isinstance(nested, dict):
+            data[field] = {k: (_str_list(v) if k in keys else v) for k, v in nested.items()}
+    levels = data.get("segmentation_levels")
+    if levels is None and "segmentation_levels" in data:
+        data["segmentation_levels"] = []
+    elif isinstance(levels, (dict, list)):
+        levels = [levels] if isinstance(levels, dict) else levels
+        data["segmentation_levels"] = [
+            {"label": item} if isinstance(item, str)
+            else ({**item, "criteria": _str_list(item.get("criteria"))} if isinstance(item, dict) else item)
+            for item in levels
+        ]
+    return data
+
+
+def validate_persona(data: Any, lenient: bool = True) -> Persona:
+    """Strict validation first; with ``lenient`` a failing dict is normalized and retried"""
+    try:
+        return Persona.model_validate(data)
+    except ValidationError:
+        if not lenient or not isinstance(data, dict):
+            raise
+        return Persona.model_validate(lenient_persona_data(data))
@@ -1,4 +1,7 @@
-from typing import Optional
+import math
+import os
+import threading
+from typing import Dict, List, Optional
 
 
 SYSTEM_PROMPT = (
@@ -7,39 +10,225 @@ SYSTEM_PROMPT = (
 )
 
 
-def build_user_prompt(product_description: str, target_market: str, num_personas: int = 4,
-                     constraints: Optional[str] = None) -> str:
-    hints = constraints or (
-        "Incluye demográficos, psicográficos, motivaciones, frustraciones, señales conductuales; "+
-        "segmentación multinivel por TIPO (elige hasta 3 entre Geográfica, Demográfica, Psicográfica, Conductual) "+
-        "con etiquetas y criterios claros; "+
-        "canales preferidos y tono; un brief narrativo claro (mensaje clave, propuesta de valor, "+
-        "prueba social, objeciones y tratamiento, CTA y racional creativo) dirigido a quien ejecuta "+
-        "la campaña; y un resumen ampliado que funcione como Canvas de Valor y Mapa de Empatía."
+DEFAULT_CRITERIA = (
+    "Incluye demográficos, psicográficos, motivaciones, frustraciones, señales conductuales; "+
+    "segmentación multinivel por TIPO (elige hasta 3 entre Geográfica, Demográfica, Psicográfica, Conductual) "+
+    "con etiquetas y criterios claros; "+
+    "canales preferidos y tono; un brief narrativo claro (mensaje clave, propuesta de valor, "+
+    "prueba social, objeciones y tratamiento, CTA y racional creativo) dirigido a quien ejecuta "+
+    "la campaña; y un resumen ampliado que funcione como Canvas de Valor y Mapa de Empatía."
+)
+
+PERSONA_SCHEMA = (
+    "Esquema sugerido para cada persona: {\n"
+    "  'name': str, 'age_range': str, 'gender': str?, 'location': str?, 'occupation': str?,\n"
+    "  'income_range': str?, 'education': str?, 'motivations': [str], 'frustrations': [str],\n"
+    "  'preferred_channels': [str], 'messaging_tone': str?,\n"
+    "  'psychographics': {'values': [str], 'interests': [str], 'lifestyle': [str]},\n"
+    "  'behavioral_signals': [str],\n"
+    "  'segmentation_levels': [\n"
+    "     {'level': 'Geográfica'|'Demográfica'|'Psicográfica'|'Conductual', 'label': str, 'criteria': [str]}\n"
+    "     // Máximo 3 entradas combinando tipos para hallar los mejores targets\n"
+    "  ],\n"
+    "  'creative_brief': str,\n"
+    "  'value_canvas': { 'customer_jobs': [str]?, 'pains': [str]?, 'gains': [str]?,\n"
+    "                    'value_props': [str]?, 'pain_relievers': [str]?, 'gain_creators': [str]? },\n"
+    "  'empathy_map': { 'think': [str]?, 'feel': [str]?, 'see': [str]?, 'say_do': [str]?, 'pains': [str]?, 'gains': [str]? },\n"
+    "  'summary': str?\n"
+    "}\n"
+)
+
+# Same fields with ~40% fewer tokens; '?' marks optional keys
+PERSONA_SCHEMA_COMPACT = (
+    "Esquema por persona (? = opcional): name, age_range, gender?, location?, occupation?, income_range?, "
+    "education?, motivations[], frustrations[], preferred_channels[], messaging_tone?, "
+    "psychographics{values[],interests[],lifestyle[]}, behavioral_signals[], "
+    "segmentation_levels[<=3]{level: Geográfica|Demográfica|Psicográfica|Conductual, label, criteria[]}, "
+    "creative_brief, value_canvas{customer_jobs[],pains[],gains[],value_props[],pain_relievers[],gain_creators[]}, "
+    "empathy_map{think[],feel[],see[],say_do[],pains[],gains[]}, summary?. Listas de strings.\n"
+)
+
+
+def static_prefix(compact: bool = False) -> str:
+    """Instructions shared by every request, byte-identical across calls.
+
+    Keeping them ahead of the product/market text lets providers reuse their prompt prefix cache.
+    """
+    return (
+        "Contexto: El estudiante describe un producto y su mercado objetivo.\n"
+        "Tarea: Genera buyer personas en formato JSON con la clave 'personas' (lista).\n"
+        + (PERSONA_SCHEMA_COMPACT if compact else PERSONA_SCHEMA)
+        + f"Criterios (salvo que al final se indiquen otros): {DEFAULT_CRITERIA}\n"
+        "Responde SOLO con JSON.\n"
     )
+
+
+def build_variable_suffix(product_description: str, target_market: str, num_personas: int = 4,
+                          constraints: Optional[str] = None) -> str:
+    suffix = (
+        f"Producto: {product_description}\n"
+        f"Mercado objetivo: {target_market}\n"
+        f"Cantidad de personas: {num_personas}"
+    )
+    if constraints:
+        # ``constraints`` replace DEFAULT_CRITERIA, as they always did; the prefix stays byte-identical
+        # and this line tells the model to drop the default criteria
+        suffix += f"\nCriterios (reemplazan a los anteriores): {constraints}"
+    return suffix
+
+
+def build_user_prompt(product_description: str, target_market: str, num_personas: int = 4,
+                     constraints: Optional[str] = None, compact: bool = False) -> str:
+    # Static prefix first, variable suffix last (see static_prefix)
+    return static_prefix(compact) + build_variable_suffix(product_description, target_market, num_personas, constraints)
+
+
+def count_tokens(text: str) -> int:
+    """Token count with tiktoken when installed, otherwise a ~4 chars/token estimate"""
+    try:
+        import tiktoken
+    except ImportError:
+        return max(1, (len(text) + 3) // 4)
+    return len(tiktoken.get_encoding("cl100k_base").encode(text))
+
+
+def max_tokens_for(num_personas: int) -> int:
+    """Output budget sized to the number of personas requested"""
+    per_persona = int(os.getenv("LLM_TOKENS_PER_PERSONA", "750"))
+    overhead = int(os.getenv("LLM_TOKENS_OVERHEAD", "150"))
+    return per_persona * max(1, num_personas) + overhead
+
+
+def max_output_tokens(num_personas: int) -> int:
+    """Ceiling for adaptive budgets: ``LLM_MAX_OUTPUT_TOKENS``, or twice ``max_tokens_for``"""
+    ceiling = int(os.getenv("LLM_MAX_OUTPUT_TOKENS", "0"))
+    return ceiling if ceiling > 0 else 2 * max_tokens_for(num_personas)
+
+
+# Completion tokens per persona observed for each model (exponential moving average)
+_persona_tokens: Dict[str, float] = {}
+_persona_tokens_lock = threading.Lock()
+TOKENS_EMA_ALPHA = 0.3
+# Margin over the average: personas vary in length and a cut-off answer costs a whole retry
+TOKENS_HEADROOM = 1.3
+
+
+def observe_persona_tokens(model: str, num_personas: int, completion_tokens: int, truncated: bool = False) -> None:
+    """Feed one finished answer into the per-persona estimate of ``model``"""
+    if num_personas <= 0 or completion_tokens <= 0:
+        return
+    sample = completion_tokens / num_personas
+    with _persona_tokens_lock:
+        current = _persona_tokens.get(model)
+        if truncated:
+            # The real length is unknown, only larger: grow the estimate so the next call fits,
+            # but never past the ceiling (a model that rambles would otherwise grow it every call)
+            ceiling = max_output_tokens(num_personas) / num_personas
+            _persona_tokens[model] = min(max(current or 0.0, sample) * 1.5, ceiling)
+        elif current is None:
+            _persona_tokens[model] = sample
+        else:
+            _persona_tokens[model] = current + TOKENS_EMA_ALPHA * (sample - current)
+
+
+def adaptive_max_tokens(model: str, num_personas: int) -> int:
+    """Output budget from the tokens ``model`` actually spends per persona (``max_tokens_for`` until observed)"""
+    with _persona_tokens_lock:
+        per_persona = _persona_tokens.get(model)
+    if per_persona is None:
+        return max_tokens_for(num_personas)
+    overhead = int(os.getenv("LLM_TOKENS_OVERHEAD", "150"))
+    budget = math.ceil(per_persona * max(1, num_personas) * TOKENS_HEADROOM) + overhead
+    return min(budget, max_output_tokens(num_personas))
+
+
+def prompt_report(user_prompt: str, compact: bool = False) -> Dict[str, int]:
+    """Sizes of a prompt and of its cacheable static part (system + schema + criteria)"""
+    prefix = SYSTEM_PROMPT + static_prefix(compact)
+    total = SYSTEM_PROMPT + user_prompt
+    return {
+        "prompt_chars": len(total),
+        "prompt_tokens_est": count_tokens(total),
+        "static_prefix_tokens_est": count_tokens(prefix) if total.startswith(prefix) else 0,
+    }
+
+
+def build_seed_prompt(product_description: str, target_market: str, num_personas: int,
+                      personas_per_seed: int = 1) -> str:
+    """Short planning prompt: one distinct segment seed per persona (or per group of personas)"""
+    use = "una buyer persona" if personas_per_seed <= 1 else f"un grupo de {personas_per_seed} buyer personas"
     return (
         "Contexto: El estudiante describe un producto y su mercado objetivo.\n"
         f"Producto: {product_description}\n"
         f"Mercado objetivo: {target_market}\n"
-        f"Cantidad de personas: {num_personas}\n"
-        "Tarea: Genera buyer personas en formato JSON con la clave 'personas' (lista).\n"
-        "Esquema sugerido para cada persona: {\n"
-        "  'name': str, 'age_range': str, 'gender': str?, 'location': str?, 'occupation': str?,\n"
-        "  'income_range': str?, 'education': str?, 'motivations': [str], 'frustrations': [str],\n"
-        "  'preferred_channels': [str], 'messaging_tone': str?,\n"
-        "  'psychographics': {'values': [str], 'interests': [str], 'lifestyle': [str]},\n"
-        "  'behavioral_signals': [str],\n"
-        "  'segmentation_levels': [\n"
-        "     {'level': 'Geográfica'|'Demográfica'|'Psicográfica'|'Conductual', 'label': str, 'criteria': [str]}\n"
-        "     // Máximo 3 entradas combinando tipos para hallar los mejores targets\n"
-        "  ],\n"
-        "  'creative_brief': str,\n"
-        "  'value_canvas': { 'customer_jobs': [str]?, 'pains': [str]?, 'gains': [str]?,\n"
-        "                    'value_props': [str]?, 'pain_relievers': [str]?, 'gain_creators': [str]? },\n"
-        "  'empathy_map': { 'think': [str]?, 'feel': [str]?, 'see': [str]?, 'say_do': [str]?, 'pains': [str]?, 'gains': [str]? },\n"
-        "  'summary': str?\n"
-        "}\n"
-        f"Criterios: {hints}\n"
+        f"Tarea: Propón {num_personas} segmentos DISTINTOS entre sí (sin solaparse en edad, "
+        f"ingresos, motivación principal ni canales) que sirvan de semilla para {use} cada uno.\n"
+        "Formato: {'seeds': [{'label': str, 'description': str}]} con descripciones de una sola frase.\n"
         "Responde SOLO con JSON."
     )
 
+
+def build_single_persona_prompt(product_description: str, target_market: str, seed_label: str,
+                                seed_description: str = "", avoid: Optional[List[str]] = None,
+                                compact: bool = False) -> str:
+    """Prompt for exactly one persona focused on a planned segment seed"""
+    prompt = build_user_prompt(product_description, target_market, 1, compact=compact)
+    focus = f"Segmento asignado: {seed_label}"
+    if seed_description:
+        focus += f" — {seed_description}"
+    prompt += f"\n{focus}\nLa lista 'personas' debe contener exactamente 1 persona de este segmento."
+    if avoid:
+        prompt += "\nEvita solaparte con estos otros segmentos: " + "; ".join(avoid)
+    return prompt
+
+
+def build_segment_prompt(product_description: str, target_market: str, seed_label: str,
+                         seed_description: str, num_personas: int, avoid: Optional[List[str]] = None,
+                         existing_names: Optional[List[str]] = None, compact: bool = False) -> str:
+    """Prompt for one chunk of a study: ``num_personas`` distinct personas inside one planned segment"""
+    prompt = build_user_prompt(product_description, target_market, num_personas, compact=compact)
+    focus = f"Segmento asignado: {seed_label}"
+    if seed_description:
+        focus += f" — {seed_description}"
+    prompt += (
+        f"\n{focus}\nLa lista 'personas' debe contener exactamente {num_personas} personas de este segmento, "
+        "distintas entre sí."
+    )
+    if avoid:
+        prompt += "\nLos demás segmentos del estudio ya tienen sus personas; no te solapes con: " + "; ".join(avoid)
+    if existing_names:
+        prompt += "\nEste segmento ya tiene estas personas; genera otras distintas: " + "; ".join(existing_names)
+    return prompt
+
+
+def build_topup_prompt(product_description: str, target_market: str, missing: int,
+                       existing_names: Optional[List[str]] = None, compact: bool = False) -> str:
+    """Re-request only the personas that could not be salvaged from a previous answer"""
+    prompt = build_user_prompt(product_description, target_market, missing, compact=compact)
+    if existing_names:
+        prompt += "\nYa existen estas personas; genera otras distintas: " + "; ".join(existing_names)
+    return prompt
+
+
+def build_regenerate_prompt(product_description: str, target_market: str, others: List[str],
+                            compact: bool = False) -> str:
+    """Replace one persona: the rest of the bundle goes in only as one-line digests to avoid"""
+    prompt = build_user_prompt(product_description, target_market, 1, compact=compact)
+    prompt += "\nLa lista 'personas' debe contener exactamente 1 persona nueva."
+    if others:
+        prompt += "\nNo te solapes (edad, ingresos, motivación principal, canales) con:\n- " + "\n- ".join(others)
+    return prompt
+
+
+def build_refine_prompt(product_description: str, target_market: str, persona_json: str, instruction: str,
+                        others: List[str], compact: bool = False) -> str:
+    """Edit one persona following ``instruction``; unchanged fields must be kept as they are"""
+    prompt = build_user_prompt(product_description, target_market, 1, compact=compact)
+    prompt += (
+        f"\nPersona actual: {persona_json}\n"
+        f"Ajuste pedido: {instruction}\n"
+        "Devuelve en 'personas' solo esta persona con el ajuste aplicado; conserva el resto de los campos."
+    )
+    if others:
+        prompt += "\nSigue sin solaparte con:\n- " + "\n- ".join(others)
+    return prompt
@@ -0,0 +1,173 @@
+import hashlib
+import json
+import threading
+from collections import OrderedDict
+from functools import lru_cache
+from typing import Dict, List, Optional, Union
+
+import streamlit as st
+
+from persona_schema import EmpathyMap, Persona, PersonaBundle, SegmentationLevel, ValueCanvas
+
+
+def _mk_kv_table(rows):
+    # rows: list of (label, value)
+    clean = [(k, v) for k, v in rows if v not in (None, "", [])]
+    if not clean:
+        return ""
+    header = "| Campo | Detalle |\n|---|---|"
+    body = "\n".join([f"| {k} | {v} |" for k, v in clean])
+    return f"{header}\n{body}"
+
+
+def _mk_bullets(items, icon="•"):
+    if not items:
+        return ""
+    return "\n".join([f"- {icon} {it}" for it in items])
+
+
+def _mk_segmentation_table(levels: List[SegmentationLevel]) -> str:
+    if not levels:
+        return ""
+    header = "| Nivel | Etiqueta | Criterios |\n|---|---|---|"
+    rows = [f"| {lvl.level} | {lvl.label} | {', '.join(lvl.criteria)} |" for lvl in levels]
+    return f"{header}\n" + "\n".join(rows)
+
+
+def _block(*parts: str) -> str:
+    # Join the non-empty markdown pieces of one column into a single element
+    return "\n\n".join(part for part in parts if part)
+
+
+def _titled(title: str, body: str) -> str:
+    return _block(title, body) if body else ""
+
+
+def _framework_columns(data: Optional[Union[ValueCanvas, EmpathyMap]],
+                       layout: List[List[tuple]]) -> Optional[List[str]]:
+    if data is None or data.is_empty():
+        return None
+    return [
+        _block(*[_titled(title, _mk_bullets(getattr(data, key), icon=icon)) for key, title, icon in column])
+        for column in layout
+    ]
+
+
+VALUE_CANVAS_LAYOUT = [
+    [("customer_jobs", "**👔 Customer jobs**", "🧰"), ("value_props", "**💡 Value props**", "💡")],
+    [("pains", "**😣 Pains**", "❌"), ("pain_relievers", "**🩹 Pain relievers**", "🩹")],
+    [("gains", "**📈 Gains**", "✅"), ("gain_creators", "**🚀 Gain creators**", "🚀")],
+]
+
+EMPATHY_MAP_LAYOUT = [
+    [("think", "**🧠 Piensa**", "🧠"), ("feel", "**💓 Siente**", "💓")],
+    [("see", "**👀 Ve**", "👀"), ("say_do", "**🗣️ Dice/Hace**", "🗣️")],
+    [("pains", "**⚠️ Dolores**", "⚠️"), ("gains", "**🏆 Ganancias**", "🏆")],
+]
+
+
+# Markdown per persona content key (see persona_key), shared by every session
+_SECTIONS: "OrderedDict[str, Dict[str, object]]" = OrderedDict()
+_SECTIONS_MAX = 1024
+_sections_lock = threading.Lock()
+
+
+def _sections(p: Persona) -> Dict[str, object]:
+    demo_table = _mk_kv_table([
+        ("Edad", p.age_range),
+        ("Género", p.gender),
+        ("Ubicación", p.location),
+        ("Ocupación", p.occupation),
+        ("Ingresos", p.income_range),
+        ("Educación", p.education),
+    ])
+    return {
+        "demo": _block(
+            "### 👤 Demográficos",
+            demo_table,
+            _titled("### 🧭 Señales conductuales", _mk_bullets(p.behavioral_signals, icon="🧩")),
+        ),
+        "psycho": _block(
+            "### 🧠 Psicográficos",
+            _titled("**Valores**", _mk_bullets(p.psychographics.values, icon="💎")),
+            _titled("**Intereses**", _mk_bullets(p.psychographics.interests, icon="🎯")),
+            _titled("**Estilo de vida**", _mk_bullets(p.psychographics.lifestyle, icon="🌱")),
+            "### 🚀 Motivaciones",
+            _mk_bullets(p.motivations, icon="⚡"),
+            "### 🛑 Frustraciones",
+            _mk_bullets(p.frustrations, icon="❗"),
+        ),
+        "channels": _block(
+            "### 📣 Canales y Mensaje",
+            _titled("**Canales preferidos**", _mk_bullets(p.preferred_channels, icon="📡")),
+            f"**Tono recomendado**: ✨ {p.messaging_tone}" if p.messaging_tone else "",
+            _titled("**🔎 Segmentación multinivel**", _mk_segmentation_table(p.segmentation_levels)),
+        ),
+        "brief": p.creative_brief,
+        "canvas": _framework_columns(p.value_canvas, VALUE_CANVAS_LAYOUT),
+        "empathy": _framework_columns(p.empathy_map, EMPATHY_MAP_LAYOUT),
+        "summary": p.summary,
+    }
+
+
+def persona_key(p: Persona) -> str:
+    """Short content hash, for widget keys that must change when a persona is replaced"""
+    return hashlib.sha256(p.model_dump_json().encode("utf-8")).hexdigest()[:16]
+
+
+def persona_sections(p: Persona, key: Optional[str] = None) -> Dict[str, object]:
+    """Rendered markdown of ``p``, memoized on ``key`` (its persona_key, computed once by the caller)"""
+    key = key or persona_key(p)
+    with _sections_lock:
+        sections = _SECTIONS.get(key)
+        if sections is not None:
+            _SECTIONS.move_to_end(key)
+            return sections
+    sections = _sections(p)
+    with _sections_lock:
+        _SECTIONS[key] = sections
+        if len(_SECTIONS) > _SECTIONS_MAX:
+            _SECTIONS.popitem(last=False)
+    return sections
+
+
+@lru_cache(maxsize=64)
+def _bundle_json(payload: str) -> str:
+    return json.dumps(json.loads(payload), ensure_ascii=False, indent=2)
+
+
+def bundle_json(bundle: PersonaBundle) -> str:
+    """Pretty JSON for the raw-response expander (memoized per bundle content)"""
+    return _bundle_json(bundle.model_dump_json())
+
+
+def render_persona(idx: int, p: Persona, expanded: bool = False, key: Optional[str] = None) -> None:
+    """Render one persona inside its own expander (``key``: its persona_key, if already known)"""
+    sections = persona_sections(p, key)
+    with st.expander(f"Persona {idx}: {p.name}", expanded=expanded):
+        cols = st.columns(3)
+        with cols[0]:
+            st.markdown(sections["demo"])
+        with cols[1]:
+            st.markdown(sections["psycho"])
+        with cols[2]:
+            st.markdown(sections["channels"])
+            if sections["brief"]:
+                st.markdown("**📝 Brief narrativo**")
+                st.info(sections["brief"])
+        # Narrative and frameworks
+        st.markdown("### 🧩 Canvas de Valor")
+        if sections["canvas"]:
+            for col, body in zip(st.columns(3), sections["canvas"]):
+                with col:
+                    if body:
+                        st.markdown(body)
+        if sections["empathy"]:
+            st.markdown("### 🤝 Mapa de empatía")
+            for col, body in zip(st.columns(3), sections["empathy"]):
+                with col:
+                    if body:
+                        st.markdown(body)
+        if sections["summary"]:
+            st.markdown("### 🧾 Resumen ampliado")
+            st.success(sections["summary"])
@@ -0,0 +1,392 @@
+from __future__ import annotations
+import asyncio
+import os
+import random
+import sys
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from email.utils import parsedate_to_datetime
+from typing import Any, Awaitable, Callable, Deque, Dict, List, Optional, Tuple, TypeVar
+
+from utils import env_flag
+
+
+T = TypeVar("T")
+
+TRANSIENT_STATUS = {408, 409, 425, 429, 500, 502, 503, 504}
+
+
+def is_transient(exc: BaseException) -> bool:
+    """Errors worth retrying: timeouts, connection drops, 429 and 5xx"""
+    # An SDK that was never imported cannot have raised, so neither is imported here
+    httpx = sys.modules.get("httpx")
+    openai = sys.modules.get("openai")
+    if httpx is not None:
+        if isinstance(exc, httpx.TransportError):
+            return True
+        if isinstance(exc, httpx.HTTPStatusError):
+            return exc.response.status_code in TRANSIENT_STATUS
+    if openai is not None:
+        if isinstance(exc, (openai.APIConnectionError, openai.APITimeoutError)):
+            return True
+        if isinstance(exc, openai.APIStatusError):
+            return exc.status_code in TRANSIENT_STATUS
+    return False
+
+
+def retry_after(exc: BaseException) -> Optional[float]:
+    """Seconds requested by a Retry-After header (delta-seconds or HTTP date), if any"""
+    response = getattr(exc, "response", None)
+    headers = getattr(response, "headers", None)
+    if not headers:
+        return None
+    value = headers.get("retry-after")
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+class CircuitOpenError(RuntimeError):
+    pass
+
+
+class ProviderHealth:
+    """Rolling window of (latency, ok) samples for one provider/model"""
+
+    def __init__(self, window: int = 50):
+        self._samples: Deque[Tuple[float, bool]] = deque(maxlen=window)
+        self._lock = threading.Lock()
+
+    def record(self, latency: float, ok: bool) -> None:
+        with self._lock:
+            self._samples.append((latency, ok))
+
+    def percentile(self, q: float) -> Optional[float]:
+        with self._lock:
+            latencies = sorted(lat for lat, ok in self._samples if ok)
+        if len(latencies) < 5:
+            return None
+        return latencies[min(len(latencies) - 1, int(q * len(latencies)))]
+
+    def error_rate(self) -> float:
+        with self._lock:
+            samples = list(self._samples)
+        return (sum(1 for _, ok in samples if not ok) / len(samples)) if samples else 0.0
+
+    def count(self) -> int:
+        with self._lock:
+            return len(self._samples)
+
+
+class CircuitBreaker:
+    """Opens after ``failure_threshold`` consecutive failures; one probe is let through after ``reset_timeout``"""
+
+    def __init__(self, failure_threshold: int = 5, reset_timeout: float = 30.0):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._failures = 0
+        self._opened_at: Optional[float] = None
+        self._probing = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self) -> str:
+        with self._lock:
+            if self._opened_at is None:
+                return "closed"
+            if time.monotonic() - self._opened_at >= self.reset_timeout:
+                return "half-open"
+            return "open"
+
+    def allow(self) -> bool:
+        with self._lock:
+            if self._opened_at is None:
+                return True
+            if time.monotonic() - self._opened_at < self.reset_timeout or self._probing:
+                return False
+            self._probing = True
+            return True
+
+    def success(self) -> None:
+        with self._lock:
+            self._failures = 0
+            self._opened_at = None
+            self._probing = False
+
+    def failure(self) -> None:
+        with self._lock:
+            self._failures += 1
+            self._probing = False
+            if self._failures >= self.failure_threshold:
+                self._opened_at = time.monotonic()
+
+    def release(self) -> None:
+        # A probe that ended without a verdict (abandoned stream) lets the next call probe instead
+        with self._lock:
+            self._probing = False
+
+
+class Router:
+    """Retry, optional hedging, circuit breaking and failover across configured providers.
+
+    ``models`` maps provider -> model; health is tracked per (provider, model) and shared by
+    every LLMClient in the process.
+    """
+
+    def __init__(self, models: Dict[str, str], max_retries: int = 3, backoff_base: float = 0.5,
+                 backoff_max: float = 20.0, hedge: bool = False, hedge_min_delay: float = 2.0,
+                 max_error_rate: float = 0.5, window: int = 50, failure_threshold: int = 5,
+                 reset_timeout: float = 30.0):
+        self.models = dict(models)
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.hedge = hedge
+        self.hedge_min_delay = hedge_min_delay
+        self.max_error_rate = max_error_rate
+        self.health = {p: ProviderHealth(window) for p in self.models}
+        self.breakers = {p: CircuitBreaker(failure_threshold, reset_timeout) for p in self.models}
+        self._pool = ThreadPoolExecutor(max_workers=8, thread_name_prefix="llm-hedge")
+
+    def candidates(self, primary: str) -> List[str]:
+        """Providers to try in order: primary first unless unhealthy, then the rest by p95"""
+        providers = [primary] + [p for p in self.models if p != primary]
+
+        def score(provider: str) -> Tuple[int, int, int, float]:
+            health = self.health[provider]
+            unhealthy = health.count() >= 5 and health.error_rate() > self.max_error_rate
+            p95 = health.percentile(0.95)
+            return (
+                int(self.breakers[provider].state == "open"),
+                int(unhealthy),
+                0 if provider == primary else 1,
+                p95 if p95 is not None else float("inf"),
+            )
+
+        return sorted(providers, key=score)
+
+    def _available(self, primary: str) -> List[str]:
+        order = [p for p in self.candidates(primary) if self.breakers[p].state != "open"]
+        if not order:
+            raise CircuitOpenError("Todos los proveedores están temporalmente deshabilitados (circuit breaker)")
+        return order
+
+    def _backoff(self, attempt: int, exc: BaseException) -> float:
+        requested = retry_after(exc)
+        if requested is not None:
+            return min(requested, self.backoff_max)
+        return min(self.backoff_max, self.backoff_base * (2 ** attempt)) * random.uniform(0.5, 1.0)
+
+    def _attempt(self, provider: str, fn: Callable[[str], T], before: Optional[Callable[[str], None]] = None) -> T:
+        """Run ``fn`` on one provider with retries on transient errors.
+
+        ``before(provider)`` runs ahead of every attempt, retries included, outside the latency window.
+        """
+        if not self.breakers[provider].allow():
+            raise CircuitOpenError(f"Proveedor {provider} deshabilitado temporalmente")
+        attempt = 0
+        while True:
+            if before is not None:
+                try:
+                    before(provider)
+                except BaseException:
+                    self.breakers[provider].release()
+                    raise
+            started = time.perf_counter()
+            try:
+                result = fn(provider)
+            except Exception as exc:
+                self.health[provider].record(time.perf_counter() - started, False)
+                self._trip(provider, exc)
+                if not is_transient(exc) or attempt >= self.max_retries:
+                    raise
+                time.sleep(self._backoff(attempt, exc))
+                attempt += 1
+                continue
+            self.health[provider].record(time.perf_counter() - started, True)
+            self.breakers[provider].success()
+            return result
+
+    def _trip(self, provider: str, exc: BaseException) -> None:
+        # Only outages count against the breaker; a 4xx/validation error means the provider is up
+        if is_transient(exc):
+            self.breakers[provider].failure()
+        else:
+            self.breakers[provider].success()
+
+    def hedge_delay(self, provider: str) -> Optional[float]:
+        p95 = self.health[provider].percentile(0.95)
+        return None if p95 is None else max(self.hedge_min_delay, p95)
+
+    def call(self, primary: str, fn: Callable[[str], T],
+             before: Optional[Callable[[str], None]] = None) -> Tuple[str, T]:
+        """Run ``fn(provider)`` and return ``(provider, result)`` from the first provider that succeeds"""
+        order = self._available(primary)
+        delay = self.hedge_delay(order[0]) if self.hedge and len(order) > 1 else None
+        if delay is not None:
+            return self._hedged(order, fn, delay, before)
+        last_exc: Optional[BaseException] = None
+        for provider in order:
+            try:
+                return provider, self._attempt(provider, fn, before)
+            except Exception as exc:
+                last_exc = exc
+        assert last_exc is not None
+        raise last_exc
+
+    def _hedged(self, order: List[str], fn: Callable[[str], T], delay: float,
+                before: Optional[Callable[[str], None]] = None) -> Tuple[str, T]:
+        # Launch the backup only if the primary is slower than its recent p95
+        futures: Dict[Future, str] = {self._pool.submit(self._attempt, order[0], fn, before): order[0]}
+        done, _ = wait(futures, timeout=delay)
+        if not done:
+            futures[self._pool.submit(self._attempt, order[1], fn, before)] = order[1]
+        last_exc: Optional[BaseException] = None
+        pending = set(futures)
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is None:
+                    return futures[future], future.result()
+                last_exc = future.exception()
+        # Both failed (or only the primary ran): fall through to the remaining providers
+        for provider in order[len(futures):]:
+            try:
+                return provider, self._attempt(provider, fn, before)
+            except Exception as exc:
+                last_exc = exc
+        assert last_exc is not None
+        raise last_exc
+
+    async def _aattempt(self, provider: str, fn: Callable[[str], Awaitable[T]],
+                        before: Optional[Callable[[str], Awaitable[None]]] = None) -> T:
+        if not self.breakers[provider].allow():
+            raise CircuitOpenError(f"Proveedor {provider} deshabilitado temporalmente")
+        attempt = 0
+        while True:
+            if before is not None:
+                try:
+                    await before(provider)
+                except BaseException:
+                    self.breakers[provider].release()
+                    raise
+            started = time.perf_counter()
+            try:
+                result = await fn(provider)
+            except Exception as exc:
+                self.health[provider].record(time.perf_counter() - started, False)
+                self._trip(provider, exc)
+                if not is_transient(exc) or attempt >= self.max_retries:
+                    raise
+                await asyncio.sleep(self._backoff(attempt, exc))
+                attempt += 1
+                continue
+            self.health[provider].record(time.perf_counter() - started, True)
+            self.breakers[provider].success()
+            return result
+
+    async def acall(self, primary: str, fn: Callable[[str], Awaitable[T]],
+                    before: Optional[Callable[[str], Awaitable[None]]] = None) -> Tuple[str, T]:
+        """Async counterpart of :meth:`call` (hedging uses a second task instead of a thread)"""
+        order = self._available(primary)
+        delay = self.hedge_delay(order[0]) if self.hedge and len(order) > 1 else None
+        if delay is not None:
+            tasks = {asyncio.ensure_future(self._aattempt(order[0], fn, before)): order[0]}
+            done, _ = await asyncio.wait(tasks, timeout=delay)
+            if not done:
+                tasks[asyncio.ensure_future(self._aattempt(order[1], fn, before))] = order[1]
+            pending = set(tasks)
+            last_exc: Optional[BaseException] = None
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        for other in pending:
+                            other.cancel()
+                        return tasks[task], task.result()
+                    last_exc = task.exception()
+            order = order[len(tasks):]
+        else:
+            last_exc = None
+        for provider in order:
+            try:
+                return provider, await self._aattempt(provider, fn, before)
+            except Exception as exc:
+                last_exc = exc
+        assert last_exc is not None
+        raise last_exc
+
+    def pick(self, primary: str) -> str:
+        """Provider for calls that cannot fail over mid-way (streaming)"""
+        for provider in self._available(primary):
+            if self.breakers[provider].allow():
+                return provider
+        raise CircuitOpenError("Todos los proveedores están temporalmente deshabilitados (circuit breaker)")
+
+    def record(self, provider: str, latency: float, ok: bool, exc: Optional[BaseException] = None) -> None:
+        """Outcome of a call made outside :meth:`call` (streams); failures count like in ``_attempt``"""
+        self.health[provider].record(latency, ok)
+        if ok:
+            self.breakers[provider].success()
+        elif exc is None:
+            self.breakers[provider].failure()
+        else:
+            self._trip(provider, exc)
+
+    def release(self, provider: str) -> None:
+        """Give back a half-open probe taken by :meth:`pick` whose call never reported an outcome"""
+        self.breakers[provider].release()
+
+    def stats(self) -> List[Dict[str, Any]]:
+        return [
+            {
+                "provider": provider,
+                "model": model,
+                "samples": self.health[provider].count(),
+                "p50": self.health[provider].percentile(0.5),
+                "p95": self.health[provider].percentile(0.95),
+                "error_rate": self.health[provider].error_rate(),
+                "circuit": self.breakers[provider].state,
+            }
+            for provider, model in self.models.items()
+        ]
+
+
+_routers: Dict[Tuple[Tuple[str, str], ...], Router] = {}
+_routers_lock = threading.Lock()
+
+
+def get_router(models: Dict[str, str]) -> Router:
+    """Process-wide router per provider/model set, so health windows are shared across sessions"""
+    key = tuple(sorted(models.items()))
+    with _routers_lock:
+        router = _routers.get(key)
+        if router is None:
+            router = Router(
+                models,
+                max_retries=int(os.getenv("LLM_MAX_RETRIES", "3")),
+                backoff_base=float(os.getenv("LLM_BACKOFF_BASE", "0.5")),
+                hedge=env_flag("LLM_HEDGE"),
+                hedge_min_delay=float(os.getenv("LLM_HEDGE_MIN_DELAY", "2")),
+                max_error_rate=float(os.getenv("LLM_MAX_ERROR_RATE", "0.5")),
+                window=int(os.getenv("LLM_HEALTH_WINDOW", "50")),
+                failure_threshold=int(os.getenv("LLM_CIRCUIT_FAILURES", "5")),
+                reset_timeout=float(os.getenv("LLM_CIRCUIT_RESET", "30")),
+            )
+            _routers[key] = router
+        return router
+
+
+def all_router_stats() -> List[Dict[str, Any]]:
+    with _routers_lock:
+        routers = list(_routers.values())
+    return [entry for router in routers for entry in router.stats()]
@@ -0,0 +1,179 @@
+from __future__ import annotations
+import os
+import re
+import threading
+import unicodedata
+from typing import Dict, List, Optional, Set, Tuple
+
+import numpy as np
+
+from library import PersonaLibrary, get_persona_library
+from utils import env_flag
+
+
+_WORD_RE = re.compile(r"[a-z0-9]+")
+# Frequent Spanish/English function words carry no signal about the product
+STOPWORDS = frozenset(
+    "a al algo con de del el en entre es esta este la las lo los mas o para pero por que se sin su sus "
+    "un una uno y e u mi mis tu tus muy como and the of for to in with on an or".split()
+)
+_MASK32 = np.uint64(0xFFFFFFFF)
+
+
+def normalize(text: str) -> List[str]:
+    """Lowercase, strip accents and punctuation, drop stopwords"""
+    # NFKD splits "á" into "a" + accent; the ASCII round-trip drops the accent
+    text = unicodedata.normalize("NFKD", text.lower()).encode("ascii", "ignore").decode("ascii")
+    return [w for w in _WORD_RE.findall(text) if w not in STOPWORDS]
+
+
+def shingles(product: str, target: str) -> Set[str]:
+    """Words and word pairs of each field (prefixed, so product and target never mix)"""
+    out: Set[str] = set()
+    for prefix, text in (("p", product), ("t", target)):
+        words = normalize(text)
+        out.update(f"{prefix}:{w}" for w in words)
+        out.update(f"{prefix}:{a}_{b}" for a, b in zip(words, words[1:]))
+    return out
+
+
+class SimilarityIndex:
+    """MinHash signatures + LSH banding over normalized product/target text.
+
+    A lookup hashes the request once, probes ``bands`` buckets and compares signatures only
+    with the few candidates found there, so it does not grow with the number of requests.
+    """
+
+    def __init__(self, num_perm: int = 64, bands: int = 16, threshold: float = 0.6, seed: int = 7):
+        if num_perm % bands:
+            raise ValueError("num_perm debe ser múltiplo de bands")
+        self.num_perm = num_perm
+        self.bands = bands
+        self.rows = num_perm // bands
+        self.threshold = threshold
+        rng = np.random.default_rng(seed)
+        # Multiply-shift hashing: (a * x + b) mod 2^64, top 32 bits; ``a`` odd
+        self._a = rng.integers(1, 2 ** 63, size=num_perm, dtype=np.uint64) | np.uint64(1)
+        self._b = rng.integers(0, 2 ** 63, size=num_perm, dtype=np.uint64)
+        self._lock = threading.Lock()
+        self._signatures = np.empty((1024, num_perm), dtype=np.uint32)
+        self._ids: List[int] = []
+        self._num_personas: List[int] = []
+        self._known: Set[int] = set()
+        self._band_mix = rng.integers(1, 2 ** 63, size=self.rows, dtype=np.uint64) | np.uint64(1)
+        self._buckets: List[Dict[int, List[int]]] = [{} for _ in range(bands)]
+        self._stats = {"lookups": 0, "hits": 0, "accepted": 0}
+
+    def _minhash(self, requests: List[Tuple[str, str]]) -> np.ndarray:
+        """MinHash signatures for a batch of (product, target) pairs, shape (n, num_perm)"""
+        # Index-local hashes: signatures are rebuilt per process, so str hashing need not be stable
+        token_hashes = [[hash(s) & 0xFFFFFFFF for s in shingles(product, target)] or [0] for product, target in requests]
+        lengths = np.fromiter((len(h) for h in token_hashes), dtype=np.int64, count=len(token_hashes))
+        flat = np.fromiter((h for hashes in token_hashes for h in hashes), dtype=np.uint64, count=int(lengths.sum()))
+        # (num_shingles, num_perm); uint64 products wrap around, which is the point
+        with np.errstate(over="ignore"):
+            mixed = ((flat[:, None] * self._a[None, :] + self._b[None, :]) >> np.uint64(32)) & _MASK32
+        starts = np.concatenate([[0], np.cumsum(lengths)[:-1]])
+        return np.minimum.reduceat(mixed, starts, axis=0).astype(np.uint32)
+
+    def signature(self, product: str, target: str) -> np.ndarray:
+        return self._minhash([(product, target)])[0]
+
+    def _band_keys(self, signatures: np.ndarray) -> np.ndarray:
+        # One integer per band (rows of the band mixed together), shape (n, bands)
+        bands = signatures.reshape(len(signatures), self.bands, self.rows).astype(np.uint64)
+        with np.errstate(over="ignore"):
+            return (bands * self._band_mix[None, None, :]).sum(axis=2, dtype=np.uint64)
+
+    def add_many(self, items: List[Tuple[int, str, str, int]]) -> None:
+        """Index (item id, product, target, num personas) tuples; already indexed ids are skipped"""
+        with self._lock:
+            items = [item for item in items if item[0] not in self._known]
+        if not items:
+            return
+        signatures = self._minhash([(product, target) for _, product, target, _ in items])
+        band_keys = self._band_keys(signatures).tolist()
+        with self._lock:
+            start = len(self._ids)
+            needed = start + len(items)
+            if needed > len(self._signatures):
+                grown = np.empty((max(needed, 2 * len(self._signatures)), self.num_perm), dtype=np.uint32)
+                grown[:start] = self._signatures[:start]
+                self._signatures = grown
+            self._signatures[start:needed] = signatures
+            for offset, (item_id, _, _, num_personas) in enumerate(items):
+                row = start + offset
+                self._ids.append(item_id)
+                self._num_personas.append(num_personas)
+                self._known.add(item_id)
+                for band, key in zip(self._buckets, band_keys[offset]):
+                    band.setdefault(key, []).append(row)
+
+    def add(self, item_id: int, product: str, target: str, num_personas: int) -> None:
+        self.add_many([(item_id, product, target, num_personas)])
+
+    def lookup(self, product: str, target: str, num_personas: Optional[int] = None) -> Optional[Tuple[int, float]]:
+        """Most similar indexed request at or above the threshold: (item id, estimated Jaccard)"""
+        signature = self.signature(product, target)
+        keys = self._band_keys(signature[None, :])[0].tolist()
+        with self._lock:
+            self._stats["lookups"] += 1
+            candidates: Set[int] = set()
+            for band, key in zip(self._buckets, keys):
+                candidates.update(band.get(key, ()))
+            if num_personas is not None:
+                candidates = {row for row in candidates if self._num_personas[row] == num_personas}
+            if not candidates:
+                return None
+            rows = np.fromiter(candidates, dtype=np.int64, count=len(candidates))
+            scores = (self._signatures[rows] == signature).mean(axis=1)
+            best = int(scores.argmax())
+            if scores[best] < self.threshold:
+                return None
+            self._stats["hits"] += 1
+            return self._ids[int(rows[best])], float(scores[best])
+
+    def record_accepted(self) -> None:
+        with self._lock:
+            self._stats["accepted"] += 1
+
+    def stats(self) -> Dict[str, float]:
+        with self._lock:
+            stats: Dict[str, float] = dict(self._stats)
+            stats["indexed"] = len(self._ids)
+        lookups = stats["lookups"]
+        stats["hit_rate"] = stats["hits"] / lookups if lookups else 0.0
+        stats["accept_rate"] = stats["accepted"] / stats["hits"] if stats["hits"] else 0.0
+        return stats
+
+    def load(self, library: PersonaLibrary, batch_size: int = 2000) -> None:
+        batch: List[Tuple[int, str, str, int]] = []
+        for row in library.requests():
+            batch.append(row)
+            if len(batch) >= batch_size:
+                self.add_many(batch)
+                batch = []
+        self.add_many(batch)
+
+
+_index: Optional[SimilarityIndex] = None
+_index_lock = threading.Lock()
+
+
+def get_similarity_index() -> Optional[SimilarityIndex]:
+    """Process-wide index over the persona library's past requests (None when either is disabled).
+
+    Past requests are indexed on a background thread, so the first page load is not delayed;
+    until it finishes, lookups just see fewer candidates.
+    """
+    global _index
+    if not env_flag("SIMILARITY_ENABLED", True):
+        return None
+    library = get_persona_library()
+    if library is None:
+        return None
+    with _index_lock:
+        if _index is None:
+            _index = SimilarityIndex(threshold=float(os.getenv("SIMILARITY_THRESHOLD", "0.6")))
+            threading.Thread(target=_index.load, args=(library,), name="similarity-load", daemon=True).start()
+        return _index
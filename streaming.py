@@ -0,0 +1,99 @@
+from __future__ import annotations
+import json
+from typing import List, Optional
+
+from pydantic import ValidationError
+
+import metrics
+from persona_schema import Persona, validate_persona
+
+
+class IncrementalPersonaParser:
+    """Incremental JSON scanner that yields each persona as soon as its object closes.
+
+    Accepts both ``{"personas": [{...}, ...]}`` and a bare ``[{...}, ...]`` document.
+    Text outside the JSON document (markdown fences, prose) is ignored.
+    """
+
+    def __init__(self) -> None:
+        self._buffer: List[str] = []
+        # Text from absolute offset ``_pending_start`` on, kept only while a persona is open, so each
+        # character is joined about once however many chunks the persona spans
+        self._pending: List[str] = []
+        self._pending_start = 0
+        self._stack: List[str] = []
+        self._in_string = False
+        self._escape = False
+        self._start: Optional[int] = None
+        self._pos = 0
+        self.personas: List[Persona] = []
+        self.rejected = 0
+
+    @property
+    def text(self) -> str:
+        return "".join(self._buffer)
+
+    def feed(self, chunk: str) -> List[Persona]:
+        """Consume a text chunk and return the personas completed by it"""
+        if not chunk:
+            return []
+        self._buffer.append(chunk)
+        self._pending.append(chunk)
+        completed: List[Persona] = []
+        base = self._pos
+        for offset, ch in enumerate(chunk):
+            index = base + offset
+            if self._in_string:
+                if self._escape:
+                    self._escape = False
+                elif ch == "\\":
+                    self._escape = True
+                elif ch == '"':
+                    self._in_string = False
+                continue
+            if ch == '"':
+                if self._stack:
+                    self._in_string = True
+            elif ch in "{[":
+                if ch == "{" and self._at_persona_level():
+                    self._start = index
+                self._stack.append(ch)
+            elif ch in "}]":
+                if self._stack:
+                    self._stack.pop()
+                if ch == "}" and self._start is not None and self._at_persona_level():
+                    persona = self._validate(self._slice(self._start, index + 1))
+                    self._start = None
+                    if persona is not None:
+                        self.personas.append(persona)
+                        completed.append(persona)
+        self._pos += len(chunk)
+        if self._start is None:
+            self._pending = []
+            self._pending_start = self._pos
+        return completed
+
+    def _at_persona_level(self) -> bool:
+        # Persona objects live directly inside the top-level array
+        return self._stack == ["{", "["] or self._stack == ["["]
+
+    def _slice(self, start: int, end: int) -> str:
+        pending = "".join(self._pending)
+        base = self._pending_start
+        # Whatever follows the persona stays pending for the next one
+        self._pending = [pending[end - base:]]
+        self._pending_start = end
+        return pending[start - base:end - base]
+
+    def _validate(self, raw: str) -> Optional[Persona]:
+        try:
+            with metrics.stage("parse_validate"):
+                return Persona.model_validate_json(raw)
+        except ValidationError:
+            pass
+        # Slow path only for objects with model quirks
+        try:
+            return validate_persona(json.loads(raw))
+        except (ValueError, ValidationError):
+            self.rejected += 1
+            return None
@@ -0,0 +1,316 @@
+from __future__ import annotations
+import argparse
+import json
+import os
+import re
+import sys
+import threading
+import time
+import uuid
+from array import array
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, Iterator, List, Optional, Set, Tuple
+
+import metrics
+from llm_client import LLMClient
+from persona_schema import Persona
+from utils import load_env
+
+
+MIN_PERSONAS = 50
+MAX_PERSONAS = 500
+# Columns of the study table (the full persona is read only for the selected row)
+TABLE_FIELDS = ("name", "age_range", "gender", "occupation", "location", "income_range")
+
+_ID_RE = re.compile(r"^[0-9a-f]{12}$")
+
+
+class StudyStore:
+    """Append-only JSONL of ``{"segment": ..., "persona": ...}`` lines plus their byte offsets"""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        # Start of every complete line; 8 bytes per persona is all a study keeps in memory
+        self._offsets = array("q")
+        self._size = 0
+        if os.path.exists(path):
+            self._scan()
+
+    def _scan(self) -> None:
+        # Reopened after a restart: a line cut short by a crash is dropped
+        with open(self.path, "rb") as fh:
+            position = 0
+            for line in fh:
+                if not line.endswith(b"\n"):
+                    break
+                self._offsets.append(position)
+                position += len(line)
+        self._size = position
+
+    def append(self, segment: str, personas: List[Persona]) -> None:
+        data = "".join(
+            json.dumps({"segment": segment, "persona": p.model_dump(exclude_none=True)}, ensure_ascii=False) + "\n"
+            for p in personas
+        ).encode("utf-8")
+        with self._lock:
+            with open(self.path, "ab") as fh:
+                fh.truncate(self._size)
+                fh.write(data)
+            # Offsets are published after the write, so readers only ever see complete lines
+            for line in data.splitlines(keepends=True):
+                self._offsets.append(self._size)
+                self._size += len(line)
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._offsets)
+
+    def read(self, start: int, count: int) -> List[Tuple[str, Persona]]:
+        """``count`` (segment, persona) pairs from position ``start``, with a single seek"""
+        with self._lock:
+            end = min(start + count, len(self._offsets))
+            if start >= end:
+                return []
+            first = self._offsets[start]
+            last = self._offsets[end] if end < len(self._offsets) else self._size
+        with open(self.path, "rb") as fh:
+            fh.seek(first)
+            lines = fh.read(last - first).splitlines()
+        items = [json.loads(line) for line in lines]
+        return [(item.get("segment", ""), Persona.model_validate(item["persona"])) for item in items]
+
+    def rows(self, start: int, count: int) -> List[Dict[str, Any]]:
+        """Table rows for one page: position, segment and the short fields"""
+        return [
+            {"#": start + i + 1, "segment": segment, **{f: getattr(p, f) or "" for f in TABLE_FIELDS}}
+            for i, (segment, p) in enumerate(self.read(start, count))
+        ]
+
+    def iter_personas(self, batch: int = 200) -> Iterator[Tuple[str, Persona]]:
+        for start in range(0, len(self), batch):
+            yield from self.read(start, batch)
+
+    def export_parquet(self, path: str, batch: int = 500) -> None:
+        """Write the study as Parquet, ``batch`` rows at a time (needs ``pyarrow``)"""
+        # Optional dependency: only needed for the export
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        schema = pa.schema(
+            [("position", pa.int32()), ("segment", pa.string())]
+            + [(f, pa.string()) for f in TABLE_FIELDS]
+            + [("preferred_channels", pa.list_(pa.string())), ("summary", pa.string()), ("persona_json", pa.string())]
+        )
+        with pq.ParquetWriter(path, schema) as writer:
+            for start in range(0, len(self), batch):
+                rows = [
+                    {
+                        "position": start + i + 1,
+                        "segment": segment,
+                        **{f: getattr(p, f) for f in TABLE_FIELDS},
+                        "preferred_channels": p.preferred_channels,
+                        "summary": p.summary,
+                        "persona_json": p.model_dump_json(exclude_none=True),
+                    }
+                    for i, (segment, p) in enumerate(self.read(start, batch))
+                ]
+                writer.write_table(pa.Table.from_pylist(rows, schema=schema))
+
+
+def parquet_available() -> bool:
+    try:
+        import pyarrow.parquet  # noqa: F401
+    except ImportError:
+        return False
+    return True
+
+
+class Study:
+    """One study's settings and progress; the personas themselves live in its store"""
+
+    def __init__(self, study_id: str, directory: str, product: str, target: str, num_personas: int,
+                 user: Optional[str] = None, status: str = "queued", created_at: Optional[float] = None):
+        self.id = study_id
+        self.directory = directory
+        self.product = product
+        self.target = target
+        self.num_personas = num_personas
+        self.user = user
+        self.status = status
+        self.error: Optional[str] = None
+        self.created_at = created_at or time.time()
+        self.finished_at: Optional[float] = None
+        self.segments = 0
+        self._segments: Set[int] = set()
+        self.usage: Dict[str, int] = {}
+        self.rate_wait_until: Optional[float] = None
+        os.makedirs(directory, exist_ok=True)
+        self.store = StudyStore(os.path.join(directory, "personas.jsonl"))
+
+    @property
+    def done(self) -> bool:
+        return self.status in {"done", "error", "interrupted"}
+
+    @property
+    def rate_wait(self) -> float:
+        """Seconds until the governor lets the next chunk through (0 when not throttled)"""
+        return max(0.0, (self.rate_wait_until or 0.0) - time.time())
+
+    def _on_rate_wait(self, seconds: float, ahead: int) -> None:
+        self.rate_wait_until = time.time() + seconds
+
+    def _on_personas(self, index: int, seed: Dict[str, str], personas: List[Persona]) -> None:
+        self.store.append(seed["label"], personas)
+        # Top-up rounds deliver the same segment again: count each planned segment once
+        self._segments.add(index)
+        self.segments = len(self._segments)
+        self.rate_wait_until = None
+
+    def save(self) -> None:
+        meta = {
+            "id": self.id, "product": self.product, "target": self.target, "num_personas": self.num_personas,
+            "user": self.user, "status": self.status, "error": self.error, "created_at": self.created_at,
+            "finished_at": self.finished_at, "usage": self.usage,
+        }
+        path = os.path.join(self.directory, "meta.json")
+        with open(path + ".tmp", "w", encoding="utf-8") as fh:
+            json.dump(meta, fh, ensure_ascii=False)
+        os.replace(path + ".tmp", path)
+
+    @classmethod
+    def load(cls, directory: str) -> Optional["Study"]:
+        try:
+            with open(os.path.join(directory, "meta.json"), encoding="utf-8") as fh:
+                meta = json.load(fh)
+        except (OSError, ValueError):
+            return None
+        # Not in this process's memory: a study still marked as running lost its worker in a restart
+        status = meta["status"] if meta["status"] in {"done", "error"} else "interrupted"
+        study = cls(meta["id"], directory, meta["product"], meta["target"], meta["num_personas"],
+                    user=meta.get("user"), status=status, created_at=meta.get("created_at"))
+        study.error = meta.get("error")
+        study.finished_at = meta.get("finished_at")
+        study.usage = meta.get("usage") or {}
+        return study
+
+
+def run_study(study: Study, chunk_size: Optional[int] = None) -> None:
+    """Generate ``study`` into its store; errors are recorded on the study, not raised"""
+    study.status = "running"
+    study.save()
+    try:
+        client = LLMClient(user=study.user)
+        client.on_rate_wait = study._on_rate_wait
+        client.generate_study(
+            study.product, study.target, study.num_personas, study._on_personas,
+            chunk_size=chunk_size or int(os.getenv("STUDY_CHUNK_SIZE", "5")),
+        )
+        study.usage = dict(client.last_usage)
+        study.status = "done"
+    except Exception as exc:
+        study.error = str(exc) or type(exc).__name__
+        study.status = "error"
+    study.finished_at = time.time()
+    study.save()
+
+
+class StudyManager:
+    """Runs studies on a small dedicated pool so they never starve the interactive job queue"""
+
+    def __init__(self, root: str, max_workers: int = 1):
+        self.root = root
+        self.max_workers = max_workers
+        self._pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="persona-study")
+        self._lock = threading.Lock()
+        self._studies: Dict[str, Study] = {}
+        self._stats = {"submitted": 0, "completed": 0, "failed": 0}
+
+    def submit(self, product: str, target: str, num_personas: int, user: Optional[str] = None) -> Study:
+        if not MIN_PERSONAS <= num_personas <= MAX_PERSONAS:
+            raise ValueError(f"Un estudio tiene entre {MIN_PERSONAS} y {MAX_PERSONAS} personas")
+        study_id = uuid.uuid4().hex[:12]
+        study = Study(study_id, os.path.join(self.root, study_id), product, target, num_personas, user=user)
+        study.save()
+        with self._lock:
+            self._studies[study.id] = study
+            self._stats["submitted"] += 1
+        metrics.inc("studies_total", result="submitted")
+        self._pool.submit(self._run, study)
+        return study
+
+    def _run(self, study: Study) -> None:
+        run_study(study)
+        with self._lock:
+            self._stats["completed" if study.status == "done" else "failed"] += 1
+
+    def get(self, study_id: str) -> Optional[Study]:
+        """Study by id; finished ones are reopened from disk after a restart"""
+        if not _ID_RE.match(study_id or ""):
+            return None
+        with self._lock:
+            study = self._studies.get(study_id)
+            if study is None:
+                study = Study.load(os.path.join(self.root, study_id))
+                if study is not None:
+                    self._studies[study_id] = study
+            return study
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            stats: Dict[str, Any] = dict(self._stats)
+            stats["running"] = sum(1 for s in self._studies.values() if s.status == "running")
+        return stats
+
+
+_manager: Optional[StudyManager] = None
+_manager_lock = threading.Lock()
+
+
+def get_study_manager() -> StudyManager:
+    """Process-wide study manager, shared by every Streamlit session"""
+    global _manager
+    with _manager_lock:
+        if _manager is None:
+            _manager = StudyManager(
+                os.getenv("STUDY_DIR", os.path.join(".cache", "studies")),
+                max_workers=int(os.getenv("STUDY_MAX_WORKERS", "1")),
+            )
+        return _manager
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="Estudio de segmentación con muchas personas (JSONL en disco)")
+    parser.add_argument("product", help="Descripción del producto")
+    parser.add_argument("target", help="Mercado objetivo")
+    parser.add_argument("--personas", type=int, default=100, help=f"Entre {MIN_PERSONAS} y {MAX_PERSONAS}")
+    parser.add_argument("--chunk-size", type=int, default=int(os.getenv("STUDY_CHUNK_SIZE", "5")),
+                        help="Personas por llamada (un segmento por llamada)")
+    parser.add_argument("--dir", default=os.getenv("STUDY_DIR", os.path.join(".cache", "studies")),
+                        help="Directorio de los estudios")
+    parser.add_argument("--parquet", help="Exportar también a este archivo Parquet (requiere pyarrow)")
+    args = parser.parse_args(argv)
+    if not MIN_PERSONAS <= args.personas <= MAX_PERSONAS:
+        parser.error(f"--personas debe estar entre {MIN_PERSONAS} y {MAX_PERSONAS}")
+
+    load_env()
+    metrics.configure()
+    study_id = uuid.uuid4().hex[:12]
+    study = Study(study_id, os.path.join(args.dir, study_id), args.product, args.target, args.personas)
+    worker = threading.Thread(target=run_study, args=(study, args.chunk_size), daemon=True)
+    worker.start()
+    while worker.is_alive():
+        worker.join(2.0)
+        print(f"{len(study.store)}/{study.num_personas} personas · {study.segments} segmentos", file=sys.stderr)
+    if study.status != "done":
+        print(f"Error: {study.error}", file=sys.stderr)
+        return 1
+    if args.parquet:
+        study.store.export_parquet(args.parquet)
+    print(json.dumps({"id": study.id, "path": study.store.path, "personas": len(study.store),
+                      "tokens": study.usage.get("total_tokens", 0)}))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,41 @@
+import httpx
+
+from batch import BatchRunner
+
+
+class CountingBucket:
+    def __init__(self):
+        self.taken = 0
+
+    def acquire(self, tokens=1.0):
+        self.taken += tokens
+        return 0.0
+
+
+def test_rpm_is_charged_per_provider_call_including_retries(monkeypatch):
+    monkeypatch.setenv("LLM_PROVIDER", "openai")
+    monkeypatch.setenv("OPENAI_API_KEY", "test-key")
+    # A model name of its own gives this test a fresh process-wide router
+    monkeypatch.setenv("OPENAI_MODEL", "test-batch-rpm")
+    monkeypatch.setenv("LLM_FAILOVER", "0")
+    monkeypatch.setenv("LLM_BACKOFF_BASE", "0")
+    monkeypatch.setenv("GOVERNOR_ENABLED", "0")
+    monkeypatch.setenv("PERSONA_CACHE_ENABLED", "0")
+    runner = BatchRunner(concurrency=1, diversify=False)
+    runner.bucket = CountingBucket()
+    client = runner._client()
+    calls = []
+
+    def complete(user_prompt, max_tokens):
+        calls.append(user_prompt)
+        if len(calls) == 1:
+            request = httpx.Request("POST", "http://llm.test/v1/chat/completions")
+            raise httpx.HTTPStatusError("503", request=request, response=httpx.Response(503, request=request))
+        return '{"personas": [{"name": "Ana", "age_range": "25-34"}, {"name": "Luis", "age_range": "35-44"}]}'
+
+    monkeypatch.setattr(client, "_complete_openai", complete)
+    result = runner.run_one({"id": "a", "product_description": "App", "target_market": "Jóvenes", "num_personas": 2})
+    assert len(result["bundle"]["personas"]) == 2
+    # One brief, one failed attempt and its retry: two provider calls, two tokens
+    assert len(calls) == 2
+    assert runner.bucket.taken == 2
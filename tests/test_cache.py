@@ -0,0 +1,60 @@
+import pytest
+
+import cache
+from cache import ResponseCache
+
+PERSONA = '{"name": "Ana", "age_range": "25-34"}'
+
+
+def test_entries_expire_after_ttl(tmp_path, monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(cache.time, "time", lambda: now[0])
+    store = ResponseCache(str(tmp_path / "cache.sqlite3"), ttl_seconds=60)
+    store.set("k", "payload")
+    assert store.get("k") == "payload"
+
+    now[0] += 61
+    assert store.get("k") is None
+    # Expired on disk too, not only in the memory tier
+    assert ResponseCache(str(tmp_path / "cache.sqlite3"), ttl_seconds=60).get("k") is None
+
+
+@pytest.fixture
+def client(tmp_path, monkeypatch):
+    monkeypatch.setenv("LLM_PROVIDER", "openai")
+    monkeypatch.setenv("OPENAI_API_KEY", "test-key")
+    monkeypatch.setenv("LLM_FAILOVER", "0")
+    monkeypatch.setenv("GOVERNOR_ENABLED", "0")
+    monkeypatch.setenv("LLM_TOPUP_ROUNDS", "0")
+    monkeypatch.setenv("PERSONA_CACHE_ENABLED", "1")
+    monkeypatch.setattr(cache, "_cache", ResponseCache(str(tmp_path / "cache.sqlite3")))
+    from llm_client import LLMClient
+
+    return LLMClient()
+
+
+def _answer(client, monkeypatch, personas):
+    calls = []
+
+    def complete(prompt, max_tokens, n=None):
+        calls.append(prompt)
+        return '{"personas": [' + ", ".join([PERSONA] * personas) + "]}"
+
+    monkeypatch.setattr(client, "_complete", complete)
+    return calls
+
+
+def test_partial_bundle_is_not_cached(client, monkeypatch):
+    calls = _answer(client, monkeypatch, personas=1)
+    assert len(client.generate_personas("App", "Jóvenes", 2).personas) == 1
+    assert len(client.generate_personas("App", "Jóvenes", 2).personas) == 1
+    assert len(calls) == 2
+    assert client.last_cache_key is None
+
+
+def test_full_bundle_is_cached(client, monkeypatch):
+    calls = _answer(client, monkeypatch, personas=2)
+    client.generate_personas("App", "Jóvenes", 2)
+    bundle = client.generate_personas("App", "Jóvenes", 2)
+    assert len(bundle.personas) == 2 and client.last_cache_hit
+    assert len(calls) == 1
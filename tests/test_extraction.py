@@ -0,0 +1,49 @@
+import pytest
+
+from extraction import extract_json_span, parse_lenient, personas_from_text
+from streaming import IncrementalPersonaParser
+
+PERSONA = '{"name": "Ana", "age_range": "25-34", "preferred_channels": ["Instagram"]}'
+
+
+def test_prose_braces_before_the_document():
+    text = 'Aquí {va} el resultado: {"personas": [' + PERSONA + "]}"
+    assert parse_lenient(text)["personas"][0]["name"] == "Ana"
+
+
+def test_unclosed_prose_bracket_before_the_document():
+    text = 'Nota [sin cerrar: {"personas": [' + PERSONA + "]} fin"
+    personas, rejected = personas_from_text(text)
+    assert [p.name for p in personas] == ["Ana"]
+    assert rejected == 0
+
+
+def test_fenced_document_with_trailing_prose():
+    text = '```json\n{"personas": [' + PERSONA + ']}\n```\nEspero que sirva {:)}'
+    assert extract_json_span(text) == '{"personas": [' + PERSONA + "]}"
+
+
+def test_truncated_output_keeps_complete_personas():
+    text = '{"personas": [' + PERSONA + ', {"name": "Bea", "age_ra'
+    personas, _ = personas_from_text(text)
+    assert [p.name for p in personas] == ["Ana"]
+
+
+def test_trailing_commas_and_python_literals():
+    text = "{'personas': [{'name': 'Ana', 'age_range': '25-34', 'gender': None,},],}"
+    personas, _ = personas_from_text(text)
+    assert personas[0].name == "Ana" and personas[0].gender is None
+
+
+def test_no_json_at_all():
+    with pytest.raises(ValueError):
+        parse_lenient("Lo siento, no puedo ayudar con eso.")
+
+
+@pytest.mark.parametrize("size", [1, 7, 1000])
+def test_stream_parser_yields_each_persona_once(size):
+    doc = "```json\n" + '{"personas": [' + ", ".join([PERSONA.replace("Ana", f"P{i}") for i in range(20)]) + "]}\n```"
+    parser = IncrementalPersonaParser()
+    names = [p.name for i in range(0, len(doc), size) for p in parser.feed(doc[i:i + size])]
+    assert names == [f"P{i}" for i in range(20)]
+    assert parser.text == doc
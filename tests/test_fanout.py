@@ -0,0 +1,25 @@
+import llm_client
+
+
+def test_only_failed_slots_are_retried(monkeypatch):
+    monkeypatch.setenv("LLM_PROVIDER", "openai")
+    monkeypatch.setenv("OPENAI_API_KEY", "test-key")
+    monkeypatch.setenv("LLM_FAILOVER", "0")
+    monkeypatch.setenv("GOVERNOR_ENABLED", "0")
+    monkeypatch.setenv("PERSONA_CACHE_ENABLED", "0")
+    client = llm_client.LLMClient()
+    monkeypatch.setattr(client, "plan_seeds", lambda *args: [{"label": f"S{i}", "description": ""} for i in range(3)])
+    # The prompt is the slot's own label, so each call can be told apart
+    monkeypatch.setattr(llm_client, "build_single_persona_prompt", lambda product, target, label, *args, **kwargs: label)
+    calls = []
+
+    async def complete(prompt, max_tokens, personas=None):
+        calls.append(prompt)
+        if prompt == "S1" and calls.count("S1") == 1:
+            return "lo siento, no puedo"
+        return '{"name": "Persona %s", "age_range": "25-34"}' % prompt
+
+    monkeypatch.setattr(client, "_acomplete", complete)
+    bundle = client.generate_personas_fanout("App", "Jóvenes", 3, fresh=True)
+    assert [p.name for p in bundle.personas] == ["Persona S0", "Persona S1", "Persona S2"]
+    assert sorted(calls) == ["S0", "S1", "S1", "S2"]
@@ -0,0 +1,95 @@
+import time
+
+import pytest
+
+from governor import RateDeferred, RateGovernor
+
+
+@pytest.fixture
+def governor(tmp_path):
+    return RateGovernor(str(tmp_path / "governor.sqlite3"), global_rpm=60, global_tpm=0, user_rpm=0, user_tpm=0)
+
+
+def _saturate(governor, seconds=600.0):
+    # Push the global request bucket far enough ahead that every call has to queue
+    governor._conn.execute(
+        "INSERT OR REPLACE INTO buckets (key, tat) VALUES ('global:openai:req', ?)", (time.time() + seconds,)
+    )
+
+
+def _free(governor):
+    governor._conn.execute("DELETE FROM buckets")
+
+
+def _order(governor):
+    return [user for (user,) in governor._conn.execute("SELECT user FROM waiters ORDER BY turn, id")]
+
+
+def _enqueue(governor, user):
+    wait, _, ticket = governor._attempt(user, "openai", 100, None)
+    assert wait > 0
+    return ticket
+
+
+def test_users_are_served_round_robin(governor):
+    _saturate(governor)
+    first = _enqueue(governor, "ana")
+    _enqueue(governor, "ana")
+    _enqueue(governor, "ana")
+    _enqueue(governor, "bea")
+    assert _order(governor) == ["ana", "bea", "ana", "ana"]
+
+    # Serving ana's oldest call does not move the rest of her backlog ahead of bea
+    _free(governor)
+    wait, ahead, ticket = governor._attempt("ana", "openai", 100, first)
+    assert (wait, ahead, ticket) == (0, 0, None)
+    _saturate(governor)
+    _enqueue(governor, "bea")
+    assert _order(governor) == ["bea", "ana", "bea", "ana"]
+
+
+def test_expected_wait_only_counts_waiters_ahead(governor):
+    _saturate(governor, seconds=60.0)
+    for _ in range(5):
+        _enqueue(governor, "ana")
+    assert governor.expected_wait("bea", "openai", 100) < governor.expected_wait("ana", "openai", 100)
+
+
+def _one_slot(governor):
+    # Exactly one call fits now; the next one has to wait for it
+    governor._conn.execute(
+        "INSERT OR REPLACE INTO buckets (key, tat) VALUES ('global:openai:req', ?)", (time.time() + 59,)
+    )
+
+
+def test_deferred_call_keeps_its_place(governor):
+    _saturate(governor)
+    with pytest.raises(RateDeferred) as info:
+        governor.acquire("ana", "openai", 100, max_wait=1.0)
+    assert info.value.wait > 1.0
+    assert info.value.ticket is not None
+    # bea queues in place after ana deferred: she lines up behind ana's kept ticket
+    bea = _enqueue(governor, "bea")
+    _enqueue(governor, "bea")
+    assert _order(governor) == ["ana", "bea", "bea"]
+
+    governor.keep(info.value.ticket)
+    _one_slot(governor)
+    wait, ahead, _ = governor._attempt("bea", "openai", 100, bea)
+    assert wait > 0 and ahead == 1
+    # Resuming with the ticket serves ana even though bea was polling in the meantime
+    assert governor.acquire("ana", "openai", 100, max_wait=0.5, ticket=info.value.ticket) == 0.0
+    assert _order(governor) == ["bea", "bea"]
+
+
+def test_stale_ticket_queues_again(governor):
+    _saturate(governor)
+    with pytest.raises(RateDeferred) as info:
+        governor.acquire("ana", "openai", 100, max_wait=1.0)
+    governor._conn.execute("UPDATE waiters SET heartbeat = 0")
+    # The pruned row's id goes to bea's call; ana's stale ticket must not take it over
+    _enqueue(governor, "bea")
+    with pytest.raises(RateDeferred) as again:
+        governor.acquire("ana", "openai", 100, max_wait=1.0, ticket=info.value.ticket)
+    assert again.value.ticket not in (None, info.value.ticket)
+    assert _order(governor) == ["bea", "ana"]
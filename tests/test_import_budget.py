@@ -0,0 +1,20 @@
+import os
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# Modules that belong behind login (diversity and similarity scoring need numpy)
+FORBIDDEN = ("pandas", "openpyxl", "openai", "httpx", "numpy", "diversity", "similarity")
+
+
+def test_login_page_does_not_import_heavy_modules(tmp_path):
+    env = dict(os.environ)
+    env.update({
+        "USER_STORE_PATH": str(tmp_path / "users.sqlite3"),
+        "LIBRARY_PATH": str(tmp_path / "persona_library.sqlite3"),
+        "METRICS_PORT": "",
+    })
+    code = f"import sys, app; print(','.join(m for m in {FORBIDDEN!r} if m in sys.modules))"
+    proc = subprocess.run([sys.executable, "-c", code], cwd=ROOT, env=env, capture_output=True, text=True, timeout=120)
+    assert proc.returncode == 0, proc.stderr[-2000:]
+    assert proc.stdout.strip().splitlines()[-1:] in ([], [""])
@@ -0,0 +1,123 @@
+import threading
+import time
+
+import pytest
+
+import governor as governor_module
+from jobs import JobManager, job_key
+from llm_client import LLMClient
+from persona_schema import Persona, PersonaBundle
+
+
+@pytest.fixture(autouse=True)
+def offline(monkeypatch):
+    monkeypatch.setenv("LLM_PROVIDER", "openai")
+    monkeypatch.setenv("OPENAI_API_KEY", "test-key")
+    monkeypatch.setenv("LLM_FAILOVER", "0")
+    monkeypatch.setenv("GOVERNOR_ENABLED", "0")
+    monkeypatch.setenv("LIBRARY_ENABLED", "0")
+    monkeypatch.setenv("PERSONA_CACHE_ENABLED", "0")
+
+
+def _wait(job, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while not job.done and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert job.done
+
+
+def test_identical_submissions_share_one_job(monkeypatch):
+    release = threading.Event()
+    calls = []
+
+    def generate(self, product, target, num_personas, fresh=False):
+        calls.append(product)
+        release.wait(5)
+        return PersonaBundle(personas=[Persona(name="Ana", age_range="25-34")])
+
+    monkeypatch.setattr(LLMClient, "generate_personas", generate)
+    manager = JobManager(max_workers=2)
+    first = manager.submit("full", "App", "Jóvenes", 1, user="ana")
+    second = manager.submit("full", " App ", "Jóvenes", 1, user="bea")
+    fresh = manager.submit("full", "App", "Jóvenes", 1, fresh=True, user="bea")
+    release.set()
+    for job in (first, fresh):
+        _wait(job)
+    assert second is first and first.subscribers == 2
+    assert fresh is not first
+    assert calls == ["App", "App"]
+    assert manager.stats()["coalesced"] == 1
+
+
+def test_job_key_covers_fresh_and_model_settings(monkeypatch):
+    base = job_key("full", "App", "Jóvenes", 4)
+    assert job_key("full", "App ", " Jóvenes", 4) == base
+    assert job_key("full", "App", "Jóvenes", 4, fresh=True) != base
+    assert job_key("stream", "App", "Jóvenes", 4) != base
+    monkeypatch.setenv("LLM_TEMPERATURE", "0.2")
+    assert job_key("full", "App", "Jóvenes", 4) != base
+
+
+def test_edit_runs_on_the_pool_and_returns_one_persona(monkeypatch):
+    edits = []
+
+    def refine(self, product, target, personas, index, instruction):
+        edits.append((index, instruction))
+        return personas[index].model_copy(update={"age_range": "18-24"})
+
+    monkeypatch.setattr(LLMClient, "refine_persona", refine)
+    manager = JobManager(max_workers=1)
+    personas = [Persona(name="Ana", age_range="35-44"), Persona(name="Luis", age_range="25-34")]
+    first = manager.submit_edit("refine", "App", "Jóvenes", personas, 0, instruction="más joven")
+    second = manager.submit_edit("refine", "App", "Jóvenes", personas, 0, instruction="más joven")
+    # Edits are not coalesced: each click is its own call
+    assert first.id != second.id
+    _wait(first)
+    _wait(second)
+    assert first.status == "done"
+    assert [(p.name, p.age_range) for p in first.bundle.personas] == [("Ana", "18-24")]
+    assert edits == [(0, "más joven"), (0, "más joven")]
+
+
+def test_deferred_job_gets_through_while_another_user_waits_in_place(monkeypatch, tmp_path):
+    monkeypatch.setenv("GOVERNOR_ENABLED", "1")
+    # 10 calls per second, one at a time once the bucket is full
+    gov = governor_module.RateGovernor(str(tmp_path / "governor.sqlite3"), global_rpm=600, global_tpm=0,
+                                       user_rpm=0, user_tpm=0)
+    monkeypatch.setattr(governor_module, "_governor", gov)
+    gov._conn.execute("INSERT INTO buckets (key, tat) VALUES ('global:openai:req', ?)", (time.time() + 60.3,))
+
+    def generate(self, product, target, num_personas, fresh=False):
+        self._govern("openai", product, 100)
+        return PersonaBundle(personas=[Persona(name="Ana", age_range="25-34")])
+
+    monkeypatch.setattr(LLMClient, "generate_personas", generate)
+
+    # bea (e.g. batch.py) keeps a call waiting in place the whole time
+    calls = 20
+    granted = []
+    stop = threading.Event()
+
+    def contend():
+        for _ in range(calls):
+            if stop.is_set():
+                return
+            gov.acquire("bea", "openai", 100)
+            granted.append(time.time())
+
+    worker = threading.Thread(target=contend, daemon=True)
+    worker.start()
+    deadline = time.monotonic() + 2
+    while not gov.stats()["waiting"] and time.monotonic() < deadline:
+        time.sleep(0.01)
+
+    manager = JobManager(max_workers=1, max_rate_wait=0.05)
+    job = manager.submit("full", "App", "Jóvenes", 1, user="ana")
+    _wait(job, timeout=10)
+    served_before = len(granted)
+    stop.set()
+    worker.join(5)
+    assert job.status == "done"
+    assert manager.stats()["deferred"] >= 1
+    # The job kept its place instead of re-queueing behind every new call of bea
+    assert served_before < calls
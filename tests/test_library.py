@@ -0,0 +1,52 @@
+import pytest
+
+from library import PersonaLibrary, fts_query
+from persona_schema import Persona, PersonaBundle
+
+
+@pytest.fixture
+def library(tmp_path):
+    library = PersonaLibrary(str(tmp_path / "library.sqlite3"))
+    # 12 motorcyclists (half 25-34, half ana's) and 3 cooks
+    riders = [
+        Persona(name=f"Rider {i}", age_range="25-34" if i % 2 else "35-44", occupation="Motociclista urbano",
+                motivations=["Ahorrar en transporte"])
+        for i in range(12)
+    ]
+    for start in range(0, 12, 4):
+        user = "ana@example.com" if start % 8 == 0 else "bea@example.com"
+        library.record(PersonaBundle(personas=riders[start:start + 4]), f"Seguro de moto {start}", "Jóvenes", user=user)
+    cooks = [Persona(name=f"Cook {i}", age_range="25-34", occupation="Cocinera") for i in range(3)]
+    library.record(PersonaBundle(personas=cooks), "Curso de cocina", "Adultos", user="ana@example.com")
+    return library
+
+
+def test_fts_query_quotes_prefix_terms():
+    assert fts_query('Moto "ahorro" OR') == '"moto"* "ahorro"* "or"*'
+    assert fts_query("  ") == ""
+
+
+def test_search_combines_text_age_and_user_filters(library):
+    rows, total = library.search("moto", page_size=50)
+    assert total == 12 and {r["name"][:5] for r in rows} == {"Rider"}
+
+    rows, total = library.search("motociclista", age_range="25-34", user="ana@example.com", page_size=50)
+    # ana owns the riders of bundles 0 and 2 (Rider 0-3 and 8-11), of which the odd ones are 25-34
+    assert total == 4
+    assert sorted(r["name"] for r in rows) == ["Rider 1", "Rider 11", "Rider 3", "Rider 9"]
+    assert {r["user"] for r in rows} == {"ana@example.com"}
+
+    _, total = library.search("", age_range="25-34", user="ana@example.com")
+    assert total == 7
+
+
+def test_pages_split_the_total(library):
+    pages = [library.search("moto", page=page, page_size=5) for page in range(3)]
+    assert [total for _, total in pages] == [12, 12, 12]
+    assert [len(rows) for rows, _ in pages] == [5, 5, 2]
+    ids = [row["id"] for rows, _ in pages for row in rows]
+    assert len(set(ids)) == 12
+
+    # Without a query rows come newest first
+    rows, total = library.search(page=0, page_size=3)
+    assert total == 15 and [r["name"] for r in rows] == ["Cook 2", "Cook 1", "Cook 0"]
@@ -0,0 +1,62 @@
+from prompt import (
+    adaptive_max_tokens,
+    build_user_prompt,
+    max_output_tokens,
+    max_tokens_for,
+    observe_persona_tokens,
+    static_prefix,
+)
+
+
+def test_static_prefix_is_byte_identical_across_calls():
+    first = build_user_prompt("App de ahorro", "Jóvenes 18-25", 3)
+    second = build_user_prompt("Curso de cocina", "Jubilados", 5, constraints="Solo personas de Chile")
+    prefix = static_prefix()
+    assert first.startswith(prefix) and second.startswith(prefix)
+    assert static_prefix(compact=True) == static_prefix(compact=True)
+    assert build_user_prompt("App", "Jóvenes", compact=True).startswith(static_prefix(compact=True))
+
+
+def test_custom_constraints_go_only_in_the_suffix():
+    prompt = build_user_prompt("App de ahorro", "Jóvenes 18-25", 3, constraints="Solo personas de Chile")
+    prefix = static_prefix()
+    assert "Solo personas de Chile" not in prefix
+    assert prompt[len(prefix):].endswith("Criterios (reemplazan a los anteriores): Solo personas de Chile")
+    assert "reemplazan" not in build_user_prompt("App de ahorro", "Jóvenes 18-25", 3)
+
+
+def test_output_budget_scales_with_personas(monkeypatch):
+    monkeypatch.setenv("LLM_TOKENS_PER_PERSONA", "700")
+    monkeypatch.setenv("LLM_TOKENS_OVERHEAD", "100")
+    assert [max_tokens_for(n) for n in (1, 3, 5)] == [800, 2200, 3600]
+
+
+def test_structured_hf_payload_pins_the_persona_count(monkeypatch):
+    monkeypatch.setenv("LLM_PROVIDER", "huggingface")
+    monkeypatch.setenv("HF_API_TOKEN", "test-token")
+    monkeypatch.setenv("HF_STRUCTURED", "1")
+    monkeypatch.setenv("LLM_FAILOVER", "0")
+    monkeypatch.setenv("GOVERNOR_ENABLED", "0")
+    monkeypatch.setenv("PERSONA_CACHE_ENABLED", "0")
+    from llm_client import LLMClient
+
+    _, _, payload = LLMClient()._hf_chat_request("prompt", 1234, personas=3)
+    personas = payload["response_format"]["value"]["properties"]["personas"]
+    assert personas["minItems"] == personas["maxItems"] == 3
+    assert payload["max_tokens"] == 1234
+
+
+def test_adaptive_budget_grows_after_truncation_within_its_ceiling(monkeypatch):
+    monkeypatch.setenv("LLM_TOKENS_PER_PERSONA", "700")
+    monkeypatch.setenv("LLM_TOKENS_OVERHEAD", "100")
+    monkeypatch.delenv("LLM_MAX_OUTPUT_TOKENS", raising=False)
+    model = "test-adaptive-budget"
+    assert adaptive_max_tokens(model, 3) == max_tokens_for(3)
+    observe_persona_tokens(model, 3, 900)
+    before = adaptive_max_tokens(model, 3)
+    assert before < max_tokens_for(3)
+    observe_persona_tokens(model, 3, before, truncated=True)
+    assert adaptive_max_tokens(model, 3) > before
+    for _ in range(10):
+        observe_persona_tokens(model, 3, 100_000, truncated=True)
+    assert adaptive_max_tokens(model, 3) == max_output_tokens(3)
@@ -0,0 +1,96 @@
+import time
+
+import httpx
+import pytest
+
+from router import CircuitBreaker, Router
+
+
+def _unavailable(provider: str) -> str:
+    request = httpx.Request("POST", "http://llm.test/v1/chat/completions")
+    raise httpx.HTTPStatusError("503", request=request, response=httpx.Response(503, request=request))
+
+
+def _half_open(breaker: CircuitBreaker) -> None:
+    breaker._failures = breaker.failure_threshold
+    breaker._opened_at = time.monotonic() - breaker.reset_timeout - 1
+
+
+def test_transient_failure_is_retried_by_the_router_only():
+    calls = []
+    router = Router({"openai": "m"}, max_retries=2, backoff_base=0.0)
+
+    def fn(provider):
+        calls.append(provider)
+        return _unavailable(provider)
+
+    with pytest.raises(httpx.HTTPStatusError):
+        router.call("openai", fn)
+    assert calls == ["openai"] * 3
+
+
+def test_openai_sdk_does_not_retry_on_its_own():
+    from clients import get_openai_client, new_async_openai_client
+
+    assert get_openai_client("test-key", "http://llm.test/v1").max_retries == 0
+    assert new_async_openai_client("test-key", "http://llm.test/v1").max_retries == 0
+
+
+def test_stream_failure_only_trips_on_transient_errors():
+    router = Router({"openai": "m"}, max_retries=0)
+    breaker = router.breakers["openai"]
+    _half_open(breaker)
+    assert router.pick("openai") == "openai"
+    router.record("openai", 0.1, False, ValueError("JSON inválido"))
+    assert breaker.state == "closed"
+
+
+def test_abandoned_stream_releases_half_open_probe(monkeypatch):
+    monkeypatch.setenv("LLM_PROVIDER", "openai")
+    monkeypatch.setenv("OPENAI_API_KEY", "test-key")
+    # A model name of its own gives this test a fresh process-wide router
+    monkeypatch.setenv("OPENAI_MODEL", "test-abandoned-stream")
+    monkeypatch.setenv("LLM_FAILOVER", "0")
+    monkeypatch.setenv("GOVERNOR_ENABLED", "0")
+    monkeypatch.setenv("PERSONA_CACHE_ENABLED", "0")
+    from llm_client import LLMClient
+
+    client = LLMClient()
+    persona = '{"name": "Ana", "age_range": "25-34"}'
+    monkeypatch.setattr(client, "_stream_openai", lambda prompt, budget: iter(['{"personas": [', persona, ", ", persona, "]}"]))
+    breaker = client._router.breakers["openai"]
+    _half_open(breaker)
+
+    stream = client.stream_personas("App de ahorro", "Jóvenes", 2, fresh=True)
+    assert next(stream).name == "Ana"
+    stream.close()
+
+    # The next call gets to probe, and its success closes the breaker
+    personas = list(client.stream_personas("App de ahorro", "Jóvenes", 2, fresh=True))
+    assert len(personas) == 2
+    assert breaker.state == "closed"
+
+
+def test_stream_is_charged_to_the_picked_provider(monkeypatch):
+    monkeypatch.setenv("LLM_PROVIDER", "openai")
+    monkeypatch.setenv("OPENAI_API_KEY", "test-key")
+    monkeypatch.setenv("HF_API_TOKEN", "test-token")
+    monkeypatch.setenv("OPENAI_MODEL", "test-stream-failover")
+    monkeypatch.setenv("LLM_FAILOVER", "1")
+    monkeypatch.setenv("LOCAL_MODEL_PATH", "")
+    monkeypatch.setenv("PERSONA_CACHE_ENABLED", "0")
+    from llm_client import LLMClient
+
+    client = LLMClient()
+    charged = []
+    monkeypatch.setattr(client, "_govern", lambda provider, prompt, budget: charged.append(provider))
+    persona = '{"name": "Ana", "age_range": "25-34"}'
+    monkeypatch.setattr(client, "_stream_hf", lambda prompt, budget, n: iter(['{"personas": [', persona, "]}"]))
+    # OpenAI's circuit is open, so the stream goes to Hugging Face and is charged there
+    breaker = client._router.breakers["openai"]
+    breaker._failures = breaker.failure_threshold
+    breaker._opened_at = time.monotonic()
+
+    personas = list(client.stream_personas("App de ahorro", "Jóvenes", 1, fresh=True))
+    assert [p.name for p in personas] == ["Ana"]
+    assert charged == ["huggingface"]
@@ -0,0 +1,38 @@
+from similarity import SimilarityIndex
+
+
+def _index(threshold=0.6):
+    index = SimilarityIndex(threshold=threshold)
+    index.add_many([
+        (1, "App móvil de ahorro para jóvenes", "Jóvenes de 18 a 25 años en Latinoamérica", 4),
+        (2, "App móvil de ahorro para jóvenes", "Jóvenes de 18 a 25 años en Latinoamérica", 3),
+        (3, "Curso online de cocina vegana", "Adultos mayores en España", 4),
+    ])
+    return index
+
+
+def test_lookup_finds_a_near_duplicate_with_the_same_size():
+    match = _index().lookup("App movil de ahorro para jovenes", "Jóvenes de 18 a 25 años en Latinoamérica", 4)
+    assert match is not None
+    item_id, score = match
+    assert item_id == 1 and score >= 0.6
+    assert _index().lookup("App movil de ahorro para jovenes", "Jóvenes de 18 a 25 años en Latinoamérica", 3)[0] == 2
+    assert _index().lookup("App movil de ahorro para jovenes", "Jóvenes de 18 a 25 años en Latinoamérica", 5) is None
+
+
+def test_lookup_respects_the_threshold():
+    product, target = "App móvil de ahorro para jóvenes", "Jóvenes de 18 a 25 años en Latinoamérica y España"
+    loose = _index(threshold=0.1).lookup(product, target, 4)
+    assert loose is not None and loose[0] == 1 and loose[1] < 1.0
+    # The same candidate is rejected once the threshold is above its estimated similarity
+    assert _index(threshold=loose[1] + 0.01).lookup(product, target, 4) is None
+    assert _index(threshold=loose[1]).lookup(product, target, 4) == loose
+    assert _index().lookup("Seguro de mascotas", "Dueños de perros en Chile", 4) is None
+
+
+def test_stats_count_lookups_and_hits():
+    index = _index()
+    index.lookup("App móvil de ahorro para jóvenes", "Jóvenes de 18 a 25 años en Latinoamérica", 4)
+    index.lookup("Seguro de mascotas", "Dueños de perros en Chile", 4)
+    stats = index.stats()
+    assert (stats["indexed"], stats["lookups"], stats["hits"]) == (3, 2, 1)
@@ -0,0 +1,62 @@
+import pytest
+
+from persona_schema import Persona
+from study import Study, StudyStore
+
+
+def _personas(*names):
+    return [Persona(name=name, age_range="25-34") for name in names]
+
+
+def test_read_pages_across_appends(tmp_path):
+    store = StudyStore(str(tmp_path / "personas.jsonl"))
+    store.append("Ahorradores", _personas("A1", "A2", "A3"))
+    store.append("Inversores", _personas("B1", "B2"))
+    assert len(store) == 5
+    assert [(s, p.name) for s, p in store.read(2, 2)] == [("Ahorradores", "A3"), ("Inversores", "B1")]
+    assert [p.name for _, p in store.read(4, 50)] == ["B2"]
+    assert store.read(5, 10) == []
+    assert [row["#"] for row in store.rows(3, 2)] == [4, 5]
+
+
+def test_line_cut_by_a_crash_is_dropped_and_overwritten(tmp_path):
+    path = tmp_path / "personas.jsonl"
+    store = StudyStore(str(path))
+    store.append("Ahorradores", _personas("A1", "A2"))
+    with open(path, "ab") as fh:
+        fh.write(b'{"segment": "Inversores", "persona": {"name": "B')
+
+    reopened = StudyStore(str(path))
+    assert len(reopened) == 2
+    reopened.append("Inversores", _personas("B1"))
+    assert [p.name for _, p in reopened.iter_personas()] == ["A1", "A2", "B1"]
+    assert StudyStore(str(path)).read(2, 1)[0][1].name == "B1"
+
+
+def test_study_without_personas_reports_the_chunk_error(monkeypatch):
+    monkeypatch.setenv("LLM_PROVIDER", "openai")
+    monkeypatch.setenv("OPENAI_API_KEY", "test-key")
+    monkeypatch.setenv("LLM_FAILOVER", "0")
+    monkeypatch.setenv("GOVERNOR_ENABLED", "0")
+    from llm_client import LLMClient
+
+    client = LLMClient()
+    monkeypatch.setattr(client, "plan_seeds", lambda *args: [{"label": f"S{i}", "description": ""} for i in range(2)])
+
+    async def fail(*args):
+        raise PermissionError("clave inválida")
+
+    monkeypatch.setattr(client, "_acomplete", fail)
+    with pytest.raises(PermissionError, match="clave inválida"):
+        client.generate_study("App", "Jóvenes", 10, lambda index, seed, personas: None, chunk_size=5, max_retries=1)
+
+
+def test_top_up_rounds_count_each_segment_once(tmp_path):
+    study = Study("0123456789ab", str(tmp_path / "study"), "App", "Jóvenes", 10)
+    seed = {"label": "Ahorradores", "description": ""}
+    study._on_personas(0, seed, _personas("A1", "A2", "A3"))
+    study._on_personas(1, {"label": "Inversores", "description": ""}, _personas("B1", "B2", "B3", "B4", "B5"))
+    # Segment 0 was short and its top-up arrives in a later round
+    study._on_personas(0, seed, _personas("A4", "A5"))
+    assert study.segments == 2
+    assert len(study.store) == 10
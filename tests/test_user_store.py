@@ -0,0 +1,45 @@
+import pytest
+
+import user_store
+from user_store import MemoryUserStore, UserStore, get_user_store, normalize_record, read_excel_records, write_excel_records
+
+
+@pytest.fixture(autouse=True)
+def memory_backend(monkeypatch, tmp_path):
+    monkeypatch.setenv("USER_STORE_BACKEND", "memory")
+    monkeypatch.setenv("USER_LOGIN_LOG", str(tmp_path / "logs" / "logins.jsonl"))
+    monkeypatch.setattr(user_store, "_stores", {})
+
+
+def test_same_count_credential_change_reloads(tmp_path):
+    users_file = str(tmp_path / "users.xlsx")
+    store = get_user_store(users_file, source_records=[{"email": "ana@example.com", "password_hash": "old"}])
+    assert store.get("ana@example.com")["password_hash"] == "old"
+
+    store = get_user_store(users_file, source_records=[{"email": "ana@example.com", "password_hash": "new"}])
+    assert store.get("ana@example.com")["password_hash"] == "new"
+
+
+def test_login_log_directory_is_created(tmp_path):
+    log = tmp_path / "cache" / "logins.jsonl"
+    store = MemoryUserStore(login_log=str(log))
+    store.load([{"email": "ana@example.com"}])
+    store.record_login("ana@example.com", "2026-01-01T10:00:00")
+    store.flush()
+    assert log.read_text(encoding="utf-8").strip() == '{"email": "ana@example.com", "at": "2026-01-01T10:00:00"}'
+
+
+def test_excel_round_trip(tmp_path):
+    path = str(tmp_path / "users.xlsx")
+    users = [{"email": "ana@example.com", "password_hash": "h", "created_at": "2026-01-01", "last_login": None}]
+    write_excel_records(path, users)
+    assert [normalize_record(r) for r in read_excel_records(path)] == users
+
+
+def test_backend_missing_a_hook_fails_on_instantiation():
+    class Partial(UserStore):
+        def load(self, records):
+            pass
+
+    with pytest.raises(TypeError):
+        Partial()
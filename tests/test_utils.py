@@ -0,0 +1,15 @@
+import pytest
+
+from utils import env_flag
+
+
+@pytest.mark.parametrize("value, default, expected", [
+    (None, True, True), ("", True, True), ("0", True, False), (" No ", True, False), ("off", True, True),
+    (None, False, False), ("1", False, True), ("TRUE", False, True), ("on", False, False),
+])
+def test_env_flag(monkeypatch, value, default, expected):
+    if value is None:
+        monkeypatch.delenv("TEST_FLAG", raising=False)
+    else:
+        monkeypatch.setenv("TEST_FLAG", value)
+    assert env_flag("TEST_FLAG", default) is expected
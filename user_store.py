@@ -0,0 +1,339 @@
+from __future__ import annotations
+import hashlib
+import json
+import os
+import queue
+import sqlite3
+import threading
+import time
+from abc import ABC, abstractmethod
+from datetime import datetime
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+
+USER_FIELDS = ["email", "password_hash", "created_at", "last_login"]
+
+
+def _clean(value: Any) -> Optional[str]:
+    # Excel cells come back as NaN/Timestamp; store plain strings or None
+    if value is None:
+        return None
+    if isinstance(value, float) and value != value:
+        return None
+    text = str(value).strip()
+    return text or None
+
+
+def normalize_record(record: Dict[str, Any]) -> Optional[Dict[str, Optional[str]]]:
+    email = _clean(record.get("email"))
+    if not email:
+        return None
+    user = {field: _clean(record.get(field)) for field in USER_FIELDS}
+    user["email"] = email.lower()
+    return user
+
+
+def read_excel_records(path: str) -> List[Dict[str, Any]]:
+    """Import format: users.xlsx with email, password_hash, created_at, last_login columns"""
+    # openpyxl directly (no pandas), and only when the workbook actually has to be imported
+    from openpyxl import load_workbook
+
+    workbook = load_workbook(path, read_only=True, data_only=True)
+    try:
+        rows = workbook.active.iter_rows(values_only=True)
+        header = [_clean(cell) for cell in next(rows, ())]
+        return [dict(zip(header, row)) for row in rows if any(cell is not None for cell in row)]
+    finally:
+        workbook.close()
+
+
+def write_excel_records(path: str, records: List[Dict[str, Any]]) -> None:
+    """Rewrite users.xlsx from ``records`` (admin edits only; logins never write the workbook)"""
+    from openpyxl import Workbook
+
+    workbook = Workbook(write_only=True)
+    sheet = workbook.create_sheet()
+    sheet.append(USER_FIELDS)
+    for record in records:
+        sheet.append([record.get(field) for field in USER_FIELDS])
+    # Written aside and swapped in, so a concurrent import never reads a half-written workbook
+    tmp = f"{path}.tmp"
+    workbook.save(tmp)
+    os.replace(tmp, path)
+
+
+class UserStore(ABC):
+    """Email-indexed user store.
+
+    Lookups never touch the source file; ``last_login`` updates are queued and flushed by a
+    background thread (append-only), so concurrent logins do not rewrite anything on the hot path.
+    """
+
+    def __init__(self, flush_interval: float = 2.0):
+        self.flush_interval = flush_interval
+        self._lock = threading.RLock()
+        self._pending: "queue.Queue[Tuple[str, str]]" = queue.Queue()
+        self._flusher: Optional[threading.Thread] = None
+
+    # --- backend hooks ---
+    @abstractmethod
+    def load(self, records: Iterable[Dict[str, Any]]) -> None:
+        ...
+
+    @abstractmethod
+    def get(self, email: str) -> Optional[Dict[str, Optional[str]]]:
+        ...
+
+    @abstractmethod
+    def all(self) -> List[Dict[str, Optional[str]]]:
+        ...
+
+    @abstractmethod
+    def delete(self, email: str) -> bool:
+        ...
+
+    @abstractmethod
+    def _write_logins(self, logins: List[Tuple[str, str]]) -> None:
+        ...
+
+    def imported_source(self) -> Optional[str]:
+        """Signature of the source last loaded into a persistent store (None if not tracked)"""
+        return None
+
+    def mark_imported(self, signature: str) -> None:
+        pass
+
+    # --- shared behaviour ---
+    def record_login(self, email: str, when: Optional[str] = None) -> str:
+        when = when or datetime.now().isoformat()
+        self._pending.put((email.lower().strip(), when))
+        self._ensure_flusher()
+        return when
+
+    def flush(self) -> None:
+        logins: List[Tuple[str, str]] = []
+        while True:
+            try:
+                logins.append(self._pending.get_nowait())
+            except queue.Empty:
+                break
+        if logins:
+            with self._lock:
+                self._write_logins(logins)
+
+    def _ensure_flusher(self) -> None:
+        with self._lock:
+            if self._flusher is not None and self._flusher.is_alive():
+                return
+            self._flusher = threading.Thread(target=self._flush_loop, name="user-store-flush", daemon=True)
+            self._flusher.start()
+
+    def _flush_loop(self) -> None:
+        while True:
+            time.sleep(self.flush_interval)
+            try:
+                self.flush()
+            except Exception:
+                # Login bookkeeping must never take the flusher down
+                pass
+
+
+class MemoryUserStore(UserStore):
+    """Dict index; logins are appended to an optional JSONL log and replayed on load"""
+
+    def __init__(self, login_log: Optional[str] = None, flush_interval: float = 2.0):
+        super().__init__(flush_interval)
+        self.login_log = login_log
+        directory = os.path.dirname(login_log or "")
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._users: Dict[str, Dict[str, Optional[str]]] = {}
+
+    def load(self, records: Iterable[Dict[str, Any]]) -> None:
+        users = {}
+        for record in records:
+            user = normalize_record(record)
+            if user:
+                users[user["email"]] = user
+        for email, when in self._read_log():
+            if email in users:
+                users[email]["last_login"] = when
+        with self._lock:
+            self._users = users
+
+    def get(self, email: str) -> Optional[Dict[str, Optional[str]]]:
+        user = self._users.get(email.lower().strip())
+        return dict(user) if user else None
+
+    def all(self) -> List[Dict[str, Optional[str]]]:
+        return [dict(u) for u in self._users.values()]
+
+    def delete(self, email: str) -> bool:
+        with self._lock:
+            return self._users.pop(email.lower().strip(), None) is not None
+
+    def record_login(self, email: str, when: Optional[str] = None) -> str:
+        when = super().record_login(email, when)
+        user = self._users.get(email.lower().strip())
+        if user:
+            user["last_login"] = when
+        return when
+
+    def _read_log(self) -> List[Tuple[str, str]]:
+        if not self.login_log or not os.path.exists(self.login_log):
+            return []
+        entries = []
+        with open(self.login_log, encoding="utf-8") as fh:
+            for line in fh:
+                try:
+                    item = json.loads(line)
+                    entries.append((item["email"], item["at"]))
+                except (ValueError, KeyError):
+                    continue
+        return entries
+
+    def _write_logins(self, logins: List[Tuple[str, str]]) -> None:
+        if not self.login_log:
+            return
+        with open(self.login_log, "a", encoding="utf-8") as fh:
+            for email, when in logins:
+                fh.write(json.dumps({"email": email, "at": when}) + "\n")
+
+
+class SQLiteUserStore(UserStore):
+    """SQLite table indexed by email (primary key) plus an append-only logins table"""
+
+    def __init__(self, db_path: str, flush_interval: float = 2.0):
+        super().__init__(flush_interval)
+        directory = os.path.dirname(db_path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._conn = sqlite3.connect(db_path, check_same_thread=False, timeout=10)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS users ("
+            " email TEXT PRIMARY KEY, password_hash TEXT, created_at TEXT, last_login TEXT)"
+        )
+        self._conn.execute("CREATE TABLE IF NOT EXISTS logins (email TEXT NOT NULL, at TEXT NOT NULL)")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+        self._conn.commit()
+
+    def load(self, records: Iterable[Dict[str, Any]]) -> None:
+        users = [u for u in (normalize_record(r) for r in records) if u]
+        with self._lock:
+            # Re-import keeps the newest last_login known to either side
+            self._conn.executemany(
+                "INSERT INTO users (email, password_hash, created_at, last_login) VALUES (?, ?, ?, ?)"
+                " ON CONFLICT(email) DO UPDATE SET password_hash = excluded.password_hash,"
+                " created_at = excluded.created_at,"
+                " last_login = NULLIF(MAX(COALESCE(users.last_login, ''), COALESCE(excluded.last_login, '')), '')",
+                [(u["email"], u["password_hash"], u["created_at"], u["last_login"]) for u in users],
+            )
+            emails = [u["email"] for u in users]
+            placeholders = ",".join("?" for _ in emails)
+            if emails:
+                self._conn.execute(f"DELETE FROM users WHERE email NOT IN ({placeholders})", emails)
+            else:
+                self._conn.execute("DELETE FROM users")
+            self._conn.commit()
+
+    def get(self, email: str) -> Optional[Dict[str, Optional[str]]]:
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT email, password_hash, created_at, last_login FROM users WHERE email = ?",
+                (email.lower().strip(),),
+            ).fetchone()
+        return dict(zip(USER_FIELDS, row)) if row else None
+
+    def all(self) -> List[Dict[str, Optional[str]]]:
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT email, password_hash, created_at, last_login FROM users ORDER BY email"
+            ).fetchall()
+        return [dict(zip(USER_FIELDS, row)) for row in rows]
+
+    def delete(self, email: str) -> bool:
+        with self._lock:
+            cur = self._conn.execute("DELETE FROM users WHERE email = ?", (email.lower().strip(),))
+            self._conn.commit()
+            return cur.rowcount > 0
+
+    def imported_source(self) -> Optional[str]:
+        with self._lock:
+            row = self._conn.execute("SELECT value FROM meta WHERE key = 'imported_source'").fetchone()
+        return row[0] if row else None
+
+    def mark_imported(self, signature: str) -> None:
+        with self._lock:
+            self._conn.execute(
+                "INSERT INTO meta (key, value) VALUES ('imported_source', ?)"
+                " ON CONFLICT(key) DO UPDATE SET value = excluded.value",
+                (signature,),
+            )
+            self._conn.commit()
+
+    def _write_logins(self, logins: List[Tuple[str, str]]) -> None:
+        self._conn.executemany("INSERT INTO logins (email, at) VALUES (?, ?)", logins)
+        self._conn.executemany(
+            "UPDATE users SET last_login = ? WHERE email = ? AND COALESCE(last_login, '') < ?",
+            [(when, email, when) for email, when in logins],
+        )
+        self._conn.commit()
+
+
+_stores: Dict[str, Tuple[UserStore, Any]] = {}
+_stores_lock = threading.Lock()
+
+
+def _new_store(users_file: str) -> UserStore:
+    backend = os.getenv("USER_STORE_BACKEND", "sqlite").strip().lower()
+    if backend == "memory":
+        return MemoryUserStore(login_log=os.getenv("USER_LOGIN_LOG", os.path.join(".cache", "logins.jsonl")))
+    if backend == "sqlite":
+        return SQLiteUserStore(os.getenv("USER_STORE_PATH", os.path.join(".cache", "users.sqlite3")))
+    raise ValueError("USER_STORE_BACKEND debe ser 'sqlite' o 'memory'")
+
+
+def get_user_store(users_file: str = "users.xlsx",
+                   source_records: Optional[List[Dict[str, Any]]] = None) -> UserStore:
+    """Process-wide store, (re)loaded only when its source changes.
+
+    ``source_records`` (e.g. from st.secrets) take precedence over ``users_file``; the Excel
+    file is re-imported only when its mtime changes. A persistent store remembers the file
+    version it holds, so a restarted process does not open the workbook again either.
+    """
+    if source_records is not None:
+        # Content hash, so a changed password or email with the same number of users still reloads
+        digest = hashlib.sha256(
+            json.dumps(sorted(json.dumps(r, sort_keys=True, default=str) for r in source_records)).encode("utf-8")
+        ).hexdigest()
+        signature: Any = ("records", digest)
+    elif os.path.exists(users_file):
+        stat = os.stat(users_file)
+        signature = ("file", stat.st_mtime_ns, stat.st_size)
+    else:
+        signature = ("empty",)
+
+    with _stores_lock:
+        store, loaded = _stores.get(users_file, (None, None))
+        if store is None:
+            store = _new_store(users_file)
+            if signature[0] == "file" and store.imported_source() == json.dumps([users_file, *signature]):
+                loaded = signature
+                _stores[users_file] = (store, signature)
+        if loaded != signature:
+            try:
+                if source_records is not None:
+                    store.load(source_records)
+                elif signature[0] == "file":
+                    store.load(read_excel_records(users_file))
+                else:
+                    store.load([])
+                store.mark_imported(json.dumps([users_file, *signature]) if signature[0] == "file" else "")
+            except Exception:
+                # A half-written workbook must not lock everyone out: keep serving the last import
+                if loaded is not None:
+                    return store
+                raise
+            _stores[users_file] = (store, signature)
+        return store
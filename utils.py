@@ -9,3 +9,11 @@ def load_env() -> None:
     if os.getenv("LLM_PROVIDER"):
         os.environ["LLM_PROVIDER"] = os.getenv("LLM_PROVIDER").strip().lower()
 
+
+
+def env_flag(name: str, default: bool = False) -> bool:
+    # On/off switches: a flag that defaults on is only turned off by 0/false/no, and vice versa
+    value = os.getenv(name, "").strip().lower()
+    if not value:
+        return default
+    return value not in {"0", "false", "no"} if default else value in {"1", "true", "yes"}